@@ -2,6 +2,7 @@ __author__ = 'alessio.rocchi'
 
 from pyVim import connect
 from pyVmomi import vim
+from vspherelib.helper.tasks import collectors
 import pyVmomi
 
 
@@ -60,7 +61,8 @@ class VcInterface(object):
             return True
         return False
 
-    def collect_properties(self, view_ref, obj_type, path_set=None, include_mors=False):
+    def collect_properties(self, view_ref, obj_type, path_set=None, include_mors=False, page_size=1000,
+                           traversal=None, joins=None):
         """
         Collect properties for managed objects from a view ref
         Check the vSphere API documentation for example on retrieving
@@ -69,14 +71,30 @@ class VcInterface(object):
         Args:
             si          (ServiceInstance): ServiceInstance connection
             view_ref (pyVmomi.vim.view.*): Starting point of inventory navigation
-            obj_type      (pyVmomi.vim.*): Type of managed object
-            path_set               (list): List of properties to retrieve
+            obj_type      (pyVmomi.vim.*): Type of managed object, or a list of
+                                           types to collect in the same call
+            path_set        (list / dict): List of properties to retrieve, or a
+                                           dict type -> list of properties when
+                                           obj_type is a list
             include_mors           (bool): If True include the managed objects
                                            refs in the result
+            page_size               (int): Max number of objects returned by
+                                           each RetrievePropertiesEx round trip
+            traversal              (list): List of (type, property) references
+                                           to follow from the objects of the
+                                           view, e.g. (vim.VirtualMachine,
+                                           'resourcePool'). Referenced objects
+                                           are collected in the same call when
+                                           their type is in obj_type
+            joins                  (dict): key -> list of reference properties.
+                                           The properties of the object reached
+                                           following the references are added
+                                           under key, e.g. {'cluster':
+                                           ['resourcePool', 'owner']}
         Returns:
             A list of properties for the managed objects
         """
-        collector = self.si.content.propertyCollector
+        collector = self.content.propertyCollector
 
         # Create object specification to define the starting point of
         # inventory navigation
@@ -92,36 +110,110 @@ class VcInterface(object):
         traversal_spec.type = view_ref.__class__
         obj_spec.selectSet = [traversal_spec]
 
-        # Identify the properties to the retrieved
-        property_spec = pyVmomi.vmodl.query.PropertyCollector.PropertySpec()
-        property_spec.type = obj_type
-
-        if not path_set:
-            property_spec.all = True
+        # Follow the references: every hop may be followed from any other one.
+        if traversal:
+            names = ['hop{}'.format(index) for index in range(len(traversal))]
+            hops = []
+            for name, (_type, path) in zip(names, traversal):
+                hop = pyVmomi.vmodl.query.PropertyCollector.TraversalSpec(name=name, type=_type, path=path,
+                                                                          skip=False)
+                hop.selectSet = [pyVmomi.vmodl.query.PropertyCollector.SelectionSpec(name=n) for n in names]
+                hops.append(hop)
+            traversal_spec.selectSet = hops
 
-        property_spec.pathSet = path_set
+        # Identify the properties to the retrieved
+        if not isinstance(obj_type, (list, tuple)):
+            obj_type = [obj_type]
+            path_set = {obj_type[0]: path_set}
+        property_specs = []
+        for _type in obj_type:
+            property_spec = pyVmomi.vmodl.query.PropertyCollector.PropertySpec()
+            property_spec.type = _type
+            _path_set = (path_set or {}).get(_type)
+            if not _path_set:
+                property_spec.all = True
+            property_spec.pathSet = _path_set
+            property_specs.append(property_spec)
 
         # Add the object and property specification to the
         # property filter specification
         filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec()
         filter_spec.objectSet = [obj_spec]
-        filter_spec.propSet = [property_spec]
-
-        # Retrieve properties
-        props = collector.RetrieveContents([filter_spec])
+        filter_spec.propSet = property_specs
+
+        # Retrieve properties, page after page
+        options = pyVmomi.vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+        result = collector.RetrievePropertiesEx([filter_spec], options)
+        props = []
+        while result:
+            props.extend(result.objects)
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(result.token)
 
         data = []
         for obj in props:
             properties = {}
             for prop in obj.propSet:
                 properties[prop.name] = prop.val
-            if include_mors:
+            if include_mors or joins:
                 properties['obj'] = obj.obj
             data.append(properties)
+
+        if joins:
+            index = dict((properties['obj']._moId, properties) for properties in data)
+            for properties in data:
+                for key, references in joins.items():
+                    joined = properties
+                    for reference in references:
+                        ref = joined.get(reference)
+                        joined = index.get(ref._moId) if ref is not None else None
+                        if joined is None:
+                            break
+                    if joined is not None:
+                        properties[key] = joined
         return data
 
+    def get_properties(self, obj, path_set):
+        """Fetch some properties of a single managed object with one RetrievePropertiesEx round trip.
+        :param obj: managed object, bound to any stub: only its type and id are sent.
+        :param path_set: list of property paths.
+        :return: dict property path -> value. Properties not set on the object are missing.
+        """
+        obj_spec = pyVmomi.vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False)
+        property_spec = pyVmomi.vmodl.query.PropertyCollector.PropertySpec(type=obj.__class__, pathSet=path_set)
+        filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[property_spec])
+        result = self.content.propertyCollector.RetrievePropertiesEx(
+            [filter_spec], pyVmomi.vmodl.query.PropertyCollector.RetrieveOptions()
+        )
+        properties = {}
+        if result:
+            for prop in result.objects[0].propSet:
+                properties[prop.name] = prop.val
+        return properties
+
+    def is_alive(self):
+        """Check that the session bound to this interface is still authenticated.
+        :return: True if the vCenter answers on the current session else False.
+        """
+        if not self.si:
+            return False
+        try:
+            return self.content.sessionManager.currentSession is not None
+        except vim.fault.NotAuthenticated:
+            return False
+        except Exception:
+            return False
+
     def disconnect(self):
-        connect.Disconnect(self.si)
+        if self.si:
+            # the task helpers must not use the collectors of a logged out session.
+            collectors.forget(self.si._stub)
+            try:
+                connect.Disconnect(self.si)
+            finally:
+                self.si = None
+                self.content = None
 
     def get_all_vms(self):
         """Return a view of all vm in the vCenter.
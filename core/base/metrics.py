@@ -0,0 +1,91 @@
+__author__ = 'alessio.rocchi'
+
+from threading import Lock
+
+
+class Counter(object):
+    """Thread safe monotonic counter."""
+    def __init__(self):
+        self._lock = Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Timer(object):
+    """Thread safe accumulator of durations expressed in seconds."""
+    def __init__(self):
+        self._lock = Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def snapshot(self):
+        with self._lock:
+            avg = self.total / self.count if self.count else 0.0
+            return {'count': self.count, 'avg': round(avg, 4), 'max': round(self.max, 4)}
+
+
+class Gauge(object):
+    """Value sampled through a callable every time a snapshot is taken."""
+    def __init__(self, func):
+        self.func = func
+
+    def snapshot(self):
+        try:
+            return self.func()
+        except Exception:
+            return None
+
+
+class MetricsRegistry(object):
+    """Process wide registry of named metrics.
+    Metrics are created on first access and shared by every caller using the same name.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, name, factory):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = factory()
+                self._metrics[name] = metric
+            return metric
+
+    def counter(self, name):
+        return self._get_or_create(name, Counter)
+
+    def timer(self, name):
+        return self._get_or_create(name, Timer)
+
+    def gauge(self, name, func):
+        with self._lock:
+            self._metrics[name] = Gauge(func)
+            return self._metrics[name]
+
+    def snapshot(self):
+        """Return a dictionary name -> current value of every registered metric."""
+        with self._lock:
+            metrics = dict(self._metrics)
+        return dict((name, metric.snapshot()) for name, metric in sorted(metrics.items()))
+
+
+registry = MetricsRegistry()
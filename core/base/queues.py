@@ -0,0 +1,65 @@
+__author__ = 'alessio.rocchi'
+
+from core.base.metrics import registry
+import logging
+import Queue
+
+
+class BoundedQueue(Queue.Queue):
+    """Queue between two pipeline stages, with a maximum size and a policy applied when it is full:
+        - block: producers wait for room, stalling the stage upstream.
+        - drop_oldest: the oldest item is handed to on_drop to make room for the new one.
+        - unbounded: producers never wait and nothing is dropped: the queue is bounded by the watermarks only, the
+        backlog being left in the durable AMQP queue while Watcher2 does not consume.
+    With every policy the queue reports saturated() above the high watermark, so Watcher2 stops consuming until
+    every queue is relieved() below the low watermark. A maxsize of 0 means unbounded.
+    """
+    POLICIES = ('block', 'drop_oldest', 'unbounded')
+
+    def __init__(self, name, maxsize=0, policy='block', on_drop=None, high_watermark=0.8, low_watermark=0.5):
+        """
+        :param name: name of the stage fed by the queue, used for the metrics.
+        :param on_drop: callable(item) receiving the items dropped by the drop_oldest policy.
+        :param high_watermark: fraction of maxsize above which the queue is saturated.
+        :param low_watermark: fraction of maxsize below which the queue is relieved.
+        """
+        Queue.Queue.__init__(self)
+        self.name = name
+        self.logger = logging.getLogger('shepherd.base.BoundedQueue')
+        self.dropped = registry.counter('queue.{}.dropped'.format(name))
+        registry.gauge('queue.{}.depth'.format(name), self.qsize)
+        self.configure(maxsize, policy, on_drop, high_watermark, low_watermark)
+
+    def configure(self, maxsize=0, policy='block', on_drop=None, high_watermark=0.8, low_watermark=0.5):
+        """Change size and policy of the queue, e.g. of a module level queue once the configuration is read."""
+        if policy not in self.POLICIES:
+            raise ValueError('Unknown queue policy: {}. Expected one of: {}.'.format(policy, ', '.join(self.POLICIES)))
+        with self.mutex:
+            self.limit = maxsize
+            self.policy = policy
+            self.on_drop = on_drop
+            # Queue.put blocks only when maxsize is set.
+            self.maxsize = maxsize if policy == 'block' else 0
+            self.high_watermark = max(1, int(maxsize * high_watermark))
+            self.low_watermark = int(maxsize * low_watermark)
+
+    def put(self, item, block=True, timeout=None):
+        dropped = None
+        if self.policy == 'drop_oldest' and self.limit:
+            with self.mutex:
+                if self._qsize() >= self.limit:
+                    dropped = self._get()
+                    # the dropped item will never be marked done by the consumer.
+                    self.unfinished_tasks -= 1
+        if dropped is not None:
+            self.dropped.inc()
+            self.logger.warning('Queue {} full: dropped {}.'.format(self.name, dropped))
+            if self.on_drop is not None:
+                self.on_drop(dropped)
+        Queue.Queue.put(self, item, block, timeout)
+
+    def saturated(self):
+        return bool(self.limit) and self.qsize() >= self.high_watermark
+
+    def relieved(self):
+        return not self.limit or self.qsize() <= self.low_watermark
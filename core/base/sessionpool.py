@@ -0,0 +1,212 @@
+__author__ = 'alessio.rocchi'
+
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
+from pyVmomi import vim
+from core.base import VcInterface
+from core.base.metrics import registry
+import logging
+import Queue
+import time
+
+
+class PoolExhausted(Exception):
+    """Raised when no vCenter session could be leased within the requested timeout."""
+    pass
+
+
+class VcSessionPool(object):
+    """Bounded pool of authenticated vCenter sessions shared by every pipeline stage.
+    Sessions are created lazily up to `size`, health checked before being leased when they have been idle
+    for more than `health_check_interval` seconds and kept alive by a background thread every `keepalive`
+    seconds. A session raising vim.fault.NotAuthenticated while leased is logged in again on the next lease.
+    """
+    def __init__(self, host, username, password, size=4, keepalive=300, health_check_interval=60):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.size = size
+        self.keepalive = keepalive
+        self.health_check_interval = health_check_interval
+        self.logger = logging.getLogger('shepherd.base.VcSessionPool')
+        self._idle = Queue.LifoQueue()
+        self._lock = Lock()
+        self._sessions = []
+        self._stopped = Event()
+        self._keepalive_thread = None
+        self.logins = registry.counter('vcenter.{}.logins'.format(host))
+        self.lease_wait = registry.timer('vcenter.{}.lease_wait'.format(host))
+        registry.gauge('vcenter.{}.sessions'.format(host), lambda: len(self._sessions))
+        registry.gauge('vcenter.{}.idle_sessions'.format(host), self._idle.qsize)
+
+    def start(self):
+        """Start the keep-alive thread."""
+        if self.keepalive and self._keepalive_thread is None:
+            self._keepalive_thread = Thread(target=self._keep_alive, name='VcKeepAlive')
+            self._keepalive_thread.daemon = True
+            self._keepalive_thread.start()
+
+    def close(self):
+        """Stop the keep-alive thread and log out every session owned by the pool."""
+        self._stopped.set()
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for vc in sessions:
+            try:
+                vc.disconnect()
+            except Exception as e:
+                self.logger.debug('Error while disconnecting session: {}'.format(e))
+
+    def _login(self, vc):
+        if not vc.connect():
+            raise vim.fault.NotAuthenticated()
+        self.logins.inc()
+        vc.last_checked = time.time()
+        self.logger.debug('Logged in to vCenter: {} (logins so far: {}).'.format(self.host, self.logins.value))
+
+    def _create(self):
+        vc = VcInterface(host=self.host, username=self.username, password=self.password)
+        vc.stale = False
+        self._login(vc)
+        return vc
+
+    def _ensure_alive(self, vc):
+        if vc.stale or time.time() - vc.last_checked > self.health_check_interval:
+            if vc.stale or not vc.is_alive():
+                self.logger.info('vCenter session to {} is not authenticated anymore. Logging in again.'.format(
+                    self.host
+                ))
+                try:
+                    vc.disconnect()
+                except Exception:
+                    pass
+                self._login(vc)
+                vc.stale = False
+            vc.last_checked = time.time()
+
+    def dedicated(self):
+        """Log in a session outside of the pool, for a thread holding one for its whole life (the Inventory, the
+        TaskTracker): leased from the pool it would be taken from the stages for good. Give it back with
+        release(vc, discard=True).
+        :return: VcInterface connected to the vCenter.
+        """
+        return self._create()
+
+    def acquire(self, timeout=None):
+        """Lease a session from the pool. Blocks until one is available if the pool is at full size.
+        :param timeout: seconds to wait for a free session. None waits forever.
+        :return: VcInterface connected to the vCenter.
+        """
+        start = time.time()
+        deadline = None if timeout is None else start + timeout
+        vc = None
+        while vc is None:
+            try:
+                vc = self._idle.get_nowait()
+                break
+            except Queue.Empty:
+                pass
+            with self._lock:
+                create = len(self._sessions) < self.size
+                if create:
+                    # reserve the slot before the (slow) login happens outside of the lock.
+                    self._sessions.append(None)
+            if create:
+                try:
+                    vc = self._create()
+                finally:
+                    with self._lock:
+                        self._sessions.remove(None)
+                        if vc is not None:
+                            self._sessions.append(vc)
+            else:
+                # wake up every second: a discarded session frees a slot without going through the idle queue.
+                wait = 1.0 if deadline is None else min(1.0, deadline - time.time())
+                if wait <= 0:
+                    raise PoolExhausted('No vCenter session available for {} in {}s.'.format(self.host, timeout))
+                try:
+                    vc = self._idle.get(timeout=wait)
+                except Queue.Empty:
+                    continue
+        self.lease_wait.observe(time.time() - start)
+        try:
+            self._ensure_alive(vc)
+        except Exception:
+            self.release(vc, discard=True)
+            raise
+        return vc
+
+    def release(self, vc, discard=False):
+        """Give back a leased session.
+        :param discard: if True the session is logged out and removed from the pool. Dedicated sessions are always
+        discarded.
+        """
+        if discard:
+            with self._lock:
+                if vc in self._sessions:
+                    self._sessions.remove(vc)
+            try:
+                vc.disconnect()
+            except Exception:
+                pass
+            return
+        if self._stopped.is_set():
+            vc.disconnect()
+            return
+        self._idle.put(vc)
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """Context manager leasing a session for the duration of the block.
+        code::
+            with pool.lease() as vc:
+                cm = ClusterManager(si=vc.si, content=vc.content)
+        """
+        vc = self.acquire(timeout=timeout)
+        try:
+            yield vc
+        except vim.fault.NotAuthenticated:
+            vc.stale = True
+            raise
+        finally:
+            self.release(vc)
+
+    def call(self, func, *args, **kwargs):
+        """Run func(vc, *args, **kwargs) on a leased session, retrying once with a fresh login
+        if the session turns out to be not authenticated anymore.
+        """
+        try:
+            with self.lease() as vc:
+                return func(vc, *args, **kwargs)
+        except vim.fault.NotAuthenticated:
+            self.logger.warning('Session expired while in use. Retrying on a fresh login.')
+            with self.lease() as vc:
+                return func(vc, *args, **kwargs)
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'idle': self._idle.qsize(),
+            'logins': self.logins.value,
+            'lease_wait': self.lease_wait.snapshot()
+        }
+
+    def _keep_alive(self):
+        while not self._stopped.wait(self.keepalive):
+            # only the sessions currently idle are pinged, leased ones are obviously alive.
+            idle = []
+            while True:
+                try:
+                    idle.append(self._idle.get_nowait())
+                except Queue.Empty:
+                    break
+            for vc in idle:
+                try:
+                    # force the health check: it is the keep-alive round trip itself.
+                    vc.last_checked = 0
+                    self._ensure_alive(vc)
+                except Exception as e:
+                    self.logger.error('Keep-alive failed for vCenter: {}. {}'.format(self.host, e))
+                    self.release(vc, discard=True)
+                    continue
+                self.release(vc)
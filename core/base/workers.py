@@ -0,0 +1,59 @@
+__author__ = 'alessio.rocchi'
+
+from threading import Thread, Lock
+import logging
+import Queue
+
+
+class WorkerPool(object):
+    """Fixed size pool of daemon threads consuming submitted callables."""
+    def __init__(self, size, name='Worker'):
+        self.size = size
+        self.name = name
+        self.logger = logging.getLogger('shepherd.base.WorkerPool')
+        self._tasks = Queue.Queue()
+        self._threads = []
+
+    def _start(self):
+        for index in range(self.size):
+            thread = Thread(target=self._work, name='{}-{}'.format(self.name, index))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self._tasks.get()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                self.logger.error('{} task failed: {}'.format(self.name, e), exc_info=True)
+            finally:
+                self._tasks.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        if not self._threads:
+            self._start()
+        self._tasks.put((func, args, kwargs))
+
+    def join(self):
+        """Block until every submitted task is done."""
+        self._tasks.join()
+
+
+class KeyedLocks(object):
+    """One lock per key, created on first use."""
+    def __init__(self):
+        self._lock = Lock()
+        self._locks = {}
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = Lock()
+            return self._locks[key]
+
+
+# Serialize the reconfigurations of a cluster across Executor and Guard. Always lease the vCenter session
+# before taking a cluster lock.
+cluster_locks = KeyedLocks()
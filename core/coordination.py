@@ -0,0 +1,306 @@
+__author__ = 'alessio.rocchi'
+
+from threading import Thread, Lock, Event, local
+from core.base.metrics import registry
+from core.base.workers import cluster_locks
+import bisect
+import hashlib
+import json
+import logging
+import pika
+import sqlite3
+import time
+
+
+class LeaseTimeout(Exception):
+    """The lease of a key could not be taken within the timeout: another node is working on it."""
+    pass
+
+
+class HashRing(object):
+    """Consistent hashing of keys on nodes: when a node joins or leaves only the keys it owned move."""
+    def __init__(self, nodes, replicas=64):
+        """
+        :param replicas: points of every node on the ring, the more the evener the spread.
+        """
+        self.nodes = sorted(nodes)
+        self._ring = sorted((self._hash('{}#{}'.format(node, index)), node)
+                            for node in self.nodes for index in range(replicas))
+        self._points = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+    def owner(self, key):
+        """Return the node owning key, None if the ring is empty."""
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class SqliteLeaseBackend(object):
+    """Membership and leases in a SQLite database, for the nodes running on the same host (or sharing a file
+    system with working locks). Every row expires: a node that dies loses its membership and leases after ttl.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = local()
+
+    def _connection(self):
+        # sqlite connections cannot be shared between threads: every thread opens its own.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # autocommit: transactions are opened explicitly with BEGIN IMMEDIATE.
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS members (node TEXT PRIMARY KEY, expires REAL NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, node TEXT NOT NULL, '
+                               'expires REAL NOT NULL)')
+            self._local.connection = connection
+        return connection
+
+    def heartbeat(self, node, ttl):
+        self._connection().execute('INSERT OR REPLACE INTO members (node, expires) VALUES (?, ?)',
+                                   (node, time.time() + ttl))
+
+    def members(self):
+        return [row[0] for row in self._connection().execute('SELECT node FROM members WHERE expires > ?',
+                                                             (time.time(),))]
+
+    def acquire(self, key, node, ttl):
+        """Take or renew the lease of key. :return: True if node holds the lease."""
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT node, expires FROM leases WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[0] != node and row[1] > now:
+                connection.execute('ROLLBACK')
+                return False
+            connection.execute('INSERT OR REPLACE INTO leases (key, node, expires) VALUES (?, ?, ?)',
+                               (key, node, now + ttl))
+            connection.execute('COMMIT')
+            return True
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def release(self, key, node):
+        self._connection().execute('DELETE FROM leases WHERE key = ? AND node = ?', (key, node))
+
+
+class RabbitMQLeaseBackend(object):
+    """Membership and leases on the RabbitMQ broker the nodes already share.
+    A lease is an exclusive queue named after the key: the broker lets a single connection declare it and deletes
+    it when the connection dies, so leases need no expiry and ttl is ignored. Nodes announce themselves on a fanout
+    exchange every heartbeat and are members as long as their announcements keep coming.
+    A BlockingConnection is not thread safe: every call goes through the same lock.
+    """
+    def __init__(self, host, username, password, exchange='shepherd.coordination', prefix='shepherd.lease.'):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.exchange = exchange
+        self.prefix = prefix
+        self.logger = logging.getLogger('shepherd.coordination.RabbitMQLeaseBackend')
+        self._lock = Lock()
+        self._connection = None
+        self._channel = None
+        self._lease_channel = None
+        # node -> time its membership expires
+        self._seen = {}
+        self._leases = set()
+
+    def _connect(self):
+        parameters = pika.ConnectionParameters(
+            host=self.host,
+            credentials=pika.PlainCredentials(username=self.username, password=self.password)
+        )
+        self._connection = pika.BlockingConnection(parameters)
+        self._channel = self._connection.channel()
+        self._channel.exchange_declare(exchange=self.exchange, exchange_type='fanout')
+        queue = self._channel.queue_declare(exclusive=True).method.queue
+        self._channel.queue_bind(exchange=self.exchange, queue=queue)
+        self._channel.basic_consume(self._on_heartbeat, queue=queue, no_ack=True)
+        self._lease_channel = self._connection.channel()
+        # leases died with the previous connection.
+        self._leases = set()
+
+    def _call(self, func, *args):
+        """Run func on a live connection, connecting again once if the connection is lost."""
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._connection is None or self._connection.is_closed:
+                        self._connect()
+                    return func(*args)
+                except pika.exceptions.AMQPConnectionError as e:
+                    self.logger.warning('Coordination connection lost: {}.'.format(e))
+                    self._connection = None
+                    if attempt == 2:
+                        raise
+
+    def _on_heartbeat(self, channel, method, properties, body):
+        message = json.loads(body)
+        self._seen[message['node']] = time.time() + message['ttl']
+
+    def heartbeat(self, node, ttl):
+        def publish():
+            self._channel.basic_publish(exchange=self.exchange, routing_key='',
+                                        body=json.dumps({'node': node, 'ttl': ttl}))
+            self._connection.process_data_events(time_limit=0)
+        self._call(publish)
+
+    def members(self):
+        def collect():
+            self._connection.process_data_events(time_limit=0)
+            now = time.time()
+            return [node for node, expires in self._seen.items() if expires > now]
+        return self._call(collect)
+
+    def acquire(self, key, node, ttl):
+        def declare():
+            if key in self._leases:
+                return True
+            try:
+                self._lease_channel.queue_declare(queue=self.prefix + key, exclusive=True)
+            except pika.exceptions.ChannelClosed:
+                # RESOURCE_LOCKED: another connection holds the queue. The channel is closed by the broker.
+                self._lease_channel = self._connection.channel()
+                return False
+            self._leases.add(key)
+            return True
+        return self._call(declare)
+
+    def release(self, key, node):
+        def delete():
+            if key in self._leases:
+                self._leases.discard(key)
+                self._lease_channel.queue_delete(queue=self.prefix + key)
+        self._call(delete)
+
+
+class LeasedLock(object):
+    """Cluster lock held across the nodes: the local lock of the cluster, then its lease in the backend.
+    Same acquire/release interface as the threading.Lock of core.base.workers.cluster_locks.
+    """
+    def __init__(self, coordinator, key, local_lock):
+        self.coordinator = coordinator
+        self.key = key
+        self.local_lock = local_lock
+
+    def acquire(self):
+        """Wait for the local lock and then for the lease, at most lease_timeout seconds.
+        :raises LeaseTimeout: if another node keeps the lease.
+        """
+        self.local_lock.acquire()
+        try:
+            self.coordinator.acquire(self.key)
+        except Exception:
+            self.local_lock.release()
+            raise
+
+    def release(self):
+        try:
+            self.coordinator.release(self.key)
+        finally:
+            self.local_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class Coordinator(Thread):
+    """Agree with the other shepherd nodes on the owner of every cluster.
+    Every node heartbeats its membership in the lease backend and hashes the clusters on the ring of the live
+    members: a Guard reconciles only the clusters its node owns. DRS edits, from the Guard or from the Executor
+    of whichever node received the notification, are made under the lease of the cluster, so two nodes never
+    reconfigure the same cluster at once even while they disagree on the membership.
+    """
+    def __init__(self, backend, node, ttl=30, interval=10, lease_timeout=60, replicas=64):
+        """
+        :param backend: SqliteLeaseBackend or RabbitMQLeaseBackend.
+        :param node: unique name of this node.
+        :param ttl: seconds membership and leases live without renewal.
+        :param interval: seconds between two heartbeats, well below ttl.
+        :param lease_timeout: seconds to wait for the lease of a cluster held by another node.
+        """
+        super(Coordinator, self).__init__()
+        self.name = 'Coordinator'
+        self.daemon = True
+        self.backend = backend
+        self.node = node
+        self.ttl = ttl
+        self.interval = interval
+        self.lease_timeout = lease_timeout
+        self.replicas = replicas
+        self.stop = False
+        self.ready = Event()
+        self.logger = logging.getLogger('shepherd.coordination.Coordinator')
+        self.ring = HashRing([])
+        self._held = set()
+        self._held_lock = Lock()
+        self.lease_waits = registry.timer('coordination.lease_wait')
+        self.lost_leases = registry.counter('coordination.lost_leases')
+        registry.gauge('coordination.members', lambda: len(self.ring.nodes))
+
+    @staticmethod
+    def cluster_key(host, cluster_id):
+        return '{}/{}'.format(host, cluster_id)
+
+    def owns(self, key):
+        """Tell if this node owns key. Nothing is owned until the membership is known."""
+        return self.ready.is_set() and self.ring.owner(key) == self.node
+
+    def lock(self, host, cluster_id):
+        """Return the LeasedLock of a cluster."""
+        return LeasedLock(self, self.cluster_key(host, cluster_id), cluster_locks.get((host, cluster_id)))
+
+    def acquire(self, key):
+        start = time.time()
+        deadline = start + self.lease_timeout
+        while not self.backend.acquire(key, self.node, self.ttl):
+            if time.time() >= deadline:
+                raise LeaseTimeout('Lease of {} held by another node for more than {}s.'.format(
+                    key, self.lease_timeout))
+            time.sleep(0.5)
+        self.lease_waits.observe(time.time() - start)
+        with self._held_lock:
+            self._held.add(key)
+
+    def release(self, key):
+        with self._held_lock:
+            self._held.discard(key)
+        self.backend.release(key, self.node)
+
+    def synchronize(self):
+        """Renew membership and held leases, then rebuild the ring from the live members."""
+        self.backend.heartbeat(self.node, self.ttl)
+        with self._held_lock:
+            held = list(self._held)
+        for key in held:
+            # a task outliving ttl keeps its cluster leased.
+            if not self.backend.acquire(key, self.node, self.ttl):
+                self.lost_leases.inc()
+                self.logger.error('Lease of {} lost: another node may reconfigure it.'.format(key))
+        members = sorted(self.backend.members())
+        if members != self.ring.nodes:
+            self.logger.info('Members: {}. This node: {}.'.format(', '.join(members), self.node))
+            self.ring = HashRing(members, self.replicas)
+        self.ready.set()
+
+    def run(self):
+        while not self.stop:
+            try:
+                self.synchronize()
+            except Exception as e:
+                # without a membership this node owns nothing: it must not act on stale ownership.
+                self.ready.clear()
+                self.logger.error('Coordination failed: {}. Owning no cluster until it recovers.'.format(e))
+            time.sleep(self.interval)
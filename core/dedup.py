@@ -0,0 +1,82 @@
+__author__ = 'alessio.rocchi'
+
+from collections import OrderedDict
+from threading import Lock
+from core.base.metrics import registry
+import logging
+import time
+
+
+class Deduplicator(object):
+    """Drop the repeated notifications of a key.
+    A key is claimed by the first work item carrying it and settled with the outcome of that item. Items carrying
+    a key in flight wait for it and get its outcome, so their deliveries are not acknowledged before the work is
+    done: when the first item fails, they are retried as well. A key settled successfully is remembered ttl
+    seconds, at most maxsize keys, the least recently settled ones being evicted first: its items are done right
+    away.
+    """
+    def __init__(self, name, ttl=300, maxsize=10000):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.logger = logging.getLogger('shepherd.dedup.Deduplicator')
+        self._lock = Lock()
+        # key -> expiry timestamp, ordered from the oldest to the most recently settled.
+        self._keys = OrderedDict()
+        # key in flight -> work items waiting for its outcome
+        self._pending = {}
+        self.hits = registry.counter('dedup.{}.hits'.format(name))
+        self.misses = registry.counter('dedup.{}.misses'.format(name))
+        registry.gauge('dedup.{}.size'.format(name), lambda: len(self._keys))
+        registry.gauge('dedup.{}.in_flight'.format(name), lambda: len(self._pending))
+
+    def _expire(self, now):
+        while self._keys:
+            key, expiry = next(self._keys.iteritems())
+            if expiry > now:
+                break
+            del self._keys[key]
+
+    def acquire(self, key, item):
+        """Claim key for item, unless it is a duplicate.
+        A duplicate of a key settled within ttl is done here; a duplicate of a key in flight is completed by
+        settle, with the outcome of the item that claimed the key.
+        :return: True if item claimed key and must be processed, settle(key, success) being called once it is
+        complete. False if item is a duplicate.
+        """
+        with self._lock:
+            self._expire(time.time())
+            applied = key in self._keys
+            waiting = self._pending.get(key)
+            if not applied and waiting is None:
+                self._pending[key] = []
+            elif waiting is not None:
+                waiting.append(item)
+        if applied:
+            self.hits.inc()
+            self.logger.debug('{}: duplicate {} dropped.'.format(self.name, key))
+            item.done()
+            return False
+        if waiting is not None:
+            self.hits.inc()
+            self.logger.debug('{}: duplicate {} waiting for the one in flight.'.format(self.name, key))
+            return False
+        self.misses.inc()
+        return True
+
+    def settle(self, key, success):
+        """Record the outcome of the item that claimed key and complete the duplicates waiting for it.
+        Only a successful key is remembered: after a failure the key is processed again the next time.
+        """
+        with self._lock:
+            waiting = self._pending.pop(key, [])
+            if success:
+                self._keys.pop(key, None)
+                self._keys[key] = time.time() + self.ttl
+                while len(self._keys) > self.maxsize:
+                    self._keys.popitem(last=False)
+        for item in waiting:
+            if success:
+                item.done()
+            else:
+                item.failed()
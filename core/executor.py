@@ -1,12 +1,15 @@
 __author__ = 'alessio.rocchi'
 
 import Queue
-from threading import Thread
+from threading import Thread, Lock
 import logging
-from pyVim import connect
-from pyVmomi import vim
+import time
+from pyVmomi import vim, vmodl
 from vspherelib.clustermanager import ClusterManager
-from vspherelib.helper.Types import HostGroupNotExists, VmGroupNotExists
+from core.base.workers import cluster_locks
+from core.rules import default_rules
+from core.tasktracker import TaskTimeout
+from core.coordination import LeaseTimeout
 
 import requests
 
@@ -16,14 +19,27 @@ rootLogger = logging.getLogger('shepherd.executor')
 
 
 class Executor(Thread):
-    def __init__(self, host, username, password, executor_queue, host_group_name='WindowsVM', vm_group_name='Windows',
-                 windows_affinity_rule_name="WindowsAffinityRule", create_affinity_rule=True):
+    def __init__(self, pool, executor_queue, host_group_name='WindowsVM', vm_group_name='Windows',
+                 windows_affinity_rule_name="WindowsAffinityRule", create_affinity_rule=True, batch_window=2,
+                 batch_size=100, inventory=None, rules=None, tracker=None, task_timeout=600,
+                 coordinator=None):
+        """
+        :param rules: core.rules.RuleSet giving the DRS groups of every VM class. By default a single Windows rule
+        with the given group names.
+        :param tracker: core.tasktracker.TaskTracker following the reconfiguration tasks. Without it every
+        reconfiguration is waited for before the next cluster is processed.
+        :param task_timeout: seconds a batch waits for its reconfigurations, None waits forever.
+        :param coordinator: core.coordination.Coordinator. When given clusters are reconfigured under their lease,
+        whichever node owns them.
+        """
         super(Executor, self).__init__()
-        self.host = host
-        self.username = username
-        self.password = password
-        self.si = None
-        self.content = None
+        self.rules = rules if rules is not None else default_rules(host_group_name, vm_group_name,
+                                                                   windows_affinity_rule_name)
+        self.pool = pool
+        self.inventory = inventory
+        self.tracker = tracker
+        self.task_timeout = task_timeout
+        self.coordinator = coordinator
         self.logger = logging.getLogger('shepherd.executor.Executor')
         self.executor_queue = executor_queue
         self.stop = False
@@ -32,95 +48,191 @@ class Executor(Thread):
         self.vm_group_name = vm_group_name
         self.windows_affinity_rule_name = windows_affinity_rule_name
         self.create_affinity_rule = create_affinity_rule
+        self.batch_window = batch_window
+        self.batch_size = batch_size
         self.logger.info("Executor Initialized. Waiting for events...")
         if create_affinity_rule == '0':
             self.logger.info('Executor has disabled VM Affinity Rule Check!')
 
-    def connect(self):
-        self.si = connect.SmartConnect(host=self.host,
-                                       user=self.username,
-                                       pwd=self.password)
-        self.content = self.si.RetrieveContent()
-        self.logger.debug('Connected to vCenter: {}'.format(self.host))
+    def drain(self):
+        """Wait for a VM, then keep collecting VMs for batch_window seconds or until batch_size is reached.
+        :return: list of the work items received, each carrying a VmRecord.
+        """
+        try:
+            batch = [self.executor_queue.get(timeout=10)]
+        except Queue.Empty:
+            return []
+        deadline = time.time() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.executor_queue.get(timeout=remaining))
+            except Queue.Empty:
+                break
+        return batch
 
     def run(self):
         while not self.stop:
-            try:
-                vm = self.executor_queue.get(timeout=10)
-            except Queue.Empty:
+            batch = self.drain()
+            if not batch:
                 continue
-            self.logger.info("Received VM from Reactioneer: {}".format(vm.name))
-            self.logger.debug('Instancing Cluster Manager.')
-            self.connect()
-            cm = ClusterManager(self.si, self.content)
-            cluster = vm.resourcePool.owner
-
-            self.logger.debug('Identified cluster: {}'.format(cluster.name))
-
+            self.logger.info("Received {} VMs from Reactioneer.".format(len(batch)))
             try:
-                # check if the HostGroup exists.
-                self.logger.debug("Checking if HostGroup: {} exists.".format(self.host_group_name))
-                host_group = cm.get_host_group_by_name(name=self.host_group_name, cluster=cluster)
-                if len(host_group) <= 0:
-                    # the HostGroup doesnt exists, create it.
-                    self.logger.debug("Creating HostGroup: {}.".format(self.host_group_name))
-                    cm.create_host_group(cluster)
-                else:
-                    if not isinstance(host_group[0], vim.cluster.HostGroup):
-                        cm.create_host_group(cluster)
-
-                # check if the HostGroup has not enough resources to contain the new VM, in that case add another
-                # host to the group.
-                try:
-                    self.logger.debug('Checking if there is enough power with the current number of hosts...')
-                    if not cm.check_avail_res(vm, cluster):
-                        # the HostGroup doesn't have enough resources. Add another host to it.
-                        self.logger.debug("Adding a new Host to the HostGroup: {}.".format(self.host_group_name))
-                        cm.add_host_to_host_group(cluster)
-                except HostGroupNotExists:
-                    raise
-
-                # check if the VmGroup exists.
-                self.logger.debug("Checking if VmGroup: {} exists".format(self.vm_group_name))
-                vm_group = cm.get_vm_group_by_name(self.vm_group_name, cluster)
-                if len(vm_group) <= 0:
-                    # the VmGroup doesn't exists, create it.
-                    self.logger.debug("VmGroup: {} doesn't exists. Creating it.".format(self.vm_group_name))
-                    cm.create_vm_group(cluster)
-                else:
-                    if not isinstance(vm_group[0], vim.cluster.VmGroup):
-                        self.logger.debug("VmGroup: {} doesn't exists. Creating it.".format(self.vm_group_name))
-                        cm.create_vm_group(cluster)
-
-                # finally add the VM to the VmGroup
-                self.logger.debug("Adding VM: {} to VmGroup: {}.".format(vm.name, self.vm_group_name))
-                if not cm.add_vm_to_vm_group(vm, cluster):
-                    self.logger.critical("Failed to add VM: {} to VmGroup: {}".format(vm.name, self.vm_group_name))
-                    # TODO: raise a Nagios alarm.
-
-                if self.create_affinity_rule == '1':
-                    # check if the affinity rule exists or not
-                    if not cm.get_affinity_rule_by_name(self.windows_affinity_rule_name, cluster):
-                        self.logger.info("The affinity rule: {} doesn't exists.".format(
-                            self.windows_affinity_rule_name
-                        ))
-                        self.logger.info("Creating affinity rule: {}.".format(self.windows_affinity_rule_name))
-                        cm.add_affinity_rule(cluster)
-                else:
-                    self.logger.info("Affinity rule not checked according to config.")
-
-            except HostGroupNotExists:
-                # TODO: raise a Nagios alarm
-                self.logger.critical("Failed to handle HostGroup: {}. Aborting.".format(self.host_group_name))
-                self.executor_queue.task_done()
-            except VmGroupNotExists:
-                # TODO: raise a Nagios alarm
-                self.logger.critical("Failed to handle VmGroup: {}. Aborting".format(self.vm_group_name))
+                self.pool.call(self.process, batch)
+            except Exception as e:
+                self.logger.error('Failed to process batch of {} VMs. {}'.format(len(batch), e), exc_info=True)
+                # items of the clusters already reconfigured are done: their outcome is not changed.
+                self.fail(batch)
+            for _ in batch:
                 self.executor_queue.task_done()
 
-            self.executor_queue.task_done()
-            self.logger.info('VM: {} finally processed correctly.\n\n'.format(vm.name))
-
-
-def __exit__(self):
-    connect.Disconnect(self.si)
+    def fail(self, items):
+        """Report the items as failed: their notifications are delivered again."""
+        for item in items:
+            item.failed()
+
+    def get_cluster(self, vc, record):
+        """Return the cluster of the VM bound to the leased session, from the inventory cache when possible.
+        :param record: VmRecord of the VM.
+        """
+        if self.inventory is not None and self.inventory.ready.is_set():
+            cluster = self.inventory.cluster_of(record.mo_id)
+            if cluster is not None:
+                return vim.ClusterComputeResource(cluster['obj']._moId, vc.si._stub)
+        if record.resource_pool is not None:
+            return vim.ResourcePool(record.resource_pool, vc.si._stub).owner
+        return vim.VirtualMachine(record.mo_id, vc.si._stub).resourcePool.owner
+
+    def cluster_lock(self, cluster):
+        """Return the lock serializing the reconfigurations of a cluster, across the nodes in coordination mode."""
+        if self.coordinator is not None:
+            return self.coordinator.lock(self.pool.host, cluster._moId)
+        # managed object ids are unique per vCenter only.
+        return cluster_locks.get((self.pool.host, cluster._moId))
+
+    def settle(self, cluster_name, vms, items, error=None):
+        """Complete the items of a cluster once its reconfiguration is over or timed out.
+        :param cluster_name: name of the cluster, for logging: read beforehand since settle may run on the
+        TaskTracker thread, without a session.
+        :param error: fault of the reconfiguration task or TaskTimeout, None if it succeeded or had nothing to do.
+        """
+        if error is not None:
+            self.logger.error('Reconfiguration of cluster: {} failed. {}'.format(cluster_name, error))
+            self.fail(items)
+            return
+        for item in items:
+            item.done()
+        self.logger.info('VMs: {} finally processed correctly.'.format(', '.join(vm._moId for vm in vms)))
+
+    def process(self, vc, items):
+        """Put the VMs in the DRS groups of their rules, with one reconfiguration per cluster covering every rule.
+        The reconfigurations of the batch are submitted one cluster after the other and run concurrently: each
+        cluster stays locked until the TaskTracker reports its task complete, even past task_timeout: its items are
+        failed then, but no other reconfiguration of the cluster may start while the task runs.
+        :param vc: VcInterface leased from the session pool.
+        :param items: list of work items carrying the VmRecord dispatched by the Reactioneer. Items are
+        done once the reconfiguration of their cluster is committed.
+        """
+        self.logger.debug('Instancing Cluster Manager.')
+        cm = ClusterManager(vc.si, vc.content, vc=vc, inventory=self.inventory, tracker=self.tracker,
+                            task_timeout=self.task_timeout)
+        clusters = {}
+        for item in items:
+            if item.completed:
+                # done during a previous attempt of the batch.
+                continue
+            # bind the VM to the leased session.
+            vm = vim.VirtualMachine(item.payload.mo_id, vc.si._stub)
+            try:
+                cluster = self.get_cluster(vc, item.payload)
+            except vim.fault.NotAuthenticated:
+                raise
+            except vmodl.fault.ManagedObjectNotFound as e:
+                # the failure of one VM must not fail the rest of the batch.
+                if getattr(e.obj, '_moId', None) == item.payload.mo_id:
+                    self.logger.warning('VM: {} deleted meanwhile. Skipping it.'.format(item.payload.mo_id))
+                    item.done()
+                else:
+                    self.logger.error('Cannot find the cluster of VM: {}. {}'.format(item.payload.mo_id, e))
+                    self.fail([item])
+                continue
+            except Exception as e:
+                self.logger.error('Cannot find the cluster of VM: {}. {}'.format(item.payload.mo_id, e))
+                self.fail([item])
+                continue
+            entry = clusters.setdefault(cluster._moId, (cluster, [], []))
+            entry[1].append(vm)
+            entry[2].append(item)
+
+        pending = []
+        for cluster, cluster_vms, cluster_items in clusters.values():
+            cluster_name = cluster.name
+            self.logger.debug('Identified cluster: {} for {} VMs.'.format(cluster_name, len(cluster_vms)))
+            if self.create_affinity_rule != '1':
+                self.logger.info("Affinity rule not checked according to config.")
+            vms_by_pool = []
+            for rule in self.rules.rules:
+                rule_vms = [rule_vm for rule_vm, rule_item in zip(cluster_vms, cluster_items)
+                            if rule.name in rule_item.payload.rules]
+                if rule_vms:
+                    vms_by_pool.append((rule, rule_vms))
+            lock = self.cluster_lock(cluster)
+            try:
+                lock.acquire()
+            except LeaseTimeout as e:
+                self.logger.error('Cluster: {} is being reconfigured by another node. {}'.format(cluster_name, e))
+                self.fail(cluster_items)
+                continue
+            try:
+                future = cm.reconcile_pools(cluster, vms_by_pool, create_affinity_rule=self.create_affinity_rule == '1',
+                                            wait=False, num_cpus=dict((item.payload.mo_id, item.payload.num_cpu)
+                                                                      for item in cluster_items))
+            except vim.fault.NotAuthenticated:
+                lock.release()
+                raise
+            except Exception as e:
+                lock.release()
+                # clusters are independent: a failure on one of them must not block the others.
+                self.logger.error('Failed to reconfigure cluster: {}. {}'.format(cluster_name, e), exc_info=True)
+                self.fail(cluster_items)
+                continue
+            if future is None:
+                lock.release()
+                self.settle(cluster_name, cluster_vms, cluster_items)
+                continue
+            future.add_done_callback(lambda f, lock=lock: lock.release())
+            # settled once, by the TaskTracker when the task completes or below when it times out.
+            settle = Once(self.settle, cluster_name, cluster_vms, cluster_items)
+            future.add_done_callback(lambda f, settle=settle: settle(error=f.error))
+            pending.append((cluster_name, future, settle))
+
+        # the batch is over when every reconfiguration is: the queue upstream keeps the backpressure.
+        deadline = None if self.task_timeout is None else time.time() + self.task_timeout
+        for cluster_name, future, settle in pending:
+            try:
+                future.result(None if deadline is None else max(0, deadline - time.time()))
+            except TaskTimeout as e:
+                self.logger.warning('Cluster: {} stays locked until its reconfiguration is complete.'.format(
+                    cluster_name))
+                settle(error=e)
+            except Exception:
+                # reported by settle.
+                pass
+
+
+class Once(object):
+    """Callable calling func with the given arguments the first time only."""
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.lock = Lock()
+        self.called = False
+
+    def __call__(self, **kwargs):
+        with self.lock:
+            if self.called:
+                return
+            self.called = True
+        self.func(*self.args, **kwargs)
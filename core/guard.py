@@ -1,8 +1,10 @@
 __author__ = 'alessio.rocchi'
 
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 from vspherelib.clustermanager import ClusterManager
-from core.base import VcInterface
+from core.base.workers import WorkerPool, cluster_locks
+from core.base.metrics import registry
+from core.rules import default_rules
 from pyVmomi import vim
 import logging
 import time
@@ -25,12 +27,42 @@ rootLogger = logging.getLogger("shepherd.guard")
 
 
 # noinspection PyTypeChecker
-class Guard(Thread, VcInterface):
-    def __init__(self, host, username, password, event, host_group_name='WindowsVM', vm_group_name='Windows',
+class Guard(Thread):
+    def __init__(self, pool, event, host_group_name='WindowsVM', vm_group_name='Windows',
                  windows_affinity_rule_name="WindowsAffinityRule", pattern='windows', wait_time=3600,
-                 post_start=30):
+                 post_start=30, inventory=None, reconcile_interval=5, settle_time=60, workers=4, rules=None,
+                 tracker=None, task_timeout=600, coordinator=None):
+        """
+        :param rules: core.rules.RuleSet giving the DRS groups of every VM class. By default a single rule built
+        from the group names and pattern.
+        :param wait_time: seconds between two full sweeps of the inventory.
+        :param inventory: optional core.inventory.Inventory. When given Guard subscribes to its changes and
+        reconciles only the changed VMs and clusters every reconcile_interval seconds, once they have been
+        stable for settle_time seconds (so the Executor handles new VMs first). Full sweeps remain as safety net.
+        :param workers: number of clusters reconciled in parallel, each on its own leased session.
+        :param tracker: core.tasktracker.TaskTracker following the reconfiguration tasks. When given the session
+        goes back to the pool as soon as the task is submitted.
+        :param task_timeout: seconds to wait for a reconfiguration task, None waits forever.
+        :param coordinator: core.coordination.Coordinator. When given only the clusters owned by this node are
+        reconciled, under their lease.
+        """
         Thread.__init__(self)
-        VcInterface.__init__(self, host=host, username=username, password=password)
+        self.pool = pool
+        self.inventory = inventory
+        self.tracker = tracker
+        self.task_timeout = task_timeout
+        self.coordinator = coordinator
+        self.reconcile_interval = reconcile_interval
+        self.settle_time = settle_time
+        self.workers = WorkerPool(workers, name='Guard')
+        self._dirty_lock = Lock()
+        # managed object id -> time it was marked dirty
+        self._dirty_vms = {}
+        self._dirty_clusters = {}
+        self._sweep_requested = False
+        if self.inventory is not None:
+            self.inventory.subscribe(self.on_inventory_change)
+        self.host = pool.host
         self.stopped = event
         self.host_group_name = host_group_name
         self.vm_group_name = vm_group_name
@@ -38,79 +70,204 @@ class Guard(Thread, VcInterface):
         self.name = "Guard"
         self.logger = logging.getLogger('shepherd.guard.Guard')
         self.pattern = pattern
+        self.rules = rules if rules is not None else default_rules(host_group_name, vm_group_name,
+                                                                   windows_affinity_rule_name, pattern)
         self.wait_time = wait_time
         self.post_start = post_start
         self.logger.info("Guardian Initialized. Cycles will start in {} seconds.".format(post_start))
 
+    def on_inventory_change(self, obj, kind, names):
+        """Inventory listener: mark the VMs and clusters whose DRS group membership may have drifted."""
+        now = time.time()
+        with self._dirty_lock:
+            if kind == 'resync':
+                self._sweep_requested = True
+            elif kind == 'leave':
+                return
+            elif isinstance(obj, vim.VirtualMachine):
+                if kind == 'enter' or 'config.guestFullName' in names or 'config.guestId' in names or \
+                        'resourcePool' in names:
+                    self._dirty_vms.setdefault(obj._moId, now)
+            elif isinstance(obj, vim.ClusterComputeResource):
+                if 'configurationEx' in names:
+                    self._dirty_clusters.setdefault(obj._moId, now)
+
+    def _pop_settled(self, dirty):
+        limit = time.time() - self.settle_time
+        settled = set(mo_id for mo_id, marked in dirty.items() if marked <= limit)
+        for mo_id in settled:
+            del dirty[mo_id]
+        return settled
+
     # noinspection PyUnresolvedReferences
     def run(self):
         time.sleep(self.post_start)
-        vm_properties = ["name", "config.guestFullName"]
+        vm_properties = ["name", "config.guestFullName", "config.guestId"]
+        next_sweep = 0
         while True:
-            try:
-                self.logger.debug("Checking Windows VM coherency group.")
-                if self.connect():
-                    self.logger.debug("Connected to vCenter: {}.".format(self.host))
-                    cm = ClusterManager(si=self.si, content=self.content)
-                    all_vc_vms = self.get_all_vms()
-                    all_clusters = self.get_all_clusters()
-                    # now it becomes fun...
-                    vm_data = self.collect_properties(view_ref=all_vc_vms,
-                                                      obj_type=vim.VirtualMachine,
-                                                      path_set=vm_properties,
-                                                      include_mors=True)
-
-                    # map cluster data into a dictionary
-                    clusters = {}
-                    for cluster in all_clusters.view:
-                        clusters[cluster.name] = {}
-                        clusters[cluster.name]['obj'] = cluster
-                        windows_vm_group = filter(
-                            lambda x: isinstance(x, vim.cluster.VmGroup) and x.name == self.vm_group_name,
-                            cluster.configurationEx.group
-                        )
-                        vm_list = []
-                        if len(windows_vm_group) > 0 and isinstance(windows_vm_group[0], vim.cluster.VmGroup):
-                            # check if there are VM inside the vm group
-                            if len(windows_vm_group[0].vm) > 0:
-                                vm_list = map(lambda x: x.name, windows_vm_group[0].vm)
-                        clusters[cluster.name]['windows.vm.group'] = vm_list
-
-                    self.logger.debug("Start iterating VMs...")
-                    try:
-                        filtered_vm_list = filter(lambda x: self.pattern in x['config.guestFullName'].lower(), vm_data)
-                    except KeyError:
-                        # probably running during VM creation. continue the cycle with empty vm list.
-                        self.logger.error("KeyError: 'config.guestFullName', continue.")
-                        filtered_vm_list = []
-                    finally:
-                        for vm in filtered_vm_list:
-                            cluster_name = vm['obj'].resourcePool.owner.name
-                            if vm['name'] not in clusters[cluster_name]['windows.vm.group']:
-                                self.logger.info("VM: {} in cluster: {} is not in the VmGroup. Adding it.".format(
-                                    vm['name'], cluster_name
-                                ))
-                                # more defensive here... sorry bro.
-                                _vmgroup = cm.get_vm_group_by_name(name=self.vm_group_name,
-                                                                   cluster=clusters[cluster_name]['obj'])
-                                if len(_vmgroup) <= 0:
-                                    cm.create_vm_group(clusters[cluster_name]['obj'])
-                                _hostgroup = cm.get_host_group_by_name(name=self.host_group_name,
-                                                                       cluster=clusters[cluster_name]['obj'])
-                                if len(_hostgroup) <= 0:
-                                    cm.create_host_group(clusters[cluster_name]['obj'])
-
-                                if not cm.check_avail_res(vm['obj'], clusters[cluster_name]['obj']):
-                                    if not cm.add_host_to_host_group(cluster=clusters[cluster_name]['obj']):
-                                        self.logger.critical("Failed to expand HostGroup. Skipping VM add.")
-                                        continue
-                                cm.add_vm_to_vm_group(vm['obj'], clusters[cluster_name]['obj'])
+            with self._dirty_lock:
+                sweep = self._sweep_requested or time.time() >= next_sweep
+                self._sweep_requested = False
+                if sweep:
+                    # a full sweep covers every pending change.
+                    self._dirty_vms.clear()
+                    self._dirty_clusters.clear()
+                    dirty_vms, dirty_clusters = set(), set()
                 else:
-                    self.logger.critical("Cannot connect to vcenter: {}.".format(self.host))
-                self.logger.debug("Windows VM coherency check complete.")
-                self.disconnect()
+                    dirty_vms = self._pop_settled(self._dirty_vms)
+                    dirty_clusters = self._pop_settled(self._dirty_clusters)
+            try:
+                if sweep:
+                    self.logger.debug("Checking Windows VM coherency group.")
+                    next_sweep = time.time() + self.wait_time
+                    self.check(vm_properties)
+                    self.logger.debug("Windows VM coherency check complete.")
+                elif dirty_vms or dirty_clusters:
+                    self.logger.debug("Reconciling {} VMs and {} clusters.".format(len(dirty_vms),
+                                                                                   len(dirty_clusters)))
+                    self.check(vm_properties, dirty_vms=dirty_vms, dirty_clusters=dirty_clusters)
             except Exception as exc:
                 self.logger.error(exc, exc_info=True)
-            if self.stopped.wait(self.wait_time):
+            if self.stopped.wait(self.reconcile_interval if self.inventory is not None else self.wait_time):
                 self.logger.debug("Break reached.")
                 break
+
+    def check(self, vm_properties, dirty_vms=None, dirty_clusters=None):
+        """Run a coherency check of the VmGroups of every rule on every cluster. Clusters with drifted VMs are
+        independent DRS domains and are reconciled in parallel by the worker pool.
+        :param vm_properties: list of VirtualMachine properties to collect.
+        :param dirty_vms: if given, only these VM managed object ids are checked (inventory required).
+        :param dirty_clusters: if given, the VMs of these cluster managed object ids are checked as well.
+        """
+        with self.pool.lease() as vc:
+            self.logger.debug("Leased session to vCenter: {}.".format(self.host))
+            if self.inventory is not None and self.inventory.ready.is_set():
+                vm_data, clusters = self.state_from_inventory(vc)
+                if dirty_vms is not None or dirty_clusters is not None:
+                    dirty_vms, dirty_clusters = dirty_vms or set(), dirty_clusters or set()
+                    vm_data = filter(lambda x: x['obj']._moId in dirty_vms or
+                                     clusters[x['cluster']]['obj']._moId in dirty_clusters, vm_data)
+            else:
+                vm_data, clusters = self.state_from_vcenter(vc, vm_properties)
+
+        self.logger.debug("Start iterating VMs...")
+        drifted = {}
+        for vm in vm_data:
+            # VMs being created may miss their guest properties: they match no rule until the next change.
+            cluster_name = vm['cluster']
+            for rule in self.rules.classify_properties(vm):
+                if vm['obj']._moId not in clusters[cluster_name]['vm.groups'].get(rule.vm_group_name, []):
+                    self.logger.info("VM: {} in cluster: {} is not in the VmGroup: {}. Adding it.".format(
+                        vm['name'], cluster_name, rule.vm_group_name
+                    ))
+                    drifted.setdefault(cluster_name, {}).setdefault(rule.name, []).append(vm['obj']._moId)
+
+        for cluster_name, vm_ids_by_rule in drifted.items():
+            self.workers.submit(self.reconcile_cluster, cluster_name, clusters[cluster_name]['obj']._moId,
+                                vm_ids_by_rule)
+        self.workers.join()
+
+    def reconcile_cluster(self, cluster_name, cluster_id, vm_ids_by_rule):
+        """Add the drifted VMs of a cluster to the VmGroups of their rules with a single reconfiguration.
+        :param cluster_name: name of the cluster, for logging.
+        :param cluster_id: managed object id of the cluster.
+        :param vm_ids_by_rule: dictionary rule name -> managed object ids of the VMs to add.
+        """
+        if self.coordinator is not None:
+            if not self.coordinator.owns(self.coordinator.cluster_key(self.host, cluster_id)):
+                self.logger.debug('Cluster: {} is owned by another node. Skipping it.'.format(cluster_name))
+                return
+            lock = self.coordinator.lock(self.host, cluster_id)
+        else:
+            lock = cluster_locks.get((self.host, cluster_id))
+        start = time.time()
+        with self.pool.lease() as vc:
+            lock.acquire()
+            try:
+                cm = ClusterManager(si=vc.si, content=vc.content, vc=vc, inventory=self.inventory,
+                                    tracker=self.tracker, task_timeout=self.task_timeout)
+                cluster = vim.ClusterComputeResource(cluster_id, vc.si._stub)
+                vms_by_pool = [(rule, [vim.VirtualMachine(vm_id, vc.si._stub) for vm_id in vm_ids_by_rule[rule.name]])
+                               for rule in self.rules.rules if rule.name in vm_ids_by_rule]
+                future = cm.reconcile_pools(cluster, vms_by_pool, wait=False)
+            except Exception:
+                lock.release()
+                raise
+        # the cluster stays locked until the task is complete, the session is free for the other workers.
+        if future is None:
+            lock.release()
+        else:
+            # even past task_timeout: no other reconfiguration of the cluster may start while the task runs.
+            future.add_done_callback(lambda f: lock.release())
+            future.result(self.task_timeout)
+        elapsed = time.time() - start
+        registry.timer('guard.cluster.{}'.format(cluster_name)).observe(elapsed)
+        self.logger.info("Cluster: {} reconciled in {:.2f}s ({} VMs).".format(
+            cluster_name, elapsed, sum(len(vm_ids) for vm_ids in vm_ids_by_rule.values())
+        ))
+
+    @staticmethod
+    def _vm_group_members(groups):
+        """Return a dictionary VmGroup name -> managed object ids of its VMs, from the cluster groups."""
+        return dict((group.name, set(_vm._moId for _vm in group.vm or []))
+                    for group in groups if isinstance(group, vim.cluster.VmGroup))
+
+    def state_from_vcenter(self, vc, vm_properties):
+        """Collect VMs and clusters from the vCenter in a single property collection: the cluster of every VM is
+        reached following VM -> resourcePool -> owner inside the PropertyCollector.
+        :return: tuple (list of VM properties, dictionary cluster name -> cluster data)
+        """
+        view = vc._get_container_view([vim.VirtualMachine, vim.ClusterComputeResource])
+        try:
+            # now it becomes fun...
+            data = vc.collect_properties(view_ref=view,
+                                         obj_type=[vim.VirtualMachine, vim.ResourcePool, vim.ClusterComputeResource],
+                                         path_set={vim.VirtualMachine: vm_properties + ['resourcePool'],
+                                                   vim.ResourcePool: ['owner'],
+                                                   vim.ClusterComputeResource: ['name', 'configurationEx']},
+                                         include_mors=True,
+                                         traversal=[(vim.VirtualMachine, 'resourcePool'),
+                                                    (vim.ResourcePool, 'owner')],
+                                         joins={'cluster': ['resourcePool', 'owner']})
+        finally:
+            # sessions are long lived now: views must not pile up on the vCenter.
+            view.DestroyView()
+
+        # map cluster data into a dictionary
+        clusters = {}
+        vm_data = []
+        for item in data:
+            if isinstance(item['obj'], vim.ClusterComputeResource):
+                clusters[item['name']] = {}
+                clusters[item['name']]['obj'] = item['obj']
+                configuration = item.get('configurationEx')
+                clusters[item['name']]['vm.groups'] = self._vm_group_members(
+                    configuration.group if configuration else []
+                )
+            elif isinstance(item['obj'], vim.VirtualMachine) and 'cluster' in item:
+                item['cluster'] = item['cluster']['name']
+                vm_data.append(item)
+        return vm_data, clusters
+
+    def state_from_inventory(self, vc):
+        """Same as state_from_vcenter, reading the inventory cache. Managed objects are bound to the leased session.
+        :return: tuple (list of VM properties, dictionary cluster name -> cluster data)
+        """
+        clusters = {}
+        for cluster in self.inventory.clusters():
+            clusters[cluster['name']] = {}
+            clusters[cluster['name']]['obj'] = vim.ClusterComputeResource(cluster['obj']._moId, vc.si._stub)
+            configuration = cluster.get('configurationEx')
+            clusters[cluster['name']]['vm.groups'] = self._vm_group_members(
+                configuration.group if configuration else []
+            )
+        vm_data = []
+        for vm in self.inventory.vms():
+            cluster = self.inventory.cluster_of(vm['obj'])
+            if cluster is None:
+                # not in a cluster (templates, standalone hosts) or not synchronized yet.
+                continue
+            vm['cluster'] = cluster['name']
+            vm['obj'] = vim.VirtualMachine(vm['obj']._moId, vc.si._stub)
+            vm_data.append(vm)
+        return vm_data, clusters
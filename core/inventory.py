@@ -0,0 +1,194 @@
+__author__ = 'alessio.rocchi'
+
+from threading import Thread, Lock, Event
+from pyVmomi import vim, vmodl
+from core.base.metrics import registry
+import logging
+import time
+
+
+class Inventory(Thread):
+    """Long lived in-memory copy of the vCenter inventory needed by shepherd.
+    VMs, clusters, resource pools and hosts are loaded once and then kept current with WaitForUpdatesEx on a
+    private PropertyCollector, the same version-token mechanism wait_for_task uses for tasks. When the version
+    token is invalidated, or the session is lost, the whole inventory is resynchronized from scratch.
+
+    Objects are stored as dictionaries property path -> value plus 'obj', the managed object bound to the
+    inventory session: callers that need to invoke methods must rebind it to their own session.
+    """
+    properties = {
+        vim.VirtualMachine: ['name', 'config.guestFullName', 'config.guestId', 'config.hardware.numCPU',
+                             'resourcePool', 'runtime.powerState'],
+        vim.ClusterComputeResource: ['name', 'configurationEx', 'host', 'resourcePool'],
+        vim.ResourcePool: ['name', 'config.cpuAllocation.limit', 'vm', 'owner', 'parent'],
+        vim.HostSystem: ['name', 'summary.hardware.cpuMhz', 'summary.hardware.numCpuCores', 'hardware.cpuInfo.hz',
+                         'runtime.inMaintenanceMode', 'runtime.connectionState'],
+    }
+
+    def __init__(self, pool, max_wait=30):
+        """
+        :param pool: VcSessionPool. The inventory logs in a dedicated session of its own, outside of the pool.
+        :param max_wait: maxWaitSeconds of every WaitForUpdatesEx call.
+        """
+        super(Inventory, self).__init__()
+        self.name = 'Inventory'
+        self.daemon = True
+        self.pool = pool
+        self.max_wait = max_wait
+        self.stop = False
+        self.ready = Event()
+        self.logger = logging.getLogger('shepherd.inventory.Inventory')
+        self._lock = Lock()
+        self._objects = {}
+        self._listeners = []
+        self.updates = registry.counter('vcenter.{}.inventory.updates'.format(pool.host))
+        self.resyncs = registry.counter('vcenter.{}.inventory.resyncs'.format(pool.host))
+        registry.gauge('vcenter.{}.inventory.objects'.format(pool.host), lambda: len(self._objects))
+
+    # readers
+
+    def get(self, obj):
+        """Return a copy of the properties of a managed object, or None if it is not known.
+        :param obj: managed object or managed object id.
+        """
+        mo_id = obj if isinstance(obj, basestring) else obj._moId
+        with self._lock:
+            props = self._objects.get(mo_id)
+            return dict(props) if props is not None else None
+
+    def _of_type(self, obj_type):
+        with self._lock:
+            return [dict(props) for props in self._objects.values() if isinstance(props['obj'], obj_type)]
+
+    def vms(self):
+        return self._of_type(vim.VirtualMachine)
+
+    def clusters(self):
+        return self._of_type(vim.ClusterComputeResource)
+
+    def resource_pools(self):
+        return self._of_type(vim.ResourcePool)
+
+    def hosts(self):
+        return self._of_type(vim.HostSystem)
+
+    def cluster_of(self, vm):
+        """Return the properties of the cluster owning the VM resource pool, or None if unknown."""
+        vm_props = self.get(vm)
+        if not vm_props or not vm_props.get('resourcePool'):
+            return None
+        rp_props = self.get(vm_props['resourcePool'])
+        if not rp_props or not rp_props.get('owner'):
+            return None
+        return self.get(rp_props['owner'])
+
+    def subscribe(self, listener):
+        """Register a callable listener(obj, kind, names) notified of every change applied after the initial load.
+        kind is 'enter', 'modify' or 'leave', names the list of changed property paths. After every full load
+        listeners receive (None, 'resync', []). Listeners run in the inventory thread and must return quickly.
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, changes):
+        for obj, kind, names in changes:
+            for listener in self._listeners:
+                try:
+                    listener(obj, kind, names)
+                except Exception as e:
+                    self.logger.error('Inventory listener failed: {}'.format(e))
+
+    # synchronization
+
+    def _build_filter(self, vc, collector):
+        view = vc.content.viewManager.CreateContainerView(vc.content.rootFolder, self.properties.keys(), True)
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseEntities', path='view',
+                                                                     skip=False, type=view.__class__)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal_spec])
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=path_set)
+                      for obj_type, path_set in self.properties.items()]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_specs)
+        return view, collector.CreateFilter(filter_spec, partialUpdates=False)
+
+    @staticmethod
+    def _apply(objects, update):
+        """Apply an UpdateSet to objects.
+        :return: list of (managed object, kind, changed property names).
+        """
+        changes = []
+        for filter_set in update.filterSet:
+            for obj_set in filter_set.objectSet:
+                mo_id = obj_set.obj._moId
+                changes.append((obj_set.obj, obj_set.kind, [change.name for change in obj_set.changeSet]))
+                if obj_set.kind == 'leave':
+                    objects.pop(mo_id, None)
+                    continue
+                props = objects.setdefault(mo_id, {'obj': obj_set.obj})
+                for change in obj_set.changeSet:
+                    if change.op == 'assign':
+                        props[change.name] = change.val
+                    elif change.op in ('remove', 'indirectRemove'):
+                        props.pop(change.name, None)
+                    elif change.op == 'add':
+                        props[change.name] = list(props.get(change.name, [])) + [change.val]
+        return changes
+
+    def synchronize(self, vc):
+        """Follow the inventory changes on the given session until it fails or the thread is stopped."""
+        collector = vc.content.propertyCollector.CreatePropertyCollector()
+        view, property_filter = self._build_filter(vc, collector)
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait)
+        version = ''
+        resync = {}
+        try:
+            while not self.stop:
+                try:
+                    update = collector.WaitForUpdatesEx(version, options)
+                except vmodl.fault.InvalidCollectorVersion:
+                    self.logger.warning('Inventory version token invalidated. Full resync.')
+                    self.resyncs.inc()
+                    version, resync = '', {}
+                    continue
+                if update is None:
+                    # maxWaitSeconds elapsed without changes.
+                    continue
+                version = update.version
+                if resync is not None:
+                    # initial load: readers keep seeing the previous inventory until it is complete.
+                    self._apply(resync, update)
+                    if not update.truncated:
+                        with self._lock:
+                            self._objects = resync
+                        resync = None
+                        self.ready.set()
+                        self.logger.info('Inventory synchronized: {} objects.'.format(len(self._objects)))
+                        # changes in between are unknown: listeners are told to look at everything.
+                        self._notify([(None, 'resync', [])])
+                else:
+                    with self._lock:
+                        changes = self._apply(self._objects, update)
+                    self._notify(changes)
+                self.updates.inc()
+        finally:
+            try:
+                property_filter.Destroy()
+                view.DestroyView()
+                collector.DestroyPropertyCollector()
+            except Exception:
+                pass
+
+    def run(self):
+        while not self.stop:
+            vc = None
+            try:
+                vc = self.pool.dedicated()
+                self.synchronize(vc)
+            except Exception as e:
+                self.logger.error('Inventory synchronization failed: {}. Resyncing.'.format(e), exc_info=True)
+                self.resyncs.inc()
+                if vc is not None:
+                    self.pool.release(vc, discard=True)
+                    vc = None
+                time.sleep(5)
+            finally:
+                if vc is not None:
+                    self.pool.release(vc, discard=True)
@@ -0,0 +1,182 @@
+__author__ = 'alessio.rocchi'
+
+from threading import Thread, Timer
+from core.base.metrics import registry
+from core.workitem import WorkItem
+import logging
+import sqlite3
+import Queue
+import time
+
+
+class Journal(Thread):
+    """Write-ahead journal of the notifications going through the pipeline, in a SQLite database in WAL mode.
+    Stages record the state transitions of an entity (received, resolved, found) and its completion (applied or
+    rejected). Writes are queued and committed in batches by the journal thread, so recording costs a queue put.
+    Once the pipeline runs, the unfinished entities the broker did not deliver again are replayed into the stage
+    following their last recorded state; finished ones are deleted after retention seconds, in the journal thread.
+    """
+    FINISHED = ('applied', 'rejected')
+
+    def __init__(self, path, flush_interval=0.05, batch_size=500, retention=3600, compact_interval=300,
+                 max_retries=3, retry_delay=30):
+        """
+        :param path: SQLite database file.
+        :param flush_interval: seconds the journal thread waits for writes to batch together.
+        :param retention: seconds finished entities are kept.
+        :param compact_interval: seconds between two compactions.
+        :param max_retries: attempts of a failing replayed entity before it is recorded as rejected.
+        :param retry_delay: seconds before a failed replayed entity is queued again.
+        """
+        super(Journal, self).__init__()
+        self.name = 'Journal'
+        self.daemon = True
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retention = retention
+        self.compact_interval = compact_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.stop = False
+        self.logger = logging.getLogger('shepherd.journal.Journal')
+        self._writes = Queue.Queue()
+        self.commits = registry.timer('journal.commits')
+        self.replayed = registry.counter('journal.replayed')
+        self.replay_rejected = registry.counter('journal.replay_rejected')
+        registry.gauge('journal.backlog', self._writes.qsize)
+
+    def _connect(self):
+        # sqlite connections cannot be shared between threads: every thread opens its own.
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode NORMAL only risks the last transactions on power loss, never the database.
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, state TEXT NOT NULL, '
+                           'payload TEXT, updated REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS entries_state ON entries (state, updated)')
+        return connection
+
+    def record(self, key, state, payload=None):
+        """Record a state transition of an entity. Without payload the one of the previous state is kept."""
+        self._writes.put((key, state, payload, time.time()))
+
+    def _drain(self):
+        try:
+            batch = [self._writes.get(timeout=self.flush_interval)]
+        except Queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._writes.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _write(self, connection, batch):
+        start = time.time()
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO entries (key, state, payload, updated) '
+                'VALUES (?, ?, COALESCE(?, (SELECT payload FROM entries WHERE key = ?)), ?)',
+                [(key, state, payload, key, updated) for key, state, payload, updated in batch]
+            )
+        self.commits.observe(time.time() - start)
+
+    def compact(self, connection):
+        """Delete the entities finished for longer than retention and truncate the write-ahead log."""
+        with connection:
+            deleted = connection.execute(
+                'DELETE FROM entries WHERE state IN ({}) AND updated < ?'.format(', '.join('?' * len(self.FINISHED))),
+                self.FINISHED + (time.time() - self.retention,)
+            ).rowcount
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.logger.debug('Journal compacted: {} entries deleted.'.format(deleted))
+
+    def pending(self, before=None):
+        """Return the unfinished entities as a list of (key, state, payload), oldest first.
+        :param before: only the entities last recorded before this timestamp.
+        """
+        query = 'SELECT key, state, payload FROM entries WHERE state NOT IN ({})'.format(
+            ', '.join('?' * len(self.FINISHED)))
+        parameters = self.FINISHED
+        if before is not None:
+            query += ' AND updated < ?'
+            parameters += (before,)
+        connection = self._connect()
+        try:
+            return connection.execute(query + ' ORDER BY updated', parameters).fetchall()
+        finally:
+            connection.close()
+
+    def replay(self, resolver_queue, reaction_queue=None, before=None):
+        """Queue the unfinished entities again: received ones to the Resolver, the others to the Reactioneer.
+        Must be called once the stages consume their queues. Replayed items have no AMQP delivery: their
+        completion is recorded in the journal only, failures being queued again after retry_delay seconds until
+        max_retries attempts.
+        :param reaction_queue: queue of the Reactioneer. None when several vCenters are served: the MoRef alone
+        does not tell the vCenter, so every entity goes through the Resolver again.
+        :param before: only the entities not recorded since this timestamp. Given the startup time, after the
+        Watcher has been consuming for a while, it skips the notifications the broker delivered again: only
+        the ones lost by the broker are replayed. A notification delivered while its replayed copy is in flight
+        waits for it in the dedup stage of the Reactioneer.
+        :return: number of entities replayed.
+        """
+        entries = self.pending(before)
+        for key, state, payload in entries:
+            self._submit(key, state, payload, (resolver_queue, reaction_queue), 1)
+            self.replayed.inc()
+        if entries:
+            self.logger.info('Replayed {} unfinished entities from the journal.'.format(len(entries)))
+        return len(entries)
+
+    def _submit(self, key, state, payload, queues, attempt):
+        resolver_queue, reaction_queue = queues
+        on_complete = lambda success: self._replayed(key, state, payload, queues, attempt, success)
+        if state == 'received' or not payload or reaction_queue is None:
+            item, queue = WorkItem(key, on_complete=on_complete), resolver_queue
+        else:
+            item, queue = WorkItem(payload, on_complete=on_complete), reaction_queue
+        item.key = key
+        queue.put(item)
+
+    def _replayed(self, key, state, payload, queues, attempt, success):
+        """Completion callback of a replayed item."""
+        if success:
+            self.complete(key, True)
+        elif attempt < self.max_retries:
+            self.logger.warning('Replayed entity: {} failed. Retrying ({}/{})...'.format(key, attempt,
+                                                                                        self.max_retries))
+            # never block the stage reporting the failure on a full queue.
+            timer = Timer(self.retry_delay, self._submit, (key, state, payload, queues, attempt + 1))
+            timer.daemon = True
+            timer.start()
+        else:
+            self.logger.error('Replayed entity: {} failed {} times. Rejecting it.'.format(key, attempt))
+            self.replay_rejected.inc()
+            self.complete(key, False, rejected=True)
+
+    def complete(self, key, success, rejected=False):
+        """Record the outcome of an entity: applied if successful, rejected if given up, nothing on retries."""
+        if success:
+            self.record(key, 'applied')
+        elif rejected:
+            self.record(key, 'rejected')
+
+    def run(self):
+        connection = self._connect()
+        next_compaction = time.time() + self.compact_interval
+        try:
+            while not self.stop or not self._writes.empty():
+                batch = self._drain()
+                try:
+                    if batch:
+                        self._write(connection, batch)
+                    if time.time() >= next_compaction:
+                        next_compaction = time.time() + self.compact_interval
+                        self.compact(connection)
+                except sqlite3.Error as e:
+                    # the journal is a recovery aid: the pipeline goes on without it.
+                    self.logger.error('Journal write failed: {}. {} records lost.'.format(e, len(batch)))
+        finally:
+            connection.close()
@@ -3,60 +3,73 @@ __author__ = 'alessio.rocchi'
 import Queue
 from threading import Thread
 import logging
-from pyVim import connect
 from pyVmomi import vim
-import ConfigParser
+from core.rules import default_rules
 
 import requests
 requests.packages.urllib3.disable_warnings()
 
 rootLogger = logging.getLogger('shepherd.reactioneer')
 
-Config = ConfigParser.ConfigParser()
-Config.read('config.ini')
 
-def config_section_map(section):
-    dict1 = {}
-    options = Config.options(section)
-    for option in options:
-        try:
-            dict1[option] = Config.get(section, option)
-        except KeyError:
-            dict1[option] = None
-    return dict1
+class VmRecord(object):
+    """Properties of a VM needed by the pipeline, detached from any vCenter session.
+    Unlike a vim.VirtualMachine it never goes back to the vCenter on attribute access: whoever needs to act on the
+    VM binds a managed object to its own session from mo_id.
+    """
+    __slots__ = ('mo_id', 'name', 'guest_id', 'guest_full_name', 'num_cpu', 'resource_pool', 'rules')
+
+    def __init__(self, mo_id, name=None, guest_id=None, guest_full_name=None, num_cpu=None, resource_pool=None):
+        self.mo_id = mo_id
+        self.name = name
+        self.guest_id = guest_id
+        self.guest_full_name = guest_full_name or ''
+        self.num_cpu = num_cpu
+        # managed object id of the resource pool
+        self.resource_pool = resource_pool
+        # names of the classification rules the VM belongs to
+        self.rules = []
+
+    def __repr__(self):
+        return 'VmRecord({}, {})'.format(self.mo_id, self.name)
 
 
 class VmFinder(object):
-    def __init__(self, vc, username, password):
+    properties = ['name', 'config.guestId', 'config.guestFullName', 'config.hardware.numCPU', 'resourcePool']
+
+    def __init__(self, vc):
         self.vc = vc
-        self.username = username
-        self.password = password
-        self.si = None
-        self.content = None
         self.logger = logging.getLogger('shepherd.reactioneer.VmFinder')
         self.logger.propagate = True
 
-    def connect(self):
-        self.si = connect.SmartConnect(host=self.vc,
-                                       user=self.username,
-                                       pwd=self.password)
-        self.content = self.si.RetrieveContent()
-        self.logger.debug('Connected to vCenter: {}'.format(self.vc))
-
     def find_vm_by_moref(self, mo_ref):
+        """Fetch the properties of a VM in a single RetrievePropertiesEx, without pulling the whole config.
+        :return: VmRecord.
+        """
         self.logger.debug('Searching for object with mo_ref: {}'.format(mo_ref))
-        vm = vim.VirtualMachine(mo_ref)
-        vm._stub = self.si._stub
-        self.logger.debug('Found Object: {}'.format(vm.name))
-        return vm
-
-    def __exit__(self):
-        connect.Disconnect(self.si)
+        props = self.vc.get_properties(vim.VirtualMachine(mo_ref, self.vc.si._stub), self.properties)
+        resource_pool = props.get('resourcePool')
+        record = VmRecord(mo_ref,
+                          name=props.get('name'),
+                          guest_id=props.get('config.guestId'),
+                          guest_full_name=props.get('config.guestFullName'),
+                          num_cpu=props.get('config.hardware.numCPU'),
+                          resource_pool=resource_pool._moId if resource_pool is not None else None)
+        self.logger.debug('Found Object: {}'.format(record.name))
+        return record
 
 
 class Reactioneer(Thread):
-    def __init__(self, reactioneer_queue, executor_queue, dispatch_any=False):
+    def __init__(self, reactioneer_queue, executor_queue, pool, dispatch_any=False, dedup=None, journal=None,
+                 rules=None):
+        """
+        :param rules: core.rules.RuleSet classifying the VMs. By default Windows VMs only.
+        """
         super(Reactioneer, self).__init__()
+        self.rules = rules if rules is not None else default_rules()
+        self.pool = pool
+        self.dedup = dedup
+        self.journal = journal
         self.reactioneer_queue = reactioneer_queue
         self.executor_queue = executor_queue
         self.stop = False
@@ -67,26 +80,49 @@ class Reactioneer(Thread):
         if self.dispatch_any == '1':
             self.logger.info('Reactioneer will dispatch any VM. Testing purpose only. Disable in production!')
 
+    @staticmethod
+    def _find(vc, vm_mo_ref):
+        return VmFinder(vc).find_vm_by_moref(mo_ref=vm_mo_ref)
+
+    def dispatch(self, item, vm):
+        if self.journal is not None and item.key is not None:
+            self.journal.record(item.key, 'found', vm.mo_id)
+        self.executor_queue.put(item.forward(vm))
+
     def run(self):
         while not self.stop:
             try:
-                vm_mo_ref = self.reactioneer_queue.get(timeout=10)
+                item = self.reactioneer_queue.get(timeout=10)
             except Queue.Empty:
                 continue
+            vm_mo_ref = item.payload
             self.logger.info('Received vm_mo_ref from Resolver: {}'.format(vm_mo_ref))
-            vcenter_config = config_section_map("vcenter")
-            finder = VmFinder(vc=vcenter_config['vcenter'],
-                              username=vcenter_config['username'],
-                              password=vcenter_config['password'])
-            finder.connect()
-            vm = finder.find_vm_by_moref(mo_ref=vm_mo_ref)
-            if 'windows' in vm.config.guestFullName.lower():
-                self.logger.info('Windows vm found. Dispatching to Executor.')
-                self.executor_queue.put(vm)
+            if self.dedup is not None:
+                if not self.dedup.acquire(vm_mo_ref, item):
+                    self.logger.info('vm_mo_ref: {} already dispatched to Executor. Skipping it.'.format(vm_mo_ref))
+                    self.reactioneer_queue.task_done()
+                    continue
+                item.add_done_callback(lambda success, key=vm_mo_ref: self.dedup.settle(key, success))
+            try:
+                vm = self.pool.call(self._find, vm_mo_ref)
+            except Exception as e:
+                self.logger.error('Cannot retrieve vm_mo_ref: {}. {}'.format(vm_mo_ref, e))
+                item.failed()
+                self.reactioneer_queue.task_done()
+                continue
+            guest_full_name = vm.guest_full_name
+            rules = self.rules.classify(guest_id=vm.guest_id, guest_full_name=guest_full_name)
+            if rules:
+                vm.rules = [rule.name for rule in rules]
+                self.logger.info('VM classified as: {}. Dispatching to Executor.'.format(', '.join(vm.rules)))
+                self.dispatch(item, vm)
             elif self.dispatch_any == '1':
                 self.logger.info('Testing purpose: vm received. Dispatching to Executor.')
-                self.executor_queue.put(vm)
+                vm.rules = [self.rules.rules[0].name]
+                self.dispatch(item, vm)
             else:
-                self.logger.info('VM not recognized as Windows. Skipping it.')
-                self.logger.debug('VM guest: {}'.format(vm.config.guestFullName.lower()))
+                # keep it in the dedup window anyway: the guest OS of a repeated notification is the same.
+                self.logger.info('VM not matching any rule. Skipping it.')
+                self.logger.debug('VM guest: {}'.format(guest_full_name.lower()))
+                item.done()
             self.reactioneer_queue.task_done()
@@ -0,0 +1,91 @@
+__author__ = 'alessio.rocchi'
+
+from core.base.metrics import registry
+import logging
+
+
+class VcenterBackend(object):
+    """The stages serving one vCenter: session pool, inventory, task tracker, Reactioneer, Executor and Guard, fed
+    by their own queues. A vCenter slow or unreachable stalls its own backend only.
+    """
+    def __init__(self, name, pool, reaction_queue, executor_queue, reactioneer, executor, guard, inventory=None,
+                 tracker=None, server_ids=()):
+        """
+        :param name: name of the backend, by default also the VimServer name it serves.
+        :param server_ids: ids of the vCloud VimServers served, see vcloudlib.parser.VimRef.
+        """
+        self.name = name
+        self.pool = pool
+        self.reaction_queue = reaction_queue
+        self.executor_queue = executor_queue
+        self.reactioneer = reactioneer
+        self.executor = executor
+        self.guard = guard
+        self.inventory = inventory
+        self.tracker = tracker
+        self.server_ids = tuple(server_ids)
+
+    @property
+    def queues(self):
+        return [self.reaction_queue, self.executor_queue]
+
+    def start(self):
+        for thread in (self.inventory, self.tracker, self.reactioneer, self.executor, self.guard):
+            if thread is not None:
+                thread.start()
+
+    def join(self):
+        for thread in (self.reactioneer, self.executor, self.guard):
+            thread.join()
+
+    def stop(self):
+        """Ask every stage to stop. The Guard stops with the event it has been given."""
+        for thread in (self.inventory, self.tracker, self.reactioneer, self.executor):
+            if thread is not None:
+                thread.stop = True
+        self.pool.close()
+
+    def __repr__(self):
+        return 'VcenterBackend({})'.format(self.name)
+
+
+class Router(object):
+    """Routing table from the vCenter of a VM, as referenced by vCloud in VmVimInfo, to the backend serving it.
+    VMs are routed by VimServer id, then by VimServer name. With a single backend every VM goes to it.
+    """
+    def __init__(self, backends=()):
+        self.logger = logging.getLogger('shepherd.router.Router')
+        self.backends = []
+        self._by_id = {}
+        self._by_name = {}
+        self.unrouted = registry.counter('router.unrouted')
+        for backend in backends:
+            self.add(backend)
+
+    def add(self, backend):
+        for server_id in backend.server_ids:
+            if server_id in self._by_id:
+                raise ValueError('VimServer {} served by both {} and {}.'.format(
+                    server_id, self._by_id[server_id].name, backend.name))
+            self._by_id[server_id] = backend
+        self._by_name[backend.name] = backend
+        self.backends.append(backend)
+
+    def route(self, vim_ref):
+        """Return the backend of a VM, or None if no backend serves its vCenter.
+        :param vim_ref: vcloudlib.parser.VimRef of the VM.
+        """
+        backend = self._by_id.get(vim_ref.server_id) or self._by_name.get(vim_ref.server_name)
+        if backend is None and len(self.backends) == 1:
+            backend = self.backends[0]
+        if backend is None:
+            self.unrouted.inc()
+            self.logger.error('No vCenter configured for VimServer: {} ({}). VM: {} not handled.'.format(
+                vim_ref.server_name, vim_ref.server_id, vim_ref.mo_ref
+            ))
+        return backend
+
+    @property
+    def queues(self):
+        """Every queue of every backend, e.g. for the backpressure of Watcher2."""
+        return [queue for backend in self.backends for queue in backend.queues]
@@ -0,0 +1,105 @@
+__author__ = 'alessio.rocchi'
+
+from threading import Lock
+import logging
+import re
+
+
+class Rule(object):
+    """Classification rule: the VMs matching every given predicate belong to its DRS groups.
+    Predicates are case insensitive regular expressions searched in the guestId and in the guestFullName.
+    """
+    # VM property path of every predicate matched against the vCenter properties
+    fields = {'guest_id': 'config.guestId', 'guest_full_name': 'config.guestFullName'}
+
+    def __init__(self, name, host_group_name, vm_group_name, affinity_rule_name, guest_id=None,
+                 guest_full_name=None):
+        self.name = name
+        self.host_group_name = host_group_name
+        self.vm_group_name = vm_group_name
+        self.affinity_rule_name = affinity_rule_name
+        self.predicates = {}
+        if guest_id:
+            self.predicates['guest_id'] = guest_id
+        if guest_full_name:
+            self.predicates['guest_full_name'] = guest_full_name
+        if not self.predicates:
+            raise ValueError('Rule {} has no predicate.'.format(name))
+        # set by the RuleSet the rule belongs to.
+        self.ruleset = None
+
+    def matches(self, props):
+        """Tell if a VM given as dictionary of vCenter properties belongs to this rule.
+        Used where VMs of a whole cluster are evaluated, e.g. the worst case allocation. The VM is classified by the
+        RuleSet of the rule, so the capacity figures agree with the classification of the pipeline.
+        """
+        if self.ruleset is None:
+            RuleSet([self])
+        return self in self.ruleset.classify_properties(props)
+
+    def __repr__(self):
+        return 'Rule({})'.format(self.name)
+
+
+class RuleSet(object):
+    """Rules compiled into one matcher per field, evaluated once per VM and memoized.
+    The expressions of every rule on a field are combined into a single regular expression made of optional
+    lookaheads, one named group per rule, so a single match tells which rules the field satisfies. A VM belongs to
+    the rules whose fields are all satisfied.
+    """
+    def __init__(self, rules, cache_size=4096):
+        self.rules = list(rules)
+        for rule in self.rules:
+            rule.ruleset = self
+        self.cache_size = cache_size
+        self.logger = logging.getLogger('shepherd.rules.RuleSet')
+        self._lock = Lock()
+        self._cache = {}
+        self._matchers = {}
+        for field in set(field for rule in self.rules for field in rule.predicates):
+            groups = ['(?=.*?(?P<r{}>{}))?'.format(index, rule.predicates[field])
+                      for index, rule in enumerate(self.rules) if field in rule.predicates]
+            self._matchers[field] = re.compile(''.join(groups), re.IGNORECASE | re.DOTALL)
+
+    def by_name(self, name):
+        for rule in self.rules:
+            if rule.name == name:
+                return rule
+        raise KeyError(name)
+
+    def _evaluate(self, values):
+        satisfied = {}
+        for field, matcher in self._matchers.items():
+            match = matcher.match(values.get(field) or '')
+            satisfied[field] = set(int(group[1:]) for group, value in match.groupdict().items() if value is not None)
+        return [rule for index, rule in enumerate(self.rules)
+                if all(index in satisfied[field] for field in rule.predicates)]
+
+    def classify(self, guest_id=None, guest_full_name=None):
+        """Return the rules a VM belongs to, in configuration order. Results are memoized by guestId and
+        guestFullName.
+        """
+        values = {'guest_id': guest_id, 'guest_full_name': guest_full_name}
+        key = tuple(sorted((field, values.get(field)) for field in self._matchers))
+        with self._lock:
+            rules = self._cache.get(key)
+        if rules is None:
+            rules = self._evaluate(values)
+            with self._lock:
+                if len(self._cache) >= self.cache_size:
+                    self._cache.clear()
+                self._cache[key] = rules
+            self.logger.debug('VM guest: {} ({}) classified as: {}.'.format(guest_full_name, guest_id, rules))
+        return rules
+
+    def classify_properties(self, props):
+        """Same as classify for a VM given as dictionary of vCenter properties."""
+        return self.classify(guest_id=props.get(Rule.fields['guest_id']),
+                             guest_full_name=props.get(Rule.fields['guest_full_name']))
+
+
+def default_rules(host_group_name='WindowsVM', vm_group_name='Windows', affinity_rule_name='WindowsAffinityRule',
+                  pattern='windows'):
+    """RuleSet reproducing the historical behaviour: VMs whose guestFullName contains pattern, one DRS group set."""
+    return RuleSet([Rule('windows', host_group_name, vm_group_name, affinity_rule_name,
+                         guest_full_name=re.escape(pattern))])
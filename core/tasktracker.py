@@ -0,0 +1,172 @@
+__author__ = 'alessio.rocchi'
+
+from threading import Thread, Lock, Event
+from pyVmomi import vim, vmodl
+from core.base.metrics import registry
+from vspherelib.helper.tasks import TaskTimeout
+import logging
+import time
+
+
+class TaskFuture(object):
+    """Outcome of a vim.Task watched by a TaskTracker."""
+    def __init__(self, task):
+        self.task = task
+        self.state = None
+        self.error = None
+        self.result_value = None
+        self._event = Event()
+        self._lock = Lock()
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def add_done_callback(self, callback):
+        """Call callback(future) once the task is complete, right away if it already is."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self, timeout=None):
+        """Wait for the task.
+        :return: info.result of the task.
+        :raises: the fault of the task if it failed, TaskTimeout if it is not complete within timeout seconds.
+        """
+        if not self._event.wait(timeout):
+            raise TaskTimeout('Task: {} not complete after {} seconds.'.format(self.task._moId, timeout))
+        if self.error is not None:
+            raise self.error
+        return self.result_value
+
+    def set_outcome(self, state, error=None, result=None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.state = state
+            self.error = error
+            self.result_value = result
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logging.getLogger('shepherd.tasktracker.TaskFuture').error('Task callback failed: {}'.format(e))
+
+
+class TaskTracker(Thread):
+    """Watch every outstanding vim.Task on one private PropertyCollector.
+    Each tracked task gets a filter on info.state, info.error and info.result of the same collector, and a single
+    WaitForUpdatesEx loop resolves the TaskFuture of every task as its state becomes success or error. The tracker
+    logs in a dedicated session, outside of the pool; when it is lost the outstanding tasks are watched again on a
+    new one.
+    """
+    path_set = ['info.state', 'info.error', 'info.result']
+
+    def __init__(self, pool, max_wait=30):
+        """
+        :param pool: VcSessionPool.
+        :param max_wait: maxWaitSeconds of every WaitForUpdatesEx call.
+        """
+        super(TaskTracker, self).__init__()
+        self.name = 'TaskTracker'
+        self.daemon = True
+        self.pool = pool
+        self.max_wait = max_wait
+        self.stop = False
+        self.logger = logging.getLogger('shepherd.tasktracker.TaskTracker')
+        self._lock = Lock()
+        # task managed object id -> (TaskFuture, PropertyFilter or None until registered)
+        self._tasks = {}
+        self._vc = None
+        self._collector = None
+        self.failures = registry.counter('vcenter.{}.tasks.failed'.format(pool.host))
+        self.latency = registry.timer('vcenter.{}.tasks.latency'.format(pool.host))
+        registry.gauge('vcenter.{}.tasks.outstanding'.format(pool.host), lambda: len(self._tasks))
+
+    def track(self, task):
+        """Start watching a task.
+        :return: TaskFuture of the task.
+        """
+        future = TaskFuture(task)
+        future.submitted = time.time()
+        with self._lock:
+            self._tasks[task._moId] = (future, None)
+            if self._collector is not None:
+                self._register(task._moId)
+        return future
+
+    def _register(self, mo_id):
+        """Create the filter of a task on the current collector. Called with the lock held."""
+        future, _ = self._tasks[mo_id]
+        task = vim.Task(mo_id, self._vc.si._stub)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=task, skip=False)
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=self.path_set)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        self._tasks[mo_id] = (future, self._collector.CreateFilter(filter_spec, partialUpdates=False))
+
+    def _apply(self, update):
+        for filter_set in update.filterSet:
+            for obj_set in filter_set.objectSet:
+                values = dict((change.name, change.val) for change in obj_set.changeSet)
+                state = values.get('info.state')
+                if state not in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+                    continue
+                with self._lock:
+                    future, property_filter = self._tasks.pop(obj_set.obj._moId, (None, None))
+                if future is None:
+                    continue
+                if property_filter is not None:
+                    try:
+                        property_filter.Destroy()
+                    except Exception:
+                        pass
+                self.latency.observe(time.time() - future.submitted)
+                if state == vim.TaskInfo.State.error:
+                    self.failures.inc()
+                    self.logger.error('Task: {} failed: {}'.format(obj_set.obj._moId, values.get('info.error')))
+                future.set_outcome(state, error=values.get('info.error'), result=values.get('info.result'))
+
+    def synchronize(self, vc):
+        """Follow the tracked tasks on the given session until it fails or the thread is stopped."""
+        collector = vc.content.propertyCollector.CreatePropertyCollector()
+        with self._lock:
+            self._vc, self._collector = vc, collector
+            # tasks submitted before start, or watched by a lost session.
+            for mo_id in self._tasks.keys():
+                self._register(mo_id)
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self.max_wait)
+        version = ''
+        try:
+            while not self.stop:
+                update = collector.WaitForUpdatesEx(version, options)
+                if update is None:
+                    continue
+                version = update.version
+                self._apply(update)
+        finally:
+            with self._lock:
+                self._vc, self._collector = None, None
+            try:
+                collector.DestroyPropertyCollector()
+            except Exception:
+                pass
+
+    def run(self):
+        while not self.stop:
+            vc = None
+            try:
+                vc = self.pool.dedicated()
+                self.synchronize(vc)
+            except Exception as e:
+                self.logger.error('Task tracking failed: {}. Watching tasks again.'.format(e), exc_info=True)
+                if vc is not None:
+                    self.pool.release(vc, discard=True)
+                    vc = None
+                time.sleep(5)
+            finally:
+                if vc is not None:
+                    self.pool.release(vc, discard=True)
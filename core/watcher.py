@@ -3,77 +3,221 @@ __author__ = 'alessio.rocchi'
 import pika
 import Queue
 import logging
+import requests
 import time
-from xml.etree import ElementTree as ET
-from xml.etree.ElementTree import ParseError
-from threading import Thread
+from collections import deque
+from threading import Thread, Lock, BoundedSemaphore
 from vcloudlib import vcloudsession
+from vcloudlib import parser
+from core.base.metrics import registry
+from core.base.queues import BoundedQueue
+from core.workitem import WorkItem
 
 module_logger = logging.getLogger('shepherd.watcher')
-resolver_queue = Queue.Queue()
+# unbounded until configured with resolver_queue.configure()
+resolver_queue = BoundedQueue('resolver')
+
+VM_URN_PREFIX = 'urn:vcloud:vm:'
+RETRIES_HEADER = 'x-shepherd-retries'
+
+
+# in-flight request limits shared by every Resolver talking to the same vCloud cell.
+_cell_limits = {}
+_cell_limits_lock = Lock()
+
+
+def get_cell_limit(host, max_in_flight):
+    """Return the semaphore bounding the concurrent requests towards a vCloud cell."""
+    with _cell_limits_lock:
+        if host not in _cell_limits:
+            _cell_limits[host] = BoundedSemaphore(max_in_flight)
+        return _cell_limits[host]
+
+
+class ResolverWorker(Thread):
+    """Resolve the entities routed to its own partition of the Resolver."""
+    def __init__(self, resolver, index, partition_size=0):
+        super(ResolverWorker, self).__init__()
+        self.resolver = resolver
+        # bounded, so a slow vCloud cell lets resolver_queue fill up and push back on Watcher2.
+        self.partition = Queue.Queue(partition_size)
+        self.name = 'Resolver-{}'.format(index)
+        self.daemon = True
+
+    def run(self):
+        while not self.resolver.stop:
+            try:
+                item, received = self.partition.get(timeout=10)
+            except Queue.Empty:
+                continue
+            try:
+                self.resolver.resolve(item)
+            except Exception as e:
+                self.resolver.failed.inc()
+                item.failed()
+                self.resolver.logger.error('Failed to resolve entity: {}. {}'.format(item.payload, e))
+            self.resolver.latency.observe(time.time() - received)
+            self.partition.task_done()
+            resolver_queue.task_done()
 
 
 class Resolver(Thread):
-    def __init__(self, host, username, password, reaction_queue):
+    """Dispatch the work items of resolver_queue to a pool of ResolverWorker.
+    Entities are partitioned by URN so notifications of the same entity are always resolved in order by the
+    same worker, while at most max_in_flight requests per vCloud cell run concurrently.
+    """
+    def __init__(self, host, username, password, reaction_queue, pool_maxsize=10, workers=4, max_in_flight=8,
+                 fast_path=True, partition_size=100, journal=None, router=None):
+        """
+        :param reaction_queue: queue of the Reactioneer, when a single vCenter is served.
+        :param router: core.router.Router giving the Reactioneer queue of the vCenter of every VM. Takes
+        precedence over reaction_queue.
+        """
         super(Resolver, self).__init__()
+        self.router = router
+        self.journal = journal
+        # resolve vcloud:vm URNs with a direct GET of /api/vApp/vm-<uuid>, using /api/entity only on 404.
+        self.fast_path = fast_path
         self.host = host
         self.username = username
         self.password = password
-        self.vcs = vcloudsession.VCS(host=self.host, username=self.username, password=self.password)
+        self.vcs = vcloudsession.VCS(host=self.host, username=self.username, password=self.password,
+                                     pool_maxsize=pool_maxsize)
         self.stop = False
         self.name = 'Resolver'
         self.reaction_queue = reaction_queue
         self.logger = logging.getLogger('shepherd.watcher.Resolver')
-        self.logger.info("Resolver initialized. Waiting for events...")
+        self.cell_limit = get_cell_limit(self.host, max_in_flight)
+        self.workers = [ResolverWorker(self, index, partition_size) for index in range(workers)]
+        self.latency = registry.timer('resolver.latency')
+        self.failed = registry.counter('resolver.failed')
+        self.fast_path_hits = registry.counter('resolver.fast_path.hits')
+        self.fast_path_misses = registry.counter('resolver.fast_path.misses')
+        registry.gauge('resolver.queue_depth', resolver_queue.qsize)
+        registry.gauge('resolver.partitions_depth', lambda: sum(w.partition.qsize() for w in self.workers))
+        self.logger.info("Resolver initialized with {} workers. Waiting for events...".format(workers))
 
     def login(self):
         self.vcs.login()
 
+    def execute_request(self, url, parse):
+        """GET url and parse the response while it is streamed.
+        :param parse: callable extracting the needed value from the response.
+        :return: tuple (HTTP status code, the parsed value or None if the request failed).
+        """
+        with self.cell_limit:
+            response = self.vcs.get(url, stream=True)
+            if response.status_code != requests.codes.ok:
+                response.close()
+                return response.status_code, None
+            return response.status_code, parse(response)
+
+    def vm_url(self, entity):
+        """Build the VM document url straight from a vcloud:vm URN, or None for other URNs."""
+        if not entity.startswith(VM_URN_PREFIX):
+            return None
+        return '{base}/api/vApp/vm-{uuid}'.format(base=self.vcs.base_url, uuid=entity[len(VM_URN_PREFIX):])
+
     def run(self):
+        for worker in self.workers:
+            worker.start()
         while not self.stop:
             try:
-                entity = resolver_queue.get(timeout=10)
+                item = resolver_queue.get(timeout=10)
             except Queue.Empty:
                 continue
-            self.login()
-            self.logger.debug('Received Entity: {entity}'.format(entity=entity))
-            response = self.vcs.execute_request(
-                'http://{host}/api/entity/{urn}'.format(host=self.host, urn=entity)
+            self.workers[hash(item.payload) % len(self.workers)].partition.put((item, time.time()))
+
+    def resolve(self, item):
+        """Resolve the vCloud VM URN of a work item to its vCenter MoRef and dispatch it to the Reactioneer."""
+        entity = item.payload
+        self.logger.debug('Received Entity: {entity}'.format(entity=entity))
+        vm_ref = None
+        status = None
+        href = self.vm_url(entity) if self.fast_path else None
+        if href:
+            status, vm_ref = self.execute_request(href, parser.find_vm_vim_ref)
+            if status == requests.codes.not_found:
+                # not a plain vApp VM url in this deployment: go through the entity resolution.
+                self.fast_path_misses.inc()
+                href = None
+            elif status == requests.codes.ok:
+                self.fast_path_hits.inc()
+        if not href:
+            status, href = self.execute_request(
+                '{base}/api/entity/{urn}'.format(base=self.vcs.base_url, urn=entity), parser.find_link_href
             )
-            if hasattr(response, 'content'):
-                res_xml = ET.fromstring(response.content)
-                obj_response = self.vcs.execute_request(
-                    res_xml.findall('{http://www.vmware.com/vcloud/v1.5}Link')[0].attrib['href']
-                )
-                if obj_response:
-                    vm_mo_ref = ET.fromstring(obj_response.content).findall(
-                        '{http://www.vmware.com/vcloud/v1.5}VCloudExtension'
-                    )[0].find(
-                        '{http://www.vmware.com/vcloud/extension/v1.5}VmVimInfo'
-                    ).find(
-                        '{http://www.vmware.com/vcloud/extension/v1.5}VmVimObjectRef'
-                    ).find(
-                        '{http://www.vmware.com/vcloud/extension/v1.5}MoRef'
-                    ).text
-                    self.logger.info('Dispatching to reactioneer vm_mo_ref: {}'.format(vm_mo_ref))
-                    self.reaction_queue.put(vm_mo_ref)
-                else:
-                    self.logger.warning('Entity: {urn} has failed to be created. Skipping it.'.format(urn=entity))
-                resolver_queue.task_done()
+            if href:
+                status, vm_ref = self.execute_request(href, parser.find_vm_vim_ref)
+        if href and status == requests.codes.ok:
+            if vm_ref and vm_ref.mo_ref:
+                self.dispatch(item, vm_ref)
             else:
-                # Session lost to vcloud... Relogging in...
-                self.logger.debug("Probably session lost to vcloud. Reconnecting.")
-                self.login()
-                resolver_queue.put(entity)
-                resolver_queue.task_done()
+                self.logger.warning('Entity: {urn} has failed to be created. Skipping it.'.format(urn=entity))
+                item.done()
+        else:
+            # errors, expired sessions (renewed by VCS itself) or entities not resolvable yet: retried later.
+            self.logger.warning('Entity: {urn} cannot be resolved (HTTP status: {status}). Retrying it later.'.format(
+                urn=entity, status=status))
+            item.failed()
+
+    def dispatch(self, item, vm_ref):
+        """Hand a resolved VM to the Reactioneer of its vCenter."""
+        reaction_queue = self.reaction_queue
+        if self.router is not None:
+            backend = self.router.route(vm_ref)
+            if backend is None:
+                # rejected once the retries are over, so it can be found in the dead letters.
+                item.failed()
+                return
+            reaction_queue = backend.reaction_queue
+        self.logger.info('Dispatching to reactioneer vm_mo_ref: {} (vCenter: {})'.format(vm_ref.mo_ref,
+                                                                                        vm_ref.server_name))
+        if self.journal is not None and item.key is not None:
+            self.journal.record(item.key, 'resolved', vm_ref.mo_ref)
+        reaction_queue.put(item.forward(vm_ref.mo_ref))
 
 
 def callback(ch, method, properties, body):
-    xml_msg = ET.fromstring(body)
-    if xml_msg.attrib['type'] == 'com/vmware/vcloud/event/vm/create':
-        entity_links = xml_msg.findall('{http://www.vmware.com/vcloud/extension/v1.5}EntityLink')
-        entity_id = filter(lambda entity: entity.attrib['type'] == 'vcloud:vm', entity_links)[0].attrib['id']
-        resolver_queue.put(entity_id)
+    notification_type, entity_id = parser.parse_notification(body, notification_types=[parser.VM_CREATE_EVENT])
+    if notification_type == parser.VM_CREATE_EVENT and entity_id:
+        resolver_queue.put(WorkItem(entity_id))
+
+
+class AckTracker(object):
+    """Delivery tags of a channel not settled yet.
+    The pipeline settles deliveries out of order: the broker is acknowledged with multiple=True up to the
+    highest tag below which every delivery is settled. Must only be used from the ioloop thread.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        # delivery tags in delivery order
+        self._pending = deque()
+        # delivery tag -> True if it has to be acknowledged, False if it has been rejected already
+        self._settled = {}
+
+    def delivered(self, delivery_tag):
+        self._pending.append(delivery_tag)
+
+    def settle(self, delivery_tag, ack=True):
+        self._settled[delivery_tag] = ack
+
+    def flush(self):
+        """Acknowledge the settled deliveries at the head of the channel.
+        :return: True if an ack has been sent.
+        """
+        last_ack = None
+        while self._pending and self._pending[0] in self._settled:
+            delivery_tag = self._pending.popleft()
+            if self._settled.pop(delivery_tag):
+                last_ack = delivery_tag
+        if last_ack is None:
+            return False
+        self.channel.basic_ack(delivery_tag=last_ack, multiple=True)
+        return True
+
+    def __len__(self):
+        return len(self._pending)
 
 
 class Watcher2(Thread):
@@ -81,21 +225,58 @@ class Watcher2(Thread):
     Base worker to abstract all connection and processing
     logic away for simplification
     """
-    def __init__(self, rabbitmq, username, password, queue='shepherd', durable=True):
+    def __init__(self, rabbitmq, username, password, queue='shepherd', durable=True, dedup=None, prefetch_count=1,
+                 consumers=1, ack_interval=0.5, max_retries=3, backpressure=None, journal=None):
         """
         Construct the worker
+        Messages are acknowledged only once their work item is done, i.e. after the DRS change is committed (or
+        when there is nothing to do). Failed items are published again with a retry count header, and rejected
+        after max_retries attempts.
+        :param dedup: optional core.dedup.Deduplicator settling repeated notifications of the same entity with the
+        outcome of the first one.
+        :param prefetch_count: unacknowledged messages the broker delivers to each consumer, i.e. the number of
+        notifications each consumer can have in flight through the pipeline.
+        :param consumers: number of consumers, each on its own channel of the connection.
+        :param ack_interval: seconds between two acknowledgements of the completed work items.
+        :param max_retries: publications of a failing notification before it is rejected.
+        :param backpressure: list of core.base.queues.BoundedQueue. Consumption stops while any of them is saturated
+        and resumes once all of them are relieved, leaving the backlog in the broker.
+        :param journal: optional core.journal.Journal recording the notifications received and their outcome.
         """
         # Call super process init
         super(Watcher2, self).__init__()
         # Set the process name
         self.name = 'Watcher2'
 
-        self.channel = None
+        self.channels = []
         self.connection = None
+        self.dedup = dedup
         self.username = username
         self.password = password
         self.queue = queue
         self.is_queue_durable = durable
+        self.prefetch_count = prefetch_count
+        self.consumers = consumers
+        self.ack_interval = ack_interval
+        self.max_retries = max_retries
+        self.backpressure = backpressure or []
+        self.journal = journal
+        self.paused = False
+        # channel number -> consumer tag
+        self.consumer_tags = {}
+        # channel number -> AckTracker
+        self.trackers = {}
+        # outcomes of the work items, reported by the pipeline threads and applied in the ioloop.
+        self.completions = Queue.Queue()
+        # work items waiting for room in resolver_queue: the ioloop never blocks on a full queue.
+        self.overflow = deque()
+        self.received = registry.counter('watcher.received')
+        self.acks = registry.counter('watcher.acks')
+        self.retried = registry.counter('watcher.retried')
+        self.rejected = registry.counter('watcher.rejected')
+        self.pauses = registry.counter('watcher.pauses')
+        registry.gauge('watcher.in_flight', lambda: sum(len(tracker) for tracker in self.trackers.values()))
+        registry.gauge('watcher.overflow', lambda: len(self.overflow))
 
         self.parameters = pika.ConnectionParameters(
             host=rabbitmq,
@@ -126,7 +307,9 @@ class Watcher2(Thread):
         self.logger.debug('Stopping')
         try:
             # Gracefully close the connection
-            self.channel.stop_consuming()
+            self.apply_completions()
+            for channel in self.channels:
+                channel.stop_consuming()
             self.connection.close()
             # Loop until we're fully closed, will stop on its own
             self.connection.ioloop.start()
@@ -165,79 +348,191 @@ class Watcher2(Thread):
         """
         # Save new connection
         self.connection = new_connection
+        # unacknowledged deliveries of a previous connection are redelivered by the broker.
+        self.channels = []
+        self.trackers = {}
+        self.consumer_tags = {}
+        self.paused = False
         # Add callbacks
-        self.connection.channel(self.on_channel_open)
+        for _ in range(self.consumers):
+            self.connection.channel(self.on_channel_open)
         self.connection.add_on_close_callback(self.on_connection_closed)
+        self.connection.add_timeout(self.ack_interval, self.on_ack_timer)
 
     def on_channel_open(self, new_channel):
         """
         Callback for when a channel is opened
         """
         # Save new channel
-        self.channel = new_channel
+        self.channels.append(new_channel)
+        self.trackers[new_channel.channel_number] = AckTracker(new_channel)
         # Setup channel
-        self.channel.queue_declare(
+        new_channel.queue_declare(
             queue=self.queue,
             durable=self.is_queue_durable,
-            callback=self.on_queue_declared,
+            callback=lambda frame: self.on_queue_declared(new_channel, frame),
         )
 
-    def on_queue_declared(self, frame):
+    def on_queue_declared(self, channel, frame):
         """
         Callback for when a queue is declared
         """
+        # Set the prefetch before consuming, so the first burst already honours it
+        channel.basic_qos(prefetch_count=self.prefetch_count)
+
         # Declare callback for consuming from queue
-        self.channel.basic_consume(self.on_message, queue=self.queue)
+        if not self.paused:
+            self.consume(channel)
 
-        # Set additional options on queue: 1 msg at a time
-        self.channel.basic_qos(prefetch_count=1)
+    def consume(self, channel):
+        self.consumer_tags[channel.channel_number] = channel.basic_consume(self.on_message, queue=self.queue)
 
-    def on_message(self, channel, method, header, body):
+    def pause(self, reason):
+        """Cancel the consumers: the broker keeps the backlog until resume."""
+        if self.paused:
+            return
+        self.logger.warning('{}. Pausing consumption.'.format(reason))
+        for channel in self.channels:
+            consumer_tag = self.consumer_tags.get(channel.channel_number)
+            if consumer_tag is not None and channel.is_open:
+                # without a CancelOk callback pika requires nowait: deliveries already sent are still handled.
+                channel.basic_cancel(consumer_tag=consumer_tag, nowait=True)
+            self.consumer_tags.pop(channel.channel_number, None)
+        self.paused = True
+        self.pauses.inc()
+
+    def apply_backpressure(self):
+        """Stop consuming while a downstream queue is saturated or items overflow resolver_queue, resume once all
+        the queues are relieved and the overflow is drained.
         """
-        Callback for when a message is received
+        saturated = [queue.name for queue in self.backpressure if queue.saturated()]
+        if saturated:
+            self.pause('Queues saturated: {}'.format(', '.join(saturated)))
+        elif self.paused and not self.overflow and all(queue.relieved() for queue in self.backpressure):
+            self.logger.info('Queues relieved. Resuming consumption.')
+            self.paused = False
+            for channel in self.channels:
+                if channel.is_open:
+                    self.consume(channel)
+
+    def complete(self, tracker, method, header, body, item, success):
+        """Completion callback of a work item: called from any thread, applied later in the ioloop."""
+        self.completions.put((tracker, method.delivery_tag, header, body, item, success))
+
+    def apply_completions(self):
+        """Settle the deliveries whose work item is complete and acknowledge them. Runs in the ioloop."""
+        while True:
+            try:
+                tracker, delivery_tag, header, body, item, success = self.completions.get_nowait()
+            except Queue.Empty:
+                break
+            if self.trackers.get(tracker.channel.channel_number) is not tracker or not tracker.channel.is_open:
+                # the channel has been closed meanwhile: the broker delivers the message again.
+                continue
+            if success:
+                tracker.settle(delivery_tag)
+                if self.journal is not None and item.key is not None:
+                    self.journal.complete(item.key, True)
+                continue
+            headers = dict(header.headers or {})
+            retries = headers.get(RETRIES_HEADER, 0) + 1
+            if retries > self.max_retries:
+                self.logger.error(str(self) + " - Max retries failed...")
+                # dead lettered if the queue has a dead letter exchange, dropped otherwise.
+                tracker.channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+                tracker.settle(delivery_tag, ack=False)
+                self.rejected.inc()
+                if self.journal is not None and item.key is not None:
+                    self.journal.complete(item.key, False, rejected=True)
+                continue
+            self.logger.warning(str(self) + " - Retrying ({}/{})...".format(retries, self.max_retries))
+            headers[RETRIES_HEADER] = retries
+            # requeued messages cannot be changed: publish a copy carrying the retry count, then ack the original.
+            tracker.channel.basic_publish(exchange='', routing_key=self.queue, body=body,
+                                          properties=pika.BasicProperties(headers=headers,
+                                                                          content_type=header.content_type,
+                                                                          delivery_mode=2))
+            tracker.settle(delivery_tag)
+            self.retried.inc()
+        for tracker in self.trackers.values():
+            if tracker.channel.is_open and tracker.flush():
+                self.acks.inc()
+
+    def dispatch(self, item):
+        """Hand a work item to the Resolver without blocking the ioloop. When resolver_queue is full the item waits
+        in the overflow, drained by on_ack_timer, and consumption is paused: the deliveries already prefetched are
+        all that can pile up.
         """
+        if not self.overflow:
+            try:
+                resolver_queue.put(item, block=False)
+                return
+            except Queue.Full:
+                pass
+        self.pause('Queue {} full'.format(resolver_queue.name))
+        self.overflow.append(item)
 
-        # Break when num retries is reached
-        if ('retries' in body and
-                body['retries'] == 3):
-            self.logger.error(str(self) + " - Max retries failed...")
+    def drain_overflow(self):
+        """Move the overflow to resolver_queue, in order, as long as it has room. Runs in the ioloop."""
+        while self.overflow:
+            try:
+                resolver_queue.put(self.overflow[0], block=False)
+            except Queue.Full:
+                return
+            self.overflow.popleft()
 
-            # ACK - Finished with message, fail or retry
-            channel.basic_ack(delivery_tag=method.delivery_tag)
-            return
+    def on_ack_timer(self):
+        """Acknowledge the deliveries completed since the last run and check the downstream queues."""
+        self.apply_completions()
+        self.drain_overflow()
+        self.apply_backpressure()
+        self.connection.add_timeout(self.ack_interval, self.on_ack_timer)
 
+    def on_message(self, channel, method, header, body):
+        """
+        Callback for when a message is received
+        """
+        self.received.inc()
+        tracker = self.trackers[channel.channel_number]
+        tracker.delivered(method.delivery_tag)
+        item = WorkItem(None, on_complete=lambda success: self.complete(tracker, method, header, body, item, success))
         try:
             # Dispatch the processing of the message
-            self.process(body)
-        except ParseError:
+            self.process(body, item)
+        except parser.ParseError:
             self.logger.error('Cannot parse message. Removing it.')
-            pass
+            item.done()
         except Exception as e:
             self.logger.error(e)
-            self.logger.error(str(self) + " - Retrying...")
-
-            # Upset retries
-            if 'retries' not in body:
-                body['retries'] = 1
-            else:
-                retries = body['retries']
-                body['retries'] = retries + 1
-
-        # Always ack, finished with message, fail or retry
-        channel.basic_ack(delivery_tag=method.delivery_tag)
+            item.failed()
 
-    def process(self, message):
+    def process(self, message, item):
         """
         Method called to do something with the received message,
         to be implemented by extending classes
+        :param item: WorkItem of the message, to be dispatched or completed.
         """
-        xml_msg = ET.fromstring(message)
-        if xml_msg.attrib['type'] == 'com/vmware/vcloud/event/vm/create':
-            self.logger.info('Received a message containing a VM Create Action. Processing...')
-            entity_links = xml_msg.findall('{http://www.vmware.com/vcloud/extension/v1.5}EntityLink')
-            entity_id = filter(lambda entity: entity.attrib['type'] == 'vcloud:vm', entity_links)[0].attrib['id']
-            resolver_queue.put(entity_id)
-            self.logger.info("Entity ID: {} dispatched to resolver.".format(entity_id))
+        notification_type, entity_id = parser.parse_notification(message,
+                                                                 notification_types=[parser.VM_CREATE_EVENT])
+        if notification_type != parser.VM_CREATE_EVENT:
+            item.done()
+            return
+        self.logger.debug('Received a message containing a VM Create Action. Processing...')
+        if not entity_id:
+            self.logger.warning('VM Create Action without vcloud:vm entity. Skipping it.')
+            item.done()
+            return
+        if self.dedup is not None:
+            if not self.dedup.acquire(entity_id, item):
+                # acknowledged once the notification in flight is complete, retried with it if it fails.
+                self.logger.debug("Entity ID: {} already dispatched. Skipping it.".format(entity_id))
+                return
+            item.add_done_callback(lambda success: self.dedup.settle(entity_id, success))
+        item.key = entity_id
+        if self.journal is not None:
+            self.journal.record(entity_id, 'received')
+        self.dispatch(item.forward(entity_id))
+        self.logger.debug("Entity ID: {} dispatched to resolver.".format(entity_id))
 
     def on_connection_closed(self, frame):
         """
@@ -0,0 +1,65 @@
+__author__ = 'alessio.rocchi'
+
+from threading import Lock
+
+
+class WorkItem(object):
+    """A notification travelling through Watcher2, Resolver, Reactioneer and Executor.
+    The payload changes at every stage (entity URN, VM MoRef, vim.VirtualMachine) while the completion callback
+    of the AMQP delivery it came from travels along. The stage that finishes with the item, successfully or not,
+    reports the outcome: only the first outcome reported counts.
+    """
+    def __init__(self, payload, on_complete=None):
+        """
+        :param payload: what the next stage works on.
+        :param on_complete: optional callable(success) invoked once with the outcome of the item.
+        """
+        self.payload = payload
+        # identity of the notification (the entity URN), set by the stage that accepts it.
+        self.key = None
+        self.completed = False
+        # outcome of the item, once completed.
+        self.success = None
+        self._on_complete = on_complete
+        self._callbacks = []
+        self._lock = Lock()
+
+    def forward(self, payload):
+        """Replace the payload before handing the item to the next stage.
+        :return: the item itself.
+        """
+        self.payload = payload
+        return self
+
+    def add_done_callback(self, callback):
+        """Call callback(success) once the item is complete, right away if it already is.
+        Lets a stage release what it holds for the item (e.g. its dedup key) whichever stage completes it.
+        """
+        with self._lock:
+            if not self.completed:
+                self._callbacks.append(callback)
+                return
+        callback(self.success)
+
+    def _complete(self, success):
+        with self._lock:
+            if self.completed:
+                return
+            self.completed = True
+            self.success = success
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(success)
+        if self._on_complete is not None:
+            self._on_complete(success)
+
+    def done(self):
+        """Nothing left to do for the item: the DRS change is committed, or none was needed."""
+        self._complete(True)
+
+    def failed(self):
+        """The item could not be handled: its notification is delivered again."""
+        self._complete(False)
+
+    def __repr__(self):
+        return 'WorkItem({!r})'.format(self.payload)
@@ -1,20 +1,34 @@
 __author__ = 'alessio.rocchi'
 
-from core.watcher import Watcher2, Resolver
+from core.watcher import Watcher2, Resolver, resolver_queue
 from core.reactioneer import Reactioneer
 from core.executor import Executor
 from core.guard import Guard as Guardian
-from threading import Event, Thread
+from core.base.sessionpool import VcSessionPool
+from core.inventory import Inventory
+from core.tasktracker import TaskTracker
+from core.router import Router, VcenterBackend
+from core.coordination import Coordinator, SqliteLeaseBackend, RabbitMQLeaseBackend
+from core.dedup import Deduplicator
+from core.journal import Journal
+from core.rules import Rule, RuleSet, default_rules
+from core.base.metrics import registry
+from core.base.queues import BoundedQueue
+from core.workitem import WorkItem
+from threading import Event, Thread, Timer
 from daemonize import Daemonize
 from argparse import ArgumentParser
 from rofl import text
 import ConfigParser
-import Queue
+import socket
 import sys
+import time
 
 import logging
 
 pid = "/var/run/shep.pid"
+# --name of the process, part of the node name in coordination mode.
+node_name = None
 
 logFormatter = logging.Formatter("%(asctime)s [%(name)-32.32s] [%(threadName)-11.11s] [%(levelname)-7.7s]  %(message)s")
 rootLogger = logging.getLogger('shepherd')
@@ -31,8 +45,8 @@ rootLogger.addHandler(fileHandler)
 
 keep_fds = [fileHandler.stream.fileno()]
 
-reaction_queue = Queue.Queue()
-executor_queue = Queue.Queue()
+reaction_queue = BoundedQueue('reaction')
+executor_queue = BoundedQueue('executor')
 
 Config = ConfigParser.ConfigParser()
 Config.read('config.ini')
@@ -48,63 +62,269 @@ def config_section_map(section):
     return dict1
 
 
+def load_rules():
+    """Build the classification rules from the [rule:<name>] sections, in file order.
+    Without any rule section VMs whose guestFullName contains 'windows' go to the default Windows groups.
+    """
+    rules = []
+    for section in Config.sections():
+        if not section.startswith('rule:'):
+            continue
+        options = config_section_map(section)
+        unknown = set(options) - set(['host_group', 'vm_group', 'affinity_rule', 'guest_id', 'guest_full_name'])
+        if unknown:
+            # a predicate nothing can evaluate would silently match no VM.
+            raise ValueError('Unknown options in [{}]: {}. Rules match on guest_id and guest_full_name.'.format(
+                section, ', '.join(sorted(unknown))))
+        rules.append(Rule(section[len('rule:'):],
+                          host_group_name=options['host_group'],
+                          vm_group_name=options['vm_group'],
+                          affinity_rule_name=options['affinity_rule'],
+                          guest_id=options.get('guest_id'),
+                          guest_full_name=options.get('guest_full_name')))
+    return RuleSet(rules) if rules else default_rules()
+
+
+def configure_queue(queue, queues_config):
+    """Apply the [queues] options of a stage, e.g. executor_size and executor_policy, to its queue.
+    The queues of every vCenter, e.g. executor.<vcenter>, share the options of their stage.
+    """
+    stage = queue.name.split('.')[0]
+    queue.configure(maxsize=int(queues_config.get('{}_size'.format(stage), 0)),
+                    policy=queues_config.get('{}_policy'.format(stage), 'block'),
+                    # dropped notifications are published again, so they are deferred rather than lost.
+                    on_drop=WorkItem.failed,
+                    high_watermark=float(queues_config.get('high_watermark', 0.8)),
+                    low_watermark=float(queues_config.get('low_watermark', 0.5)))
+
+
 class Supervisor(Thread):
-    def __init__(self, event):
+    def __init__(self, event, interval=60):
         super(Supervisor, self).__init__()
         self.name = "Supervisor"
         self.stop = event
+        self.interval = interval
+        self.daemon = True
         self.logger = logging.getLogger('shepherd.Supervisor')
 
+    def run(self):
+        while not self.stop.wait(self.interval):
+            for name, value in registry.snapshot().items():
+                self.logger.info('metric {}: {}'.format(name, value))
+
+
+def vcenter_configs():
+    """Return the vCenters to serve as a list of (name, options).
+    Every [vcenter:<name>] section is a vCenter, its options override the ones of [vcenter]. The VMs of a vCenter
+    are recognized by the VimServer ids listed in its vim_servers option, or by the VimServer name being <name>.
+    Without such sections [vcenter] is the only vCenter and serves every VM.
+    """
+    defaults = config_section_map('vcenter') if Config.has_section('vcenter') else {}
+    configs = []
+    for section in Config.sections():
+        if section.startswith('vcenter:'):
+            options = dict(defaults)
+            options.update(config_section_map(section))
+            configs.append((section[len('vcenter:'):], options))
+    return configs or [('vcenter', defaults)]
+
+
+def coordination_enabled():
+    return Config.has_section('coordination') and config_section_map('coordination').get('enabled', '0') == '1'
+
+
+def build_coordinator(rabbitmq_config):
+    """Build the Coordinator of this node from [coordination], None when the node runs alone.
+    The sqlite backend serves nodes on the same host, the rabbitmq one nodes sharing the [rabbitmq] broker.
+    """
+    if not coordination_enabled():
+        return None
+    coordination_config = config_section_map('coordination')
+    backend_name = coordination_config.get('backend', 'sqlite')
+    if backend_name == 'sqlite':
+        backend = SqliteLeaseBackend(coordination_config.get('path', '/var/lib/shepherd/coordination.db'))
+    elif backend_name == 'rabbitmq':
+        backend = RabbitMQLeaseBackend(host=rabbitmq_config['host'],
+                                       username=rabbitmq_config['username'],
+                                       password=rabbitmq_config['password'])
+    else:
+        raise ValueError('Unknown coordination backend: {}. Expected sqlite or rabbitmq.'.format(backend_name))
+    node = coordination_config.get('node') or '{}-{}'.format(socket.gethostname(), node_name)
+    return Coordinator(backend, node,
+                       ttl=int(coordination_config.get('ttl', 30)),
+                       interval=int(coordination_config.get('interval', 10)),
+                       lease_timeout=int(coordination_config.get('lease_timeout', 60)))
+
+
+def build_backend(name, vcenter_config, reaction_queue, executor_queue, guardian_event, rules, journal,
+                  rabbitmq_config, executor_config, guard_config, dedup_config, suffix='', coordinator=None):
+    """Build the stages serving one vCenter, see VcenterBackend.
+    :param suffix: appended to the thread names, to tell the backends apart in the logs.
+    """
+    vc_pool = VcSessionPool(host=vcenter_config['vcenter'],
+                            username=vcenter_config['username'],
+                            password=vcenter_config['password'],
+                            size=int(vcenter_config.get('pool_size', 4)),
+                            keepalive=int(vcenter_config.get('keepalive', 300)))
+    vc_pool.start()
+
+    # MoRefs are unique per vCenter only: every backend has its own dedup stage.
+    mo_ref_dedup = Deduplicator('mo_refs{}'.format(suffix),
+                                ttl=int(dedup_config.get('ttl', 300)),
+                                maxsize=int(dedup_config.get('maxsize', 10000)))
+
+    inventory = None
+    if vcenter_config.get('inventory', '1') == '1':
+        inventory = Inventory(vc_pool)
+
+    tracker = None
+    if vcenter_config.get('task_tracker', '1') == '1':
+        tracker = TaskTracker(vc_pool, max_wait=int(vcenter_config.get('task_max_wait', 30)))
+    task_timeout = int(vcenter_config.get('task_timeout', 600))
+
+    reactioneer = Reactioneer(reaction_queue, executor_queue, vc_pool, dispatch_any=rabbitmq_config['dispatch_any'],
+                              dedup=mo_ref_dedup, journal=journal, rules=rules)
+
+    executor = Executor(pool=vc_pool,
+                        executor_queue=executor_queue,
+                        create_affinity_rule=executor_config['create_affinity'],
+                        batch_window=float(executor_config.get('batch_window', 2)),
+                        batch_size=int(executor_config.get('batch_size', 100)),
+                        inventory=inventory,
+                        rules=rules,
+                        tracker=tracker,
+                        task_timeout=task_timeout,
+                        coordinator=coordinator)
+
+    guardian = Guardian(pool=vc_pool,
+                        event=guardian_event,
+                        inventory=inventory,
+                        wait_time=int(guard_config.get('wait_time', 3600)),
+                        reconcile_interval=int(guard_config.get('reconcile_interval', 5)),
+                        settle_time=int(guard_config.get('settle_time', 60)),
+                        workers=int(guard_config.get('workers', 4)),
+                        rules=rules,
+                        tracker=tracker,
+                        task_timeout=task_timeout,
+                        coordinator=coordinator)
+
+    for thread in (inventory, tracker, reactioneer, executor, guardian):
+        if thread is not None:
+            thread.name += suffix
+
+    server_ids = [server_id.strip() for server_id in vcenter_config.get('vim_servers', '').split(',')
+                  if server_id.strip()]
+    return VcenterBackend(name, vc_pool, reaction_queue, executor_queue, reactioneer, executor, guardian,
+                          inventory=inventory, tracker=tracker, server_ids=server_ids)
+
 
 def main():
+    # entities journaled before were in flight when the daemon stopped.
+    started = time.time()
     rootLogger.info(text)
     rabbitmq_config = config_section_map("rabbitmq")
     vcloud_config = config_section_map("vcloud")
-    vcenter_config = config_section_map("vcenter")
     executor_config = config_section_map("executor")
+    guard_config = config_section_map("guard") if Config.has_section("guard") else {}
+    dedup_config = config_section_map("dedup") if Config.has_section("dedup") else {}
+    queues_config = config_section_map("queues") if Config.has_section("queues") else {}
+    rules = load_rules()
+    journal_config = config_section_map("journal") if Config.has_section("journal") else {}
+
+    entity_dedup = Deduplicator('entities',
+                                ttl=int(dedup_config.get('ttl', 300)),
+                                maxsize=int(dedup_config.get('maxsize', 10000)))
+
+    journal = None
+    if journal_config.get('enabled', '0') == '1':
+        journal = Journal(journal_config.get('path', '/var/lib/shepherd/journal.db'),
+                          retention=int(journal_config.get('retention', 3600)),
+                          compact_interval=int(journal_config.get('compact_interval', 300)),
+                          max_retries=int(rabbitmq_config.get('max_retries', 3)),
+                          retry_delay=int(journal_config.get('retry_delay', 30)))
+        journal.start()
+
+    coordinator = build_coordinator(rabbitmq_config)
+    if coordinator is not None:
+        coordinator.start()
+
+    guardian_event = Event()
+    vcenters = vcenter_configs()
+    router = Router()
+    for name, vcenter_config in vcenters:
+        if len(vcenters) == 1:
+            queues, suffix = (reaction_queue, executor_queue), ''
+        else:
+            queues = (BoundedQueue('reaction.{}'.format(name)), BoundedQueue('executor.{}'.format(name)))
+            suffix = '-{}'.format(name)
+        router.add(build_backend(name, vcenter_config, queues[0], queues[1], guardian_event, rules, journal,
+                                 rabbitmq_config, executor_config, guard_config, dedup_config, suffix=suffix,
+                                 coordinator=coordinator))
+        rootLogger.info('vCenter: {} ({}) served for VimServers: {}.'.format(
+            name, vcenter_config['vcenter'], ', '.join(router.backends[-1].server_ids) or name
+        ))
+
+    for queue in [resolver_queue] + router.queues:
+        configure_queue(queue, queues_config)
 
     watch = Watcher2(rabbitmq=rabbitmq_config['host'],
                      username=rabbitmq_config['username'],
-                     password=rabbitmq_config['password'])
+                     password=rabbitmq_config['password'],
+                     dedup=entity_dedup,
+                     prefetch_count=int(rabbitmq_config.get('prefetch_count', 1)),
+                     consumers=int(rabbitmq_config.get('consumers', 1)),
+                     ack_interval=float(rabbitmq_config.get('ack_interval', 0.5)),
+                     max_retries=int(rabbitmq_config.get('max_retries', 3)),
+                     backpressure=[resolver_queue] + router.queues,
+                     journal=journal)
 
     resolver = Resolver(host=vcloud_config['vcloud'],
                         username=vcloud_config['username'],
                         password=vcloud_config['password'],
-                        reaction_queue=reaction_queue)
-
-    reactioneer = Reactioneer(reaction_queue, executor_queue, dispatch_any=rabbitmq_config['dispatch_any'])
+                        reaction_queue=None,
+                        pool_maxsize=int(vcloud_config.get('pool_maxsize', 10)),
+                        workers=int(vcloud_config.get('resolver_workers', 4)),
+                        max_in_flight=int(vcloud_config.get('max_in_flight', 8)),
+                        fast_path=vcloud_config.get('fast_path', '1') == '1',
+                        partition_size=int(queues_config.get('partition_size', 100)),
+                        journal=journal,
+                        router=router)
 
-    executor = Executor(host=vcenter_config['vcenter'],
-                        username=vcenter_config['username'],
-                        password=vcenter_config['password'],
-                        executor_queue=executor_queue,
-                        create_affinity_rule=executor_config['create_affinity'])
-
-    guardian_event = Event()
-    guardian = Guardian(host=vcenter_config['vcenter'],
-                        username=vcenter_config['username'],
-                        password=vcenter_config['password'],
-                        event=guardian_event)
+    supervisor = Supervisor(guardian_event)
 
     resolver.start()
     watch.start()
-    reactioneer.start()
-    executor.start()
-    guardian.start()
+    for backend in router.backends:
+        backend.start()
+    supervisor.start()
+
+    if journal is not None:
+        # what was in flight when the daemon stopped and the broker did not deliver again, once the stages consume
+        # their queues: replaying into bounded queues before would block the startup.
+        replay = Timer(int(journal_config.get('replay_delay', 60)), journal.replay,
+                       (resolver_queue, router.backends[0].reaction_queue if len(router.backends) == 1 else None),
+                       {'before': started})
+        replay.daemon = True
+        replay.start()
 
     try:
         resolver.join()
         watch.join()
-        reactioneer.join()
-        executor.join()
-        guardian.join()
+        for backend in router.backends:
+            backend.join()
     except KeyboardInterrupt:
         rootLogger.info("Caught CTRL+C. Waiting for all threads to finish...")
         resolver.stop = True
         watch.stop = True
-        reactioneer.stop = True
-        executor.stop = True
-        guardian.stopped.set()
+        guardian_event.set()
+        for backend in router.backends:
+            backend.stop()
+        if coordinator is not None:
+            coordinator.stop = True
+        if journal is not None:
+            # commit the pending records before leaving.
+            journal.stop = True
+            journal.join()
 
 
 if __name__ == '__main__':
@@ -113,6 +333,10 @@ if __name__ == '__main__':
     parser.add_argument('--name', type=str, help='Vcloud Cell Name. This is only needed to identify the process',
                         required=True)
     p = parser.parse_args()
+    node_name = p.name
+    if coordination_enabled():
+        # several nodes may run on the same host.
+        pid = '/var/run/shep.{}.pid'.format(p.name)
     if p.daemon is True:
         daemon = Daemonize(app="shepherd", pid=pid, action=main, keep_fds=keep_fds)
         daemon.start()
@@ -0,0 +1,65 @@
+__author__ = 'alessio.rocchi'
+
+from vspherelib.capacity import CapacityEngine, CapacitySnapshot
+import unittest
+
+
+class FakeObject(object):
+    def __init__(self, mo_id):
+        self._moId = mo_id
+
+
+class FitsTest(unittest.TestCase):
+    def snapshot(self, host_capacities=None, num_cpus=None):
+        return CapacitySnapshot(single_host_max_mhz_capacity=10000, single_core_max_mhz_capacity=2500,
+                                worst_case_mhz_allocation=0, num_cpus=num_cpus, host_capacities=host_capacities)
+
+    def test_no_host_never_fits(self):
+        self.assertFalse(self.snapshot().fits([], 0))
+
+    def test_largest_host_is_kept_spare(self):
+        hosts = [FakeObject('host-1'), FakeObject('host-2')]
+        self.assertTrue(self.snapshot().fits(hosts, 10000))
+        self.assertFalse(self.snapshot().fits(hosts, 10001))
+
+    def test_hosts_of_different_sizes(self):
+        hosts = [FakeObject('host-1'), FakeObject('host-2'), FakeObject('host-3')]
+        snapshot = self.snapshot({'host-1': 20000, 'host-2': 10000})
+        # host-3 unknown: as large as the reference host. 40000 in all, 20000 kept spare.
+        self.assertTrue(snapshot.fits(hosts, 20000))
+        self.assertFalse(snapshot.fits(hosts, 20001))
+
+    def test_vm_mhz_prefers_the_given_num_cpu(self):
+        snapshot = self.snapshot(num_cpus={'vm-1': 2})
+        self.assertEqual(snapshot.vm_mhz(FakeObject('vm-1')), 5000)
+        self.assertEqual(snapshot.vm_mhz(FakeObject('vm-1'), num_cpu=4), 10000)
+        self.assertEqual(snapshot.vm_mhz(FakeObject('vm-2'), num_cpu=1), 2500)
+
+
+class ComputeTest(unittest.TestCase):
+    def test_worst_case_allocation_is_capped_by_pool_limits(self):
+        vms = {
+            'vm-1': {'config.guestFullName': 'Microsoft Windows Server 2012', 'config.hardware.numCPU': 4},
+            'vm-2': {'config.guestFullName': 'Microsoft Windows Server 2012', 'config.hardware.numCPU': 2},
+            'vm-3': {'config.guestFullName': 'CentOS 7', 'config.hardware.numCPU': 8},
+        }
+        rps = {
+            'rp-1': {'name': 'vdc-1', 'config.cpuAllocation.limit': 100000,
+                     'vm': [FakeObject('vm-1'), FakeObject('vm-3')]},
+            'rp-2': {'name': 'vdc-2', 'config.cpuAllocation.limit': 3000, 'vm': [FakeObject('vm-2')]},
+            'rp-3': {'name': 'Resources', 'config.cpuAllocation.limit': -1, 'vm': []},
+        }
+        hosts = {
+            'host-1': {'name': 'esx01', 'summary.hardware.cpuMhz': 2000, 'summary.hardware.numCpuCores': 16,
+                       'hardware.cpuInfo.hz': 2000000000},
+        }
+        snapshot = CapacityEngine(None).compute(rps, vms, hosts)
+        self.assertEqual(snapshot.single_host_max_mhz_capacity, 32000)
+        self.assertEqual(snapshot.single_core_max_mhz_capacity, 2000)
+        # 4 Windows vCPUs in vdc-1, 2 in vdc-2 capped to its 3000 Mhz limit.
+        self.assertEqual(snapshot.worst_case_mhz_allocation, 4 * 2000 + 3000)
+        self.assertEqual(snapshot.host_capacities, {'host-1': 32000})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+__author__ = 'alessio.rocchi'
+
+from core.coordination import HashRing, SqliteLeaseBackend
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class HashRingTest(unittest.TestCase):
+    keys = ['vc01/domain-c{}'.format(index) for index in range(500)]
+
+    def owners(self, ring):
+        return dict((key, ring.owner(key)) for key in self.keys)
+
+    def test_empty_ring_owns_nothing(self):
+        self.assertIsNone(HashRing([]).owner('vc01/domain-c1'))
+
+    def test_owner_does_not_depend_on_node_order(self):
+        self.assertEqual(self.owners(HashRing(['a', 'b', 'c'])), self.owners(HashRing(['c', 'a', 'b'])))
+
+    def test_every_node_owns_keys(self):
+        self.assertEqual(set(self.owners(HashRing(['a', 'b', 'c'])).values()), set(['a', 'b', 'c']))
+
+    def test_joining_node_only_takes_keys(self):
+        before = self.owners(HashRing(['a', 'b', 'c']))
+        after = self.owners(HashRing(['a', 'b', 'c', 'd']))
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(after[key] == 'd' for key in moved))
+
+    def test_leaving_node_only_gives_its_keys(self):
+        before = self.owners(HashRing(['a', 'b', 'c']))
+        after = self.owners(HashRing(['a', 'c']))
+        moved = [key for key in self.keys if before[key] != after[key]]
+        self.assertEqual(sorted(moved), sorted(key for key in self.keys if before[key] == 'b'))
+
+
+class SqliteLeaseBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = SqliteLeaseBackend(os.path.join(self.directory, 'coordination.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lease_is_exclusive_until_released(self):
+        self.assertTrue(self.backend.acquire('vc01/domain-c1', 'a', ttl=30))
+        self.assertFalse(self.backend.acquire('vc01/domain-c1', 'b', ttl=30))
+        # renewal by the holder.
+        self.assertTrue(self.backend.acquire('vc01/domain-c1', 'a', ttl=30))
+        self.backend.release('vc01/domain-c1', 'a')
+        self.assertTrue(self.backend.acquire('vc01/domain-c1', 'b', ttl=30))
+
+    def test_release_by_another_node_is_ignored(self):
+        self.backend.acquire('vc01/domain-c1', 'a', ttl=30)
+        self.backend.release('vc01/domain-c1', 'b')
+        self.assertFalse(self.backend.acquire('vc01/domain-c1', 'b', ttl=30))
+
+    def test_lease_expires(self):
+        self.backend.acquire('vc01/domain-c1', 'a', ttl=0.05)
+        time.sleep(0.1)
+        self.assertTrue(self.backend.acquire('vc01/domain-c1', 'b', ttl=30))
+
+    def test_members_expire(self):
+        self.backend.heartbeat('a', ttl=30)
+        self.backend.heartbeat('b', ttl=0.05)
+        self.assertEqual(sorted(self.backend.members()), ['a', 'b'])
+        time.sleep(0.1)
+        self.assertEqual(self.backend.members(), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
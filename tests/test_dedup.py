@@ -0,0 +1,67 @@
+__author__ = 'alessio.rocchi'
+
+from core.dedup import Deduplicator
+from core.workitem import WorkItem
+import time
+import unittest
+
+
+class DeduplicatorTest(unittest.TestCase):
+    def setUp(self):
+        self.outcomes = []
+
+    def item(self, name):
+        return WorkItem(name, on_complete=lambda success: self.outcomes.append((name, success)))
+
+    def claim(self, dedup, key, name):
+        item = self.item(name)
+        claimed = dedup.acquire(key, item)
+        if claimed:
+            item.add_done_callback(lambda success: dedup.settle(key, success))
+        return claimed, item
+
+    def test_settled_key_is_duplicate_within_ttl(self):
+        dedup = Deduplicator('test-ttl', ttl=0.1)
+        claimed, first = self.claim(dedup, 'vm-1', 'first')
+        self.assertTrue(claimed)
+        first.done()
+        claimed, _ = self.claim(dedup, 'vm-1', 'second')
+        self.assertFalse(claimed)
+        self.assertEqual(self.outcomes, [('first', True), ('second', True)])
+
+    def test_settled_key_expires_after_ttl(self):
+        dedup = Deduplicator('test-expiry', ttl=0.05)
+        _, first = self.claim(dedup, 'vm-1', 'first')
+        first.done()
+        time.sleep(0.1)
+        claimed, _ = self.claim(dedup, 'vm-1', 'second')
+        self.assertTrue(claimed)
+
+    def test_duplicate_waits_for_the_key_in_flight(self):
+        dedup = Deduplicator('test-in-flight')
+        _, first = self.claim(dedup, 'vm-1', 'first')
+        claimed, _ = self.claim(dedup, 'vm-1', 'second')
+        self.assertFalse(claimed)
+        self.assertEqual(self.outcomes, [])
+        first.done()
+        self.assertEqual(sorted(self.outcomes), [('first', True), ('second', True)])
+
+    def test_failure_fails_the_duplicates_and_is_not_remembered(self):
+        dedup = Deduplicator('test-failure')
+        _, first = self.claim(dedup, 'vm-1', 'first')
+        self.claim(dedup, 'vm-1', 'second')
+        first.failed()
+        self.assertEqual(sorted(self.outcomes), [('first', False), ('second', False)])
+        claimed, _ = self.claim(dedup, 'vm-1', 'third')
+        self.assertTrue(claimed)
+
+    def test_least_recently_settled_key_is_evicted(self):
+        dedup = Deduplicator('test-maxsize', maxsize=2)
+        for key in ('vm-1', 'vm-2', 'vm-3'):
+            self.claim(dedup, key, key)[1].done()
+        self.assertTrue(self.claim(dedup, 'vm-1', 'again')[0])
+        self.assertFalse(self.claim(dedup, 'vm-3', 'again')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
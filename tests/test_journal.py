@@ -0,0 +1,92 @@
+__author__ = 'alessio.rocchi'
+
+from core.journal import Journal
+import Queue
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = Journal(os.path.join(self.directory, 'journal.db'), flush_interval=0.01, max_retries=2,
+                               retry_delay=0.01)
+        self.journal.start()
+        self.resolver_queue = Queue.Queue()
+        self.reaction_queue = Queue.Queue()
+
+    def tearDown(self):
+        self.journal.stop = True
+        self.journal.join()
+        shutil.rmtree(self.directory)
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                self.fail('Condition not met within {}s.'.format(timeout))
+            time.sleep(0.01)
+
+    def state(self, key):
+        """Return the committed state of an unfinished entity, None if it is finished or unknown."""
+        return dict((entry[0], entry[1]) for entry in self.journal.pending()).get(key)
+
+    def committed(self, key, state):
+        self.wait_for(lambda: self.state(key) == state)
+
+    def test_replay_routes_by_state(self):
+        self.journal.record('urn:3', 'received')
+        self.journal.record('urn:3', 'applied')
+        self.journal.record('urn:1', 'received')
+        self.journal.record('urn:2', 'received')
+        self.journal.record('urn:2', 'found', 'vm-2')
+        # writes are committed in order: the last one is enough.
+        self.committed('urn:2', 'found')
+        self.assertEqual(self.journal.replay(self.resolver_queue, self.reaction_queue), 2)
+        received = self.resolver_queue.get_nowait()
+        found = self.reaction_queue.get_nowait()
+        self.assertEqual((received.key, received.payload), ('urn:1', 'urn:1'))
+        self.assertEqual((found.key, found.payload), ('urn:2', 'vm-2'))
+        self.assertTrue(self.resolver_queue.empty() and self.reaction_queue.empty())
+
+    def test_without_reaction_queue_everything_is_resolved_again(self):
+        self.journal.record('urn:1', 'found', 'vm-1')
+        self.committed('urn:1', 'found')
+        self.journal.replay(self.resolver_queue)
+        self.assertEqual(self.resolver_queue.get_nowait().payload, 'urn:1')
+
+    def test_entities_recorded_since_before_are_skipped(self):
+        self.journal.record('urn:1', 'received')
+        time.sleep(0.01)
+        started = time.time()
+        # delivered again by the broker after the start.
+        self.journal.record('urn:2', 'received')
+        self.committed('urn:2', 'received')
+        self.assertEqual(self.journal.replay(self.resolver_queue, before=started), 1)
+        self.assertEqual(self.resolver_queue.get_nowait().key, 'urn:1')
+
+    def test_success_is_recorded_as_applied(self):
+        self.journal.record('urn:1', 'received')
+        self.committed('urn:1', 'received')
+        self.journal.replay(self.resolver_queue)
+        self.resolver_queue.get_nowait().done()
+        self.committed('urn:1', None)
+
+    def test_failures_are_retried_then_rejected(self):
+        self.journal.record('urn:1', 'received')
+        self.committed('urn:1', 'received')
+        self.journal.replay(self.resolver_queue)
+        self.resolver_queue.get_nowait().failed()
+        retry = self.resolver_queue.get(timeout=5)
+        self.assertEqual(retry.key, 'urn:1')
+        self.assertEqual(self.state('urn:1'), 'received')
+        retry.failed()
+        self.committed('urn:1', None)
+        self.assertTrue(self.resolver_queue.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+__author__ = 'alessio.rocchi'
+
+from vcloudlib import parser
+import unittest
+
+NOTIFICATION = """<?xml version="1.0" encoding="UTF-8"?>
+<vmext:Notification xmlns:vmext="http://www.vmware.com/vcloud/extension/v1.5" type="{type}">
+    <vmext:Link rel="down" type="vcloud:user" name="system" id="urn:vcloud:user:1"/>
+    <vmext:EntityLink rel="entityResolver" type="vcloud:vapp" name="vApp" id="urn:vcloud:vapp:2"/>
+    <vmext:EntityLink rel="entity" type="vcloud:vm" name="vm" id="urn:vcloud:vm:3"/>
+</vmext:Notification>"""
+
+ENTITY = """<?xml version="1.0" encoding="UTF-8"?>
+<Entity xmlns="http://www.vmware.com/vcloud/v1.5" name="urn:vcloud:vm:3">
+    <Link rel="alternate" type="application/vnd.vmware.vcloud.vm+xml" href="https://vcloud/api/vApp/vm-3"/>
+    <Link rel="up" type="application/vnd.vmware.vcloud.entities+xml" href="https://vcloud/api/entity/"/>
+</Entity>"""
+
+VM = """<?xml version="1.0" encoding="UTF-8"?>
+<Vm xmlns="http://www.vmware.com/vcloud/v1.5" xmlns:vmext="http://www.vmware.com/vcloud/extension/v1.5" name="vm">
+    <Link rel="up" href="https://vcloud/api/vApp/vapp-2"/>
+    <VCloudExtension required="false">
+        <vmext:VmVimInfo>
+            <vmext:VmVimObjectRef>
+                <vmext:VimServerRef type="application/vnd.vmware.admin.vmwvirtualcenter+xml" name="vc01"
+                    href="https://vcloud/api/admin/extension/vimServer/0f7a3c52"/>
+                <vmext:MoRef>vm-42</vmext:MoRef>
+                <vmext:VimObjectType>VIRTUAL_MACHINE</vmext:VimObjectType>
+            </vmext:VmVimObjectRef>
+        </vmext:VmVimInfo>
+    </VCloudExtension>
+</Vm>"""
+
+
+class ParserTest(unittest.TestCase):
+    def test_vm_create_notification(self):
+        document = NOTIFICATION.format(type=parser.VM_CREATE_EVENT)
+        self.assertEqual(parser.parse_notification(document, notification_types=[parser.VM_CREATE_EVENT]),
+                         (parser.VM_CREATE_EVENT, 'urn:vcloud:vm:3'))
+
+    def test_other_notifications_are_not_parsed_further(self):
+        document = NOTIFICATION.format(type='com/vmware/vcloud/event/vm/modify')
+        self.assertEqual(parser.parse_notification(document, notification_types=[parser.VM_CREATE_EVENT]),
+                         ('com/vmware/vcloud/event/vm/modify', None))
+
+    def test_malformed_notification(self):
+        self.assertRaises(parser.ParseError, parser.parse_notification, '<vmext:Notification')
+
+    def test_first_link_of_the_root(self):
+        self.assertEqual(parser.find_link_href(ENTITY), 'https://vcloud/api/vApp/vm-3')
+
+    def test_vm_vim_ref(self):
+        self.assertEqual(parser.find_vm_vim_ref(VM), parser.VimRef('vm-42', '0f7a3c52', 'vc01'))
+
+    def test_vm_without_vim_info(self):
+        self.assertIsNone(parser.find_vm_vim_ref('<Vm xmlns="http://www.vmware.com/vcloud/v1.5"/>'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+__author__ = 'alessio.rocchi'
+
+from core.base.queues import BoundedQueue
+import Queue
+import unittest
+
+
+class BoundedQueueTest(unittest.TestCase):
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, BoundedQueue, 'test-unknown', 10, 'spill')
+
+    def test_block_policy_refuses_past_maxsize(self):
+        queue = BoundedQueue('test-block', maxsize=2, policy='block')
+        queue.put(1)
+        queue.put(2)
+        self.assertRaises(Queue.Full, queue.put, 3, block=False)
+
+    def test_drop_oldest_policy(self):
+        dropped = []
+        queue = BoundedQueue('test-drop', maxsize=2, policy='drop_oldest', on_drop=dropped.append)
+        for item in (1, 2, 3):
+            queue.put(item)
+        self.assertEqual(dropped, [1])
+        self.assertEqual([queue.get_nowait(), queue.get_nowait()], [2, 3])
+        queue.task_done()
+        queue.task_done()
+        # the dropped item is not waited for.
+        queue.join()
+
+    def test_unbounded_policy_never_refuses(self):
+        queue = BoundedQueue('test-unbounded', maxsize=2, policy='unbounded')
+        for item in range(5):
+            queue.put(item, block=False)
+        self.assertEqual(queue.qsize(), 5)
+        self.assertTrue(queue.saturated())
+
+    def test_watermarks(self):
+        queue = BoundedQueue('test-watermarks', maxsize=10, high_watermark=0.8, low_watermark=0.5)
+        for item in range(8):
+            queue.put(item)
+        self.assertTrue(queue.saturated())
+        self.assertFalse(queue.relieved())
+        for _ in range(3):
+            queue.get_nowait()
+        self.assertFalse(queue.saturated())
+        self.assertTrue(queue.relieved())
+
+    def test_unlimited_queue_is_never_saturated(self):
+        queue = BoundedQueue('test-unlimited')
+        for item in range(100):
+            queue.put(item)
+        self.assertFalse(queue.saturated())
+        self.assertTrue(queue.relieved())
+
+
+if __name__ == '__main__':
+    unittest.main()
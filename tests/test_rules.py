@@ -0,0 +1,50 @@
+__author__ = 'alessio.rocchi'
+
+from core.rules import Rule, RuleSet, default_rules
+import unittest
+
+
+class RuleSetTest(unittest.TestCase):
+    def setUp(self):
+        self.windows = Rule('windows', 'WindowsVM', 'Windows', 'WindowsAffinityRule', guest_full_name='windows')
+        self.sql = Rule('sql', 'SqlHosts', 'Sql', 'SqlAffinityRule', guest_id='^windows9', guest_full_name='2016')
+        self.rhel = Rule('rhel', 'RhelHosts', 'Rhel', 'RhelAffinityRule', guest_id='^rhel')
+        self.rules = RuleSet([self.windows, self.sql, self.rhel])
+
+    def test_rule_without_predicate(self):
+        self.assertRaises(ValueError, Rule, 'empty', 'Hosts', 'Vms', 'AffinityRule')
+
+    def test_rules_in_configuration_order(self):
+        self.assertEqual(self.rules.classify(guest_id='windows9Server64Guest',
+                                             guest_full_name='Microsoft Windows Server 2016 (64-bit)'),
+                         [self.windows, self.sql])
+
+    def test_every_predicate_must_match(self):
+        self.assertEqual(self.rules.classify(guest_id='windows8Server64Guest',
+                                             guest_full_name='Microsoft Windows Server 2016 (64-bit)'),
+                         [self.windows])
+
+    def test_case_insensitive(self):
+        self.assertEqual(self.rules.classify(guest_id='RHEL7_64Guest'), [self.rhel])
+
+    def test_missing_properties_match_nothing(self):
+        self.assertEqual(self.rules.classify(), [])
+
+    def test_properties_agree_with_classify(self):
+        props = {'config.guestId': 'rhel7_64Guest', 'config.guestFullName': 'Red Hat Enterprise Linux 7 (64-bit)'}
+        self.assertEqual(self.rules.classify_properties(props), [self.rhel])
+        self.assertTrue(self.rhel.matches(props))
+        self.assertFalse(self.windows.matches(props))
+
+    def test_by_name(self):
+        self.assertIs(self.rules.by_name('sql'), self.sql)
+        self.assertRaises(KeyError, self.rules.by_name, 'missing')
+
+    def test_default_rules_escape_the_pattern(self):
+        rules = default_rules(pattern='windows (64')
+        self.assertEqual(len(rules.classify(guest_full_name='Microsoft Windows (64-bit)')), 1)
+        self.assertEqual(rules.classify(guest_full_name='Microsoft Windows 2016'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
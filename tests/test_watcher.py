@@ -0,0 +1,153 @@
+__author__ = 'alessio.rocchi'
+
+from core.watcher import AckTracker, Watcher2, resolver_queue
+from core.workitem import WorkItem
+import Queue
+import unittest
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+
+class FakeConsumerChannel(FakeChannel):
+    """Consumer side of a pika 0.13 channel."""
+    channel_number = 1
+    is_open = True
+
+    def __init__(self):
+        super(FakeConsumerChannel, self).__init__()
+        self.consumers = set()
+        self.consumed = 0
+
+    def basic_consume(self, consumer_callback, queue=''):
+        self.consumed += 1
+        consumer_tag = 'ctag{}'.format(self.consumed)
+        self.consumers.add(consumer_tag)
+        return consumer_tag
+
+    def basic_cancel(self, callback=None, consumer_tag='', nowait=False):
+        if not nowait and callback is None:
+            raise ValueError('Must have completion callback with nowait=False')
+        self.consumers.discard(consumer_tag)
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.timeouts = []
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append(callback)
+
+
+class OfflineWatcher(Watcher2):
+    def connect(self):
+        self.connection = FakeConnection()
+
+
+class AckTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.channel = FakeChannel()
+        self.tracker = AckTracker(self.channel)
+        for delivery_tag in (1, 2, 3, 4):
+            self.tracker.delivered(delivery_tag)
+
+    def test_nothing_settled(self):
+        self.assertFalse(self.tracker.flush())
+        self.assertEqual(self.channel.acks, [])
+        self.assertEqual(len(self.tracker), 4)
+
+    def test_acks_up_to_the_first_unsettled(self):
+        self.tracker.settle(1)
+        self.tracker.settle(2)
+        self.tracker.settle(4)
+        self.assertTrue(self.tracker.flush())
+        self.assertEqual(self.channel.acks, [(2, True)])
+        self.assertEqual(len(self.tracker), 2)
+
+    def test_out_of_order_settlement_waits_for_the_head(self):
+        self.tracker.settle(3)
+        self.tracker.settle(2)
+        self.assertFalse(self.tracker.flush())
+        self.tracker.settle(1)
+        self.assertTrue(self.tracker.flush())
+        self.assertEqual(self.channel.acks, [(3, True)])
+        self.assertEqual(len(self.tracker), 1)
+
+    def test_rejected_deliveries_are_not_acked(self):
+        self.tracker.settle(1)
+        self.tracker.settle(2, ack=False)
+        self.assertTrue(self.tracker.flush())
+        self.assertEqual(self.channel.acks, [(1, True)])
+        # a rejected delivery at the head lets the following ones through.
+        self.tracker.settle(3)
+        self.assertTrue(self.tracker.flush())
+        self.assertEqual(self.channel.acks, [(1, True), (3, True)])
+
+    def test_only_rejected_sends_nothing(self):
+        self.tracker.settle(1, ack=False)
+        self.assertFalse(self.tracker.flush())
+        self.assertEqual(self.channel.acks, [])
+        self.assertEqual(len(self.tracker), 3)
+
+
+class Watcher2BackpressureTest(unittest.TestCase):
+    def setUp(self):
+        resolver_queue.configure(10, 'block', high_watermark=0.8, low_watermark=0.5)
+        self.channel = FakeConsumerChannel()
+        self.watcher = OfflineWatcher('rabbitmq', 'guest', 'guest', backpressure=[resolver_queue])
+        self.watcher.channels = [self.channel]
+        self.watcher.trackers = {self.channel.channel_number: AckTracker(self.channel)}
+        self.watcher.consume(self.channel)
+
+    def tearDown(self):
+        while True:
+            try:
+                resolver_queue.get_nowait()
+            except Queue.Empty:
+                break
+        resolver_queue.configure()
+
+    def take(self, count):
+        return [resolver_queue.get_nowait().payload for _ in range(count)]
+
+    def test_full_queue_pauses_and_overflow_resumes_in_order(self):
+        for index in range(12):
+            self.watcher.dispatch(WorkItem(index))
+        self.assertTrue(self.watcher.paused)
+        self.assertEqual(self.channel.consumers, set())
+        self.assertEqual([item.payload for item in self.watcher.overflow], [10, 11])
+
+        self.watcher.on_ack_timer()
+        self.assertTrue(self.watcher.paused)
+        self.assertEqual(len(self.watcher.connection.timeouts), 1)
+
+        self.assertEqual(self.take(7), range(7))
+        # two items of the overflow join the three left: 5 is the low watermark.
+        self.watcher.on_ack_timer()
+        self.assertFalse(self.watcher.overflow)
+        self.assertFalse(self.watcher.paused)
+        self.assertEqual(len(self.channel.consumers), 1)
+        self.assertEqual(len(self.watcher.connection.timeouts), 2)
+        self.assertEqual(self.take(5), range(7, 12))
+
+    def test_saturated_queue_pauses_from_the_ack_timer(self):
+        for index in range(8):
+            self.watcher.dispatch(WorkItem(index))
+        self.assertFalse(self.watcher.paused)
+        self.watcher.on_ack_timer()
+        self.assertTrue(self.watcher.paused)
+        self.assertEqual(self.channel.consumers, set())
+        self.assertEqual(len(self.watcher.connection.timeouts), 1)
+        self.take(3)
+        self.watcher.on_ack_timer()
+        self.assertFalse(self.watcher.paused)
+        self.assertEqual(len(self.channel.consumers), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+Incremental parsing of vCloud notifications and entity documents.
+Documents are parsed with iterparse and parsing stops as soon as the element looked for is reached, so large
+VM documents (many NICs and disks) never cost a full DOM build. HTTP responses are parsed while they are read.
+"""
+__author__ = 'alessio.rocchi'
+
+from StringIO import StringIO
+from collections import namedtuple
+
+try:
+    from xml.etree import cElementTree as ET
+except ImportError:
+    from xml.etree import ElementTree as ET
+
+ParseError = ET.ParseError
+
+VCLOUD_NS = 'http://www.vmware.com/vcloud/v1.5'
+VCLOUD_EXTENSION_NS = 'http://www.vmware.com/vcloud/extension/v1.5'
+
+
+def _tag(namespace, name):
+    return '{%s}%s' % (namespace, name)
+
+
+VM_CREATE_EVENT = 'com/vmware/vcloud/event/vm/create'
+ENTITY_LINK = _tag(VCLOUD_EXTENSION_NS, 'EntityLink')
+LINK = _tag(VCLOUD_NS, 'Link')
+VM_MO_REF_PATH = (
+    _tag(VCLOUD_NS, 'VCloudExtension'),
+    _tag(VCLOUD_EXTENSION_NS, 'VmVimInfo'),
+    _tag(VCLOUD_EXTENSION_NS, 'VmVimObjectRef'),
+    _tag(VCLOUD_EXTENSION_NS, 'MoRef'),
+)
+VIM_SERVER_REF_PATH = VM_MO_REF_PATH[:-1] + (_tag(VCLOUD_EXTENSION_NS, 'VimServerRef'),)
+
+# where a VM lives: its MoRef and the vCenter (VimServer) holding it, as known by vCloud.
+VimRef = namedtuple('VimRef', ['mo_ref', 'server_id', 'server_name'])
+
+
+def _source(document):
+    """Return a file like object for a string, a requests response or a file like object."""
+    if isinstance(document, basestring):
+        return StringIO(document)
+    raw = getattr(document, 'raw', None)
+    if raw is not None:
+        # streamed requests response: read it while parsing, honouring gzip/deflate encodings.
+        raw.decode_content = True
+        return raw
+    return document
+
+
+def _release(document):
+    """Drain what is left of a streamed response so its connection goes back to the keep-alive pool."""
+    if hasattr(document, 'iter_content'):
+        for _ in document.iter_content(65536):
+            pass
+        document.close()
+
+
+def parse_notification(document, entity_type='vcloud:vm', notification_types=None):
+    """Parse a vCloud AMQP notification.
+    :param document: message body.
+    :param entity_type: type of the EntityLink whose id is returned.
+    :param notification_types: if given, parsing stops at the root element of notifications of other types.
+    :return: tuple (notification type, id of the first EntityLink of entity_type or None).
+    """
+    notification_type = None
+    for event, element in ET.iterparse(_source(document), events=('start',)):
+        if notification_type is None:
+            # the first element is the notification itself
+            notification_type = element.attrib.get('type')
+            if notification_types is not None and notification_type not in notification_types:
+                break
+        elif element.tag == ENTITY_LINK and element.attrib.get('type') == entity_type:
+            return notification_type, element.attrib['id']
+    return notification_type, None
+
+
+def find_link_href(document):
+    """Return the href of the first Link child of the document root, or None.
+    :param document: entity document as string, streamed response or file like object.
+    """
+    depth = 0
+    try:
+        for event, element in ET.iterparse(_source(document), events=('start', 'end')):
+            if event == 'end':
+                depth -= 1
+                continue
+            depth += 1
+            if depth == 2 and element.tag == LINK:
+                return element.attrib['href']
+        return None
+    finally:
+        _release(document)
+
+
+def find_vm_vim_ref(document):
+    """Return the VimRef of a vCloud VM document (VCloudExtension/VmVimInfo/VmVimObjectRef), or None.
+    The VimServer id is the last segment of the VimServerRef href.
+    :param document: VM document as string, streamed response or file like object.
+    """
+    stack = []
+    server_id, server_name = None, None
+    try:
+        for event, element in ET.iterparse(_source(document), events=('start', 'end')):
+            if event == 'start':
+                stack.append(element.tag)
+                if tuple(stack[1:]) == VIM_SERVER_REF_PATH:
+                    server_id = element.attrib.get('href', '').rstrip('/').rsplit('/', 1)[-1] or None
+                    server_name = element.attrib.get('name')
+                continue
+            if tuple(stack[1:]) == VM_MO_REF_PATH:
+                # VimServerRef comes first in the VmVimObjectRef sequence.
+                return VimRef(element.text, server_id, server_name)
+            stack.pop()
+            element.clear()
+        return None
+    finally:
+        _release(document)
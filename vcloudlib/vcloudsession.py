@@ -1,46 +1,88 @@
 __author__ = 'alessio.rocchi'
 
 import base64
+import logging
+import time
+from threading import Lock
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class VCS(object):
-    def __init__(self, host, username, password, version='5.5', verify=False, org='System'):
+    """vCloud Director REST session.
+    A single authentication token is shared by every caller and reused until vCloud answers 401/403 or
+    the token has been idle for more than `token_ttl` seconds. HTTP connections are kept alive in a pool of
+    `pool_maxsize` connections so concurrent callers don't pay a TLS handshake per request.
+    """
+    def __init__(self, host, username, password, version='5.5', verify=False, org='System', pool_maxsize=10,
+                 token_ttl=1500):
         if not (host.startswith('https://') or host.startswith('http://')):
             host = 'https://{host}'.format(host=host)
+        self.base_url = host
         self.url = host + '/api/sessions'
         self.username = username
         self.password = password
         self.version = version
         self.verify = verify
         self.token = None
+        self.token_ttl = token_ttl
+        self.token_expires = 0
         self.org = org
         self.org_list_url = None
         self.orgList = []
+        self.logger = logging.getLogger('shepherd.vcloudlib.VCS')
+        self._lock = Lock()
+        self.session = requests.Session()
+        self.session.verify = self.verify
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def login(self):
         encode = "Basic " + base64.standard_b64encode(self.username + "@" + self.org + ":" + self.password)
         headers = {}
         headers["Authorization"] = encode.rstrip()
         headers["Accept"] = "application/*+xml;version=" + self.version
-        response = requests.post(self.url, headers=headers, verify=self.verify)
+        response = self.session.post(self.url, headers=headers)
         if response.status_code == requests.codes.ok:
             self.token = response.headers["x-vcloud-authorization"]
+            self.token_expires = time.time() + self.token_ttl
+            self.logger.debug('Logged in to vCloud: {}'.format(self.url))
             return True
         else:
+            self.token = None
             return False
 
+    def _ensure_token(self, stale_token=None):
+        """Log in if there is no valid token. When stale_token is given the login happens only if no other
+        thread has already replaced it, so a burst of 401 triggers a single login.
+        """
+        with self._lock:
+            if stale_token is not None and self.token != stale_token:
+                return True
+            if self.token is None or stale_token is not None or time.time() > self.token_expires:
+                return self.login()
+            return True
+
     def _get_vcloud_headers(self):
         headers = {}
         headers["x-vcloud-authorization"] = self.token
         headers["Accept"] = "application/*+xml;version=" + self.version
         return headers
 
-    def execute_request(self, url):
-        headers = self._get_vcloud_headers()
-        response = requests.get(url, headers=headers, verify=self.verify)
+    def get(self, url, **kwargs):
+        """GET an url with the shared token, logging in again once if vCloud refuses it.
+        :return: requests.Response whatever the status code is.
+        """
+        self._ensure_token()
+        token = self.token
+        response = self.session.get(url, headers=self._get_vcloud_headers(), **kwargs)
+        if response.status_code in (requests.codes.unauthorized, requests.codes.forbidden):
+            self.logger.debug('vCloud refused the session token. Logging in again.')
+            response.close()
+            self._ensure_token(stale_token=token)
+            response = self.session.get(url, headers=self._get_vcloud_headers(), **kwargs)
         if response.status_code == requests.codes.ok:
-            return response
-        else:
-            return None
-
+            # vCloud expires idle sessions only: every successful call extends the token lifetime.
+            self.token_expires = time.time() + self.token_ttl
+        return response
@@ -0,0 +1,180 @@
+__author__ = 'alessio.rocchi'
+
+from pyVmomi import vim
+import logging
+import time
+
+
+def pattern_matcher(pattern):
+    """Return a callable(VM properties) -> bool selecting the VMs counted in the worst case allocation.
+    :param pattern: substring of the lowercase guestFullName, or a callable such as core.rules.Rule.matches.
+    """
+    if callable(pattern):
+        return pattern
+    return lambda props: pattern in (props.get('config.guestFullName') or '').lower()
+
+
+class CapacitySnapshot(object):
+    """In memory figures needed to evaluate the capacity of a cluster."""
+    def __init__(self, single_host_max_mhz_capacity, single_core_max_mhz_capacity, worst_case_mhz_allocation,
+                 num_cpus=None, host_capacities=None):
+        self.single_host_max_mhz_capacity = single_host_max_mhz_capacity
+        self.single_core_max_mhz_capacity = single_core_max_mhz_capacity
+        self.worst_case_mhz_allocation = worst_case_mhz_allocation
+        # VM managed object id -> numCPU of every VM of the cluster
+        self.num_cpus = num_cpus or {}
+        # host managed object id -> Mhz of the host
+        self.host_capacities = host_capacities or {}
+        self.taken = time.time()
+
+    def host_mhz(self, host):
+        return self.host_capacities.get(host._moId, self.single_host_max_mhz_capacity)
+
+    def fits(self, hosts, worst_case_mhz_allocation):
+        """Check if the hosts can hold the worst case allocation keeping spare the capacity of their largest host.
+        Hosts of different sizes are accounted for each with its own capacity.
+        :return True if there are enough resource else False.
+        """
+        if not hosts:
+            return False
+        capacities = [self.host_mhz(host) for host in hosts]
+        return sum(capacities) - worst_case_mhz_allocation >= max(capacities)
+
+    def vm_mhz(self, vm, num_cpu=None):
+        """Worst case Mhz of a VM of the cluster, fetching its config only when its numCPU is unknown.
+        :param num_cpu: numCPU of the VM when the caller knows it: a VM just created may be missing from the
+        figures collected.
+        """
+        if num_cpu is None:
+            num_cpu = self.num_cpus.get(vm._moId)
+        if num_cpu is None:
+            num_cpu = vm.config.hardware.numCPU
+        return int(num_cpu * self.single_core_max_mhz_capacity)
+
+
+class CapacityEngine(object):
+    """Compute the worst case Mhz allocation of a cluster from a single bulk property collection.
+    Resource pools, VMs and hosts of the cluster are fetched with one paged RetrievePropertiesEx through
+    VcInterface.collect_properties instead of dereferencing every managed object lazily. When an inventory
+    cache is available and synchronized the figures are computed from it without any call to the vCenter.
+    """
+    rp_properties = ['name', 'config.cpuAllocation.limit', 'vm']
+    vm_properties = ['config.guestFullName', 'config.guestId', 'config.hardware.numCPU']
+    host_properties = ['name', 'summary.hardware.cpuMhz', 'summary.hardware.numCpuCores', 'hardware.cpuInfo.hz']
+
+    def __init__(self, vc, ttl=60, inventory=None):
+        """
+        :param vc: VcInterface with an active session.
+        :param ttl: seconds a cluster snapshot is reused before being collected again.
+        :param inventory: optional core.inventory.Inventory to read from instead of collecting.
+        """
+        self.vc = vc
+        self.ttl = ttl
+        self.inventory = inventory
+        self.logger = logging.getLogger('shepherd.capacity.CapacityEngine')
+        # cluster managed object id -> (collection time, (resource pools, vms, hosts))
+        self._collections = {}
+
+    def collect(self, cluster):
+        """Collect resource pools, VMs and hosts of the cluster in one call.
+        :return: tuple of dictionaries (resource pools, vms, hosts) keyed by managed object id.
+        """
+        view = self.vc.content.viewManager.CreateContainerView(
+            cluster, [vim.ResourcePool, vim.VirtualMachine, vim.HostSystem], True
+        )
+        try:
+            data = self.vc.collect_properties(view_ref=view,
+                                              obj_type=[vim.ResourcePool, vim.VirtualMachine, vim.HostSystem],
+                                              path_set={vim.ResourcePool: self.rp_properties,
+                                                        vim.VirtualMachine: self.vm_properties,
+                                                        vim.HostSystem: self.host_properties},
+                                              include_mors=True)
+        finally:
+            view.DestroyView()
+        rps, vms, hosts = {}, {}, {}
+        for item in data:
+            obj = item['obj']
+            if isinstance(obj, vim.ResourcePool):
+                rps[obj._moId] = item
+            elif isinstance(obj, vim.VirtualMachine):
+                vms[obj._moId] = item
+            elif isinstance(obj, vim.HostSystem):
+                hosts[obj._moId] = item
+        return rps, vms, hosts
+
+    def collect_from_inventory(self, cluster):
+        """Same as collect, reading the inventory cache.
+        :return: tuple of dictionaries (resource pools, vms, hosts) keyed by managed object id.
+        """
+        rps = dict((rp['obj']._moId, rp) for rp in self.inventory.resource_pools()
+                   if rp.get('owner') is not None and rp['owner']._moId == cluster._moId)
+        vms = {}
+        for rp in rps.values():
+            for _vm in rp.get('vm', []):
+                vm = self.inventory.get(_vm)
+                if vm is not None:
+                    vms[_vm._moId] = vm
+        cluster_props = self.inventory.get(cluster) or {}
+        hosts = {}
+        for _host in cluster_props.get('host', []):
+            host = self.inventory.get(_host)
+            if host is not None:
+                hosts[_host._moId] = host
+        return rps, vms, hosts
+
+    def compute(self, rps, vms, hosts, pattern='windows'):
+        """Compute the capacity figures of a cluster from collected data, without any call to the vCenter.
+        :param pattern: selects the VMs counted, see pattern_matcher.
+        :return: CapacitySnapshot
+        """
+        matches = pattern_matcher(pattern)
+        # every host is considered equal to the first one, sorted by name to be deterministic.
+        _host = sorted(hosts.values(), key=lambda x: x.get('name'))[0]
+        single_host_max_mhz_capacity = _host['summary.hardware.cpuMhz'] * int(_host['summary.hardware.numCpuCores'])
+        single_core_max_mhz_capacity = int(_host['hardware.cpuInfo.hz']) / 1000000
+
+        worst_case_mhz_allocation = 0
+        for rp in rps.values():
+            if rp['name'] == 'Resources' or 'System vDC' in rp['name']:
+                continue
+            max_rp_usage = rp['config.cpuAllocation.limit']
+            rp_total_cpu = 0
+            windows_vm_count = 0
+            for _vm in rp.get('vm', []):
+                vm = vms.get(_vm._moId, {})
+                if matches(vm):
+                    windows_vm_count += 1
+                    rp_total_cpu += vm.get('config.hardware.numCPU', 0)
+            rp_total_mhz = rp_total_cpu * single_core_max_mhz_capacity
+            if rp_total_mhz > max_rp_usage:
+                rp_total_mhz = max_rp_usage
+            self.logger.debug('RP: {}, VM Count: {}, Windows cpuCount: {}, RP totalMhz: {}'.format(rp['name'],
+                                                                                                   windows_vm_count,
+                                                                                                   rp_total_cpu,
+                                                                                                   rp_total_mhz))
+            worst_case_mhz_allocation += rp_total_mhz
+        self.logger.info('Processed: {} Resource Pools'.format(len(rps)))
+        num_cpus = dict((mo_id, vm['config.hardware.numCPU']) for mo_id, vm in vms.items()
+                        if 'config.hardware.numCPU' in vm)
+        host_capacities = dict((mo_id, host['summary.hardware.cpuMhz'] * int(host['summary.hardware.numCpuCores']))
+                               for mo_id, host in hosts.items())
+        return CapacitySnapshot(single_host_max_mhz_capacity, single_core_max_mhz_capacity, worst_case_mhz_allocation,
+                                num_cpus, host_capacities)
+
+    def snapshot(self, cluster, pattern='windows'):
+        """Return the capacity figures of the cluster, collecting them again only when older than ttl.
+        The collection is shared by every pattern, so the pools of a cluster cost a single collection.
+        :param cluster: vim.ClusterComputeResource to evaluate.
+        :param pattern: selects the VMs counted, see pattern_matcher.
+        :return: CapacitySnapshot
+        """
+        if self.inventory is not None and self.inventory.ready.is_set():
+            rps, vms, hosts = self.collect_from_inventory(cluster)
+            if hosts:
+                return self.compute(rps, vms, hosts, pattern)
+        collected = self._collections.get(cluster._moId)
+        if collected is None or time.time() - collected[0] > self.ttl:
+            collected = (time.time(), self.collect(cluster))
+            self._collections[cluster._moId] = collected
+        rps, vms, hosts = collected[1]
+        return self.compute(rps, vms, hosts, pattern)
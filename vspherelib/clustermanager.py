@@ -3,8 +3,9 @@ __author__ = 'alessio.rocchi'
 from pyVmomi import vim
 from helper.tasks import wait_for_task
 from helper.Types import Operation
-from helper.Types import HostGroupNotExists
 from helper.Types import VmGroupNotExists
+from capacity import CapacityEngine
+from hostscorer import HostScorer
 import logging
 
 rootLogger = logging.getLogger('shepherd.clustermanager')
@@ -17,7 +18,11 @@ class ClusterManager(object):
                  host_group_name='WindowsVM',
                  vm_group_name='Windows',
                  windows_affinity_rule_name="WindowsAffinityRule",
-                 test_mode=False):
+                 test_mode=False,
+                 vc=None,
+                 inventory=None,
+                 tracker=None,
+                 task_timeout=None):
         """
         :param si: ServiceInstance Managed object referred to a vCenter connection
         :param content: vim.ServiceInstanceContent data object define properties for ServiceInstance MO
@@ -25,6 +30,13 @@ class ClusterManager(object):
         Default: "WindowsVM"
         :param vm_group_name: string representing the name of the vim.cluster.VmGroup to manage.
         Default: "Windows"
+        :param vc: VcInterface owning the session, needed by reconcile_pools: capacity is computed by a
+        CapacityEngine with a single bulk property collection per cluster.
+        :param inventory: optional core.inventory.Inventory used for read only decisions (capacity, host names).
+        Reconfiguration specs are always built from the live cluster configuration.
+        :param tracker: optional core.tasktracker.TaskTracker following the reconfiguration tasks. Without it the
+        tasks are followed with helper.tasks.wait_for_task.
+        :param task_timeout: seconds to wait for a task, None waits forever.
         """
         self.logger = logging.getLogger('shepherd.clustermanager.ClusterManager')
         self.si = si
@@ -33,6 +45,25 @@ class ClusterManager(object):
         self.vm_group_name = vm_group_name
         self.windows_affinity_rule_name = windows_affinity_rule_name
         self.test_mode = test_mode
+        self.inventory = inventory
+        self.capacity = CapacityEngine(vc, inventory=inventory) if vc is not None else None
+        self.scorer = HostScorer(vc) if vc is not None else None
+        self.tracker = tracker
+        self.task_timeout = task_timeout
+
+    def submit(self, task, wait=True):
+        """Follow a reconfiguration task.
+        :param wait: if True return once the task is complete, raising its fault if it failed.
+        :return: the TaskFuture of the task when a tracker is given, else None.
+        """
+        if self.tracker is None:
+            if wait:
+                wait_for_task(task, si=self.si, timeout=self.task_timeout)
+            return None
+        future = self.tracker.track(task)
+        if wait:
+            future.result(self.task_timeout)
+        return future
 
     @staticmethod
     def get_host_group_by_name(name, cluster):
@@ -73,6 +104,14 @@ class ClusterManager(object):
                 return result[0]
         return None
 
+    def _get_name(self, obj):
+        """Return the name of a managed object, from the inventory cache when it knows it."""
+        if self.inventory is not None:
+            props = self.inventory.get(obj)
+            if props and 'name' in props:
+                return props['name']
+        return obj.name
+
     def get_cluster(self, name=None):
         """Return all clusters in the ServiceInstanceContent data object if a name is not specified, otherwise
         it return a list of cluster having the name to find.
@@ -101,8 +140,7 @@ class ClusterManager(object):
             from pprint import pprint
             pprint(spec)
         else:
-            task = cluster.ReconfigureComputeResource_Task(spec, True)
-            # wait_for_task(task)
+            self.submit(cluster.ReconfigureComputeResource_Task(spec, True), wait=False)
         return True
 
     def add_vm_to_vm_group(self, vm, cluster):
@@ -138,68 +176,10 @@ class ClusterManager(object):
 
             pprint(spec)
         else:
-            task = cluster.ReconfigureComputeResource_Task(spec, True)
-            # wait_for_task(task)
+            self.submit(cluster.ReconfigureComputeResource_Task(spec, True), wait=False)
         self.logger.info('VM: {} finally plugged into VmGroup: {}'.format(vm_name, self.vm_group_name))
         return True
 
-    def add_host_to_host_group(self, cluster):
-        """Add a new host entity to an HostGroup spec.
-        :param cluster: vim.ClusterComputeResource representing the cluster containing the HostGroup.
-        :return True in case of success, else False
-        """
-        active_hosts = []
-        # I will take the first result returned by the function.
-        windows_host_group = self.get_host_group_by_name(self.host_group_name, cluster)
-        # Assuring that the group exists.
-        operation = Operation()
-        if windows_host_group and len(windows_host_group) > 0:
-            # Extrapolate the first element of the list (we should have only one record here if everything is fine.
-            try:
-                windows_host_group = windows_host_group[0]
-            except IndexError:
-                # Something really strange is happening... Let's raise an error.
-                raise HostGroupNotExists(name=self.host_group_name)
-            # I take the first host available in the cluster
-            operation.operation = operation.edit
-            # If the HostGroup is empty, I will add the first host of the cluster (sorted by name)
-            if len(windows_host_group.host) == 0:
-                sorted_list = sorted(
-                    map(lambda x: x, cluster.host),
-                    key=lambda x: x.name, reverse=False
-                )
-                first_usable_host = sorted_list[0]
-            else:
-                sorted_list = sorted(
-                    filter(lambda x: x not in windows_host_group.host, cluster.host),
-                    key=lambda x: x.name, reverse=False
-                )
-                first_usable_host = sorted_list[0]
-            active_hosts = windows_host_group.host
-            active_hosts.append(first_usable_host)
-            self.logger.debug('Picked host: {}'.format(first_usable_host.name))
-        else:
-            self.logger.critical("HostGroup doesn't exists. We shouldn't be here...")
-            raise HostGroupNotExists(name=self.host_group_name)
-        spec = vim.cluster.ConfigSpecEx()
-        group = vim.cluster.GroupSpec()
-        group.operation = operation.operation
-        group.info = vim.cluster.HostGroup()
-        group.info.name = self.host_group_name
-        # if the group exists and the object is really an HostGroup I will add the current list of available
-        # hosts to it.
-        if windows_host_group and isinstance(windows_host_group, vim.cluster.HostGroup):
-            group.info.host = active_hosts
-        spec.groupSpec.append(group)
-        if self.test_mode:
-            from pprint import pprint
-
-            pprint(spec)
-        else:
-            task = cluster.ReconfigureComputeResource_Task(spec, True)
-            # wait_for_task(task)
-        return True
-
     def create_vm_group(self, cluster):
         """Create the VmGroup in the DRS.
         :param cluster: vim.ClusterComputeResource representing the cluster where the VM is contained.
@@ -225,8 +205,7 @@ class ClusterManager(object):
 
             pprint(spec)
         else:
-            task = cluster.ReconfigureComputeResource_Task(spec, True)
-            # wait_for_task(task)
+            self.submit(cluster.ReconfigureComputeResource_Task(spec, True), wait=False)
         self.logger.info("VmGroup: {} Created.".format(self.vm_group_name))
         return True
 
@@ -256,8 +235,7 @@ class ClusterManager(object):
 
             pprint(spec)
         else:
-            task = cluster.ReconfigureComputeResource_Task(spec, True)
-            wait_for_task(task)
+            self.submit(cluster.ReconfigureComputeResource_Task(spec, True))
         return True
 
     def get_rp_view_by_vm(self, vm):
@@ -273,85 +251,115 @@ class ClusterManager(object):
         else:
             return None
 
-    def check_avail_res(self, vm, cluster, pattern="windows", only_powered_on=False):
-        """Calculate if there is enough resources available on the Hosts members of the Windows HostGroup to contain
-        also the new Virtual Machine.
-        :param vm: vim.VirtualMachine managed object representing the VM to add the DRS Group.
-        :param cluster: vim.ClusterComputeResource representing the cluster containing the HostGroup.
-        :return True if there are enough resource else False.
+    def rank_candidates(self, cluster, hosts):
+        """Return the hosts of the cluster that can join a HostGroup, best candidate first.
+        :param hosts: current hosts of the HostGroup.
+        :return: list of tuples (vim.HostSystem, capacity in Mhz), see HostScorer.
         """
-        # check hosts in cluster host group
-        try:
-            windows_host_group = self.get_host_group_by_name(self.host_group_name, cluster)[0]
-        except IndexError:
-            raise HostGroupNotExists(host_group_name=self.host_group_name)
+        exclude = set(host._moId for host in hosts)
+        return self.scorer.rank(cluster, exclude)
 
-        hosts = windows_host_group.host
-        if len(hosts) <= 0:
-            return False
-
-        worst_case_mhz_allocation = 0
+    def reconcile_pools(self, cluster, vms_by_pool, create_affinity_rule=False, wait=True, num_cpus=None):
+        """Put VMs of the same cluster in the groups of several DRS pools with a single ReconfigureComputeResource_Task.
+        The live cluster configuration is read once and every pool is evaluated on the same capacity collection.
+        :param cluster: vim.ClusterComputeResource containing every VM.
+        :param vms_by_pool: list of (pool, list of vim.VirtualMachine). A pool is any object with name,
+        host_group_name, vm_group_name, affinity_rule_name and matches(VM properties), e.g. core.rules.Rule.
+        :param create_affinity_rule: if True add the VM/Host affinity rules when missing.
+        :param wait: if True return once the reconfiguration is complete, raising its fault if it failed. If False,
+        with a tracker, return as soon as the task is submitted.
+        :param num_cpus: optional dictionary VM managed object id -> numCPU known by the caller, e.g. from the
+        VmRecord of the Reactioneer, saving a lookup of the VMs missing from the capacity figures.
+        :return: the TaskFuture of the reconfiguration when a tracker is given, else None. None as well if nothing
+        had to be changed.
+        """
+        assert self.capacity is not None, Exception('Capacity needs a VcInterface.')
+        config = cluster.configurationEx
+        spec = vim.cluster.ConfigSpecEx()
+        # hosts given to a pool in this pass are not offered to the next ones.
+        reserved = set()
+        summary = []
+        for pool, vms in vms_by_pool:
+            new_members, added_hosts = self._pool_spec(spec, config, cluster, pool, vms,
+                                                       create_affinity_rule, reserved, num_cpus or {})
+            if new_members or added_hosts:
+                summary.append('{}: {} VMs, {} hosts'.format(pool.name, len(new_members), len(added_hosts)))
 
-        # get view of resourcePools inside the cluster
-        rp_view = self.si.content.viewManager.CreateContainerView(
-            cluster, [vim.ResourcePool], True
-        )
+        if not spec.groupSpec and not spec.rulesSpec:
+            self.logger.info('Cluster: {} is already coherent. Nothing to do.'.format(cluster.name))
+            return None
+        self.logger.info('Reconfiguring cluster: {} - {}'.format(cluster.name, '; '.join(summary) or 'rules added'))
+        if self.test_mode:
+            from pprint import pprint
 
-        _host = cluster.host[0]  # let's take the first host in cluster to get information
-        single_host_max_mhz_capacity = _host.summary.hardware.cpuMhz * int(_host.summary.hardware.numCpuCores)
-        single_core_max_mhz_capacity = int(_host.hardware.cpuInfo.hz) / 1000000
-        available_mhz_on_windows_host_group = len(windows_host_group.host) * single_host_max_mhz_capacity
+            pprint(spec)
+            return None
+        # without a tracker there is nothing to return: the task is waited for in any case.
+        return self.submit(cluster.ReconfigureComputeResource_Task(spec, True), wait or self.tracker is None)
 
-        # defensive here
-        assert rp_view and len(rp_view.view) > 0, Exception()
+    def _pool_spec(self, spec, config, cluster, pool, vms, create_affinity_rule, reserved, num_cpus):
+        """Add to spec the group and rule specs bringing the VMs in the groups of a pool.
+        :return: tuple (VMs added to the VmGroup, hosts added to the HostGroup)
+        """
+        host_group = filter(lambda x: isinstance(x, vim.cluster.HostGroup) and x.name == pool.host_group_name,
+                            config.group)
+        vm_group = filter(lambda x: isinstance(x, vim.cluster.VmGroup) and x.name == pool.vm_group_name,
+                          config.group)
+        operation = Operation()
 
-        for rp in rp_view.view:
-            max_rp_usage = rp.config.cpuAllocation.limit
-            if rp.name == 'Resources' or 'System vDC' in rp.name:
-                continue
-            _windows_vm = []
-            for vm in rp.vm:
-                vm_config = vm.config
-                if hasattr(vm_config, 'guestFullName'):
-                    if pattern in vm.config.guestFullName.lower():
-                        _windows_vm.append(vm)
-            rp_total_cpu = sum(
-                map(lambda x: x.config.hardware.numCPU, _windows_vm)
-            )
-            rp_total_mhz = rp_total_cpu * single_core_max_mhz_capacity
-            if rp_total_mhz > max_rp_usage:
-                rp_total_mhz = max_rp_usage
-            self.logger.debug('RP: {}, VM Count: {}, Windows cpuCount: {}, RP totalMhz: {}'.format(rp.name,
-                                                                                                   len(_windows_vm),
-                                                                                                   rp_total_cpu,
-                                                                                                   rp_total_mhz))
-            worst_case_mhz_allocation = worst_case_mhz_allocation + rp_total_mhz
-            # self.logger.debug('-> Current Worst Case Mhz Allocation: {}'.format(worst_case_mhz_allocation))
-            # self.logger.debug('-> Total Mhz Available on HostGroup: {}'.format(available_mhz_on_windows_host_group))
-        self.logger.info('Processed: {} Resource Pools'.format(len(rp_view.view)))
+        # HostGroup: expand it, best candidate first, while the batch doesn't fit. Several hosts may be needed
+        # for a single VM when the candidates are smaller than the hosts already in the group.
+        hosts = list(host_group[0].host) if host_group else []
+        capacity = self.capacity.snapshot(cluster, pool.matches)
+        candidates = None
+        added_hosts = []
+        for vm in vms:
+            worst_case_mhz_allocation = capacity.worst_case_mhz_allocation + capacity.vm_mhz(vm,
+                                                                                           num_cpus.get(vm._moId))
+            while not capacity.fits(hosts, worst_case_mhz_allocation):
+                if candidates is None:
+                    # host metrics are collected only when a host has to be added.
+                    candidates = filter(lambda x: x[0]._moId not in reserved, self.rank_candidates(cluster, hosts))
+                if not candidates:
+                    break
+                host, host_mhz = candidates.pop(0)
+                capacity.host_capacities.setdefault(host._moId, host_mhz)
+                self.logger.debug('Picked host: {} for pool: {}'.format(self._get_name(host), pool.name))
+                hosts.append(host)
+                added_hosts.append(host)
+                reserved.add(host._moId)
+            if not capacity.fits(hosts, worst_case_mhz_allocation):
+                self.logger.warning('No more hosts available in cluster: {} for pool: {}.'.format(cluster.name,
+                                                                                                   pool.name))
+                break
+        if not host_group or added_hosts:
+            group = vim.cluster.GroupSpec()
+            group.operation = operation.edit if host_group else operation.add
+            group.info = vim.cluster.HostGroup()
+            group.info.name = pool.host_group_name
+            group.info.host = hosts
+            spec.groupSpec.append(group)
 
-        worst_case_mhz_allocation += int(vm.config.hardware.numCPU * single_core_max_mhz_capacity)
+        # VmGroup: existing members plus the batch.
+        members = [_vm for _vm in vm_group[0].vm if isinstance(_vm, vim.VirtualMachine)] if vm_group else []
+        new_members = [vm for vm in vms if vm not in members]
+        if not vm_group or new_members:
+            group_vm = vim.cluster.GroupSpec()
+            group_vm.operation = operation.edit if vm_group else operation.add
+            group_vm.info = vim.cluster.VmGroup()
+            group_vm.info.name = pool.vm_group_name
+            group_vm.info.vm = members + new_members
+            spec.groupSpec.append(group_vm)
 
-        total_mhz = single_host_max_mhz_capacity * len(cluster.host)
-        if worst_case_mhz_allocation > available_mhz_on_windows_host_group:
-            self.logger.debug('Not enough resources available with the current number of hosts. Returning False')
-            return False
-        else:
-            # HostGroup must have the equal amount of a single host in terms of mhz available in order to have
-            # a spare host in the group.
-            spare_capacity = available_mhz_on_windows_host_group - worst_case_mhz_allocation
-            # self.logger.debug('Total Mhz Available on Windows HostGroup: {}'.format(
-            #    available_mhz_on_windows_host_group
-            # ))
-            self.logger.debug("Total Mhz: {} - Worst Case: {} - Spare Capacity: {} - Single Host Capacity: {}".format(
-                available_mhz_on_windows_host_group,
-                worst_case_mhz_allocation,
-                spare_capacity,
-                single_host_max_mhz_capacity
-            ))
-            if spare_capacity >= single_host_max_mhz_capacity:
-                self.logger.debug("Spare host available. Returning True")
-                return True
-            else:
-                self.logger.debug("No spare host resource available. Returning False")
-                return False
+        if create_affinity_rule:
+            rules = filter(lambda x: x.name == pool.affinity_rule_name, config.rule)
+            if not rules:
+                rule = vim.cluster.RuleSpec()
+                rule.operation = operation.add
+                rule.info = vim.cluster.VmHostRuleInfo()
+                rule.info.enabled = True
+                rule.info.name = pool.affinity_rule_name
+                rule.info.vmGroupName = pool.vm_group_name
+                rule.info.affineHostGroupName = pool.host_group_name
+                spec.rulesSpec.append(rule)
+        return new_members, added_hosts
@@ -17,22 +17,155 @@ This module implements helper functions for vim.Task
 """
 __author__ = "VMware, Inc."
 
+import math
+import random
+import threading
 import time
+import weakref
 
-import pyVim.connect as connect
 from pyVmomi import vim
 from pyVmomi import vmodl
 
 
-def build_task_filter(task):
+# shortest interval between two polls of poll_task.
+MIN_SLEEP_SECONDS = 0.1
+
+
+class TaskTimeout(Exception):
+    """The task did not complete before the deadline given to the helper."""
+    pass
+
+
+class SessionCollectors(object):
+    """PropertyCollectors of every vCenter session the helpers have seen,
+    keyed by the SOAP stub of the session.
+
+    A task is always watched on the session it is bound to, or the one given
+    explicitly, never on the process-wide connect.GetSi(): with several
+    sessions, or several vCenters, that is the last session connected and
+    possibly one already logged out.
+
+    One-shot retrievals use the default collector of the session. Waits use
+    a private collector created once per session, so that their filters and
+    version tokens are never mixed with the ones of other callers. Waits on
+    the same session are serialized by a lock of the session, waits on
+    different sessions run in parallel.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # stub -> {'content': ..., 'private': ..., 'lock': ...}, dropped with
+        # the stub.
+        self._sessions = weakref.WeakKeyDictionary()
+
+    def _entry(self, stub):
+        with self._lock:
+            entry = self._sessions.get(stub)
+            if entry is None:
+                entry = {'content': None, 'private': None,
+                         'lock': threading.Lock()}
+                self._sessions[stub] = entry
+            return entry
+
+    def content(self, stub):
+        """Return the vim.ServiceInstanceContent of the session."""
+        entry = self._entry(stub)
+        if entry['content'] is None:
+            si = vim.ServiceInstance('ServiceInstance', stub)
+            entry['content'] = si.RetrieveContent()
+        return entry['content']
+
+    def default(self, stub):
+        """Return the default PropertyCollector of the session."""
+        return self.content(stub).propertyCollector
+
+    def private(self, stub):
+        """Return the private PropertyCollector of the session and the lock
+        to hold while waiting on it.
+
+        :rtype tuple: (vmodl.query.PropertyCollector, threading.Lock)
+        """
+        entry = self._entry(stub)
+        with entry['lock']:
+            if entry['private'] is None:
+                entry['private'] = \
+                    self.default(stub).CreatePropertyCollector()
+        return entry['private'], entry['lock']
+
+    def forget(self, stub):
+        """Drop the collectors of a session, e.g. before logging it out."""
+        with self._lock:
+            entry = self._sessions.pop(stub, None)
+        if entry is not None and entry['private'] is not None:
+            try:
+                entry['private'].DestroyPropertyCollector()
+            except Exception:
+                pass
+
+
+collectors = SessionCollectors()
+
+
+def _session_stub(task, kwargs):
+    """Return the stub of the session given as si, else the one of the task."""
+    si = kwargs.get('si')
+    return si._stub if si is not None else task._stub
+
+
+def _deadline_wait(deadline, max_wait):
+    """Return the maxWaitSeconds of the next WaitForUpdatesEx: max_wait capped
+    by the time left before deadline, at least 1 second. None waits forever.
+    """
+    if deadline is None:
+        return max_wait
+    remaining = int(math.ceil(deadline - time.time()))
+    return max(1, remaining if max_wait is None else min(remaining, max_wait))
+
+
+def cancel_task(task):
+    """Ask vSphere to cancel a task, ignoring tasks that cannot be canceled
+    or are already complete: the caller keeps waiting for the outcome.
+    """
+    try:
+        task.CancelTask()
+    except (vmodl.fault.NotSupported, vim.fault.InvalidState):
+        pass
+
+
+def retrieve_task_state(task, pc=None):
+    """Fetch info.state, info.error and info.progress of a task in a single
+    RetrieveProperties call, where reading task.info.state and then
+    task.info.error costs one round trip each.
+
+    :param pc: collector to use, by default the default collector of the
+        session the task is bound to
+
+    :rtype dict: property path -> value, unset properties are missing
+    """
+    if pc is None:
+        pc = collectors.default(task._stub)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=task)
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(
+        type=vim.Task, pathSet=['info.state', 'info.error', 'info.progress'])
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=[obj_spec], propSet=[prop_spec])
+    contents = pc.RetrieveProperties([filter_spec])
+    return dict((prop.name, prop.val) for prop in contents[0].propSet)
+
+
+def build_task_filter(task, pc=None):
     """A helper that builds a filter for a particular task object.
 
     This method builds a property filter for use with a task object and
 
+    :param pc: collector owning the filter, by default the private collector
+        of the session the task is bound to
+
     :rtype vim.PropertyFilter: property filter for this object
     """
 
-    pc = connect.GetSi().content.propertyCollector
+    if pc is None:
+        pc, _ = collectors.private(task._stub)
 
     obj_spec = [vmodl.query.PropertyCollector.ObjectSpec(obj=task)]
     prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
@@ -92,33 +225,79 @@ def wait_for_task(task, *args, **kwargs):
     if the task is observed leaving queued and entering running, then the
     callback for 'running' is fired.
 
+    use with a deadline
+    ===================
+
+    code::
+        rename_task.wait(timeout=600, cancel=stop_event)
+
+    Updates are waited for with WaitForUpdatesEx and at most max_wait seconds
+    (default 5) at a time, so the deadline and the cancel event (any object
+    with is_set(), e.g. threading.Event) are checked between two waits. Once
+    the cancel event is set the task is canceled and its outcome, usually a
+    vim.fault.RequestCanceled, is still waited for. Past the deadline
+    TaskTimeout is raised, after canceling the task if cancel_on_timeout.
+
+    use with several sessions
+    =========================
+
+    code::
+        wait_for_task(task, si=vc.si)
+
+    The task is watched on the private collector of the session given as si,
+    by default the session the task is bound to (see SessionCollectors).
+
     :type task: vim.Task
     :param task: any subclass of the vim.Task object
 
     :rtype None: returns or raises exception
 
     :raises vim.RuntimeFault:
+    :raises TaskTimeout:
     """
 
     def no_op(task, *args):
         pass
 
+    timeout = kwargs.get('timeout')
+    cancel = kwargs.get('cancel')
+    cancel_on_timeout = kwargs.get('cancel_on_timeout', False)
+    deadline = None if timeout is None else time.time() + timeout
+    max_wait = None
+    if deadline is not None or cancel is not None:
+        max_wait = kwargs.get('max_wait', 5)
+
     queued_callback = kwargs.get('queued', no_op)
     running_callback = kwargs.get('running', no_op)
     success_callback = kwargs.get('success', no_op)
     error_callback = kwargs.get('error', no_op)
 
-    si = connect.GetSi()
-    pc = si.content.propertyCollector
-    filter = build_task_filter(task)
+    pc, session_lock = collectors.private(_session_stub(task, kwargs))
+    session_lock.acquire()
+    filter = None
 
     try:
-        version, state = None, None
+        filter = build_task_filter(task, pc)
+        version, state = '', None
+        canceled = False
 
         # Loop looking for updates till the state moves to a completed state.
         waiting = True
         while waiting:
-            update = pc.WaitForUpdates(version)
+            if cancel is not None and cancel.is_set() and not canceled:
+                canceled = True
+                cancel_task(task)
+            if deadline is not None and time.time() >= deadline:
+                if cancel_on_timeout:
+                    cancel_task(task)
+                raise TaskTimeout('Task {0} not complete after {1} seconds.'
+                                  .format(task._moId, timeout))
+            options = vmodl.query.PropertyCollector.WaitOptions(
+                maxWaitSeconds=_deadline_wait(deadline, max_wait))
+            update = pc.WaitForUpdatesEx(version, options)
+            if update is None:
+                # maxWaitSeconds elapsed without changes.
+                continue
             version = update.version
             for filterSet in update.filterSet:
                 for objSet in filterSet.objectSet:
@@ -146,8 +325,11 @@ def wait_for_task(task, *args, **kwargs):
                             raise task.info.error
 
     finally:
-        if filter:
-            filter.Destroy()
+        try:
+            if filter:
+                filter.Destroy()
+        finally:
+            session_lock.release()
 
 
 def poll_task(task, *args, **kwargs):
@@ -162,8 +344,12 @@ def poll_task(task, *args, **kwargs):
     python process from advancing until the task is completed on the vCenter
     or ESX host on which the task is actually running.
 
-    NOTE: sleep_seconds of 0 indicates check as fast as possible. This
-    mode will generate a great deal of network traffic.
+    Every poll fetches info.state, info.error and info.progress with a single
+    RetrieveProperties call. The interval between two polls starts at
+    sleep_seconds and doubles up to max_sleep_seconds while the task shows
+    no progress, with random jitter so that many waiting threads do not poll
+    in lockstep. Prefer wait_for_task, or a TaskTracker, which are notified of
+    changes and do not poll at all.
 
     Usage Examples
     ==============
@@ -191,18 +377,27 @@ def poll_task(task, *args, **kwargs):
     use with sleep_seconds
     ======================
     code::
-        rename_task.wait(sleep_seconds=0)
+        rename_task.wait(sleep_seconds=0.5, max_sleep_seconds=10)
 
-    The default sleep_seconds is 1, meaning the vCenter server is polled at
-    most 1 time every 1 second. If you set sleep_seconds to 0, the vCenter
-    server will be polled as fast as possible. This has the tendency to create
-    a great deal of network traffic.
+    The default sleep_seconds is 1 and max_sleep_seconds is 30: vCenter is
+    polled after about 1, 2, 4, ... seconds, then every 30 seconds at most.
+    The interval goes back to sleep_seconds whenever the task state or
+    progress changes. A sleep_seconds of 0 or None starts from
+    MIN_SLEEP_SECONDS: the server is never polled in a tight loop.
 
+    use with a deadline
+    ===================
     code::
-        rename_task.wait(sleep_seconds=3)
+        rename_task.poll(timeout=600, cancel=stop_event)
+
+    Past timeout seconds TaskTimeout is raised, after canceling the task if
+    cancel_on_timeout. When the cancel event (any object with is_set() and
+    wait(), e.g. threading.Event) is set, the sleep is interrupted, the task
+    is canceled and its outcome is still waited for.
 
-    The process will wait 3 seconds between polling vCenter for task status.
-    The default is to wait 1 second between polling vCenter for task updates.
+    The task is polled on the default collector of the session given as si,
+    by default the session the task is bound to, or on the collector given
+    as pc.
 
     use with callbacks
     ==================
@@ -260,12 +455,19 @@ def poll_task(task, *args, **kwargs):
     :rtype None: returns or raises exception
 
     :raises vim.RuntimeFault:
+    :raises TaskTimeout:
     """
 
     def no_op(task, *args):
         pass
 
-    sleep_seconds = kwargs.get('sleep_seconds', 1)
+    sleep_seconds = max(kwargs.get('sleep_seconds', 1) or 0, MIN_SLEEP_SECONDS)
+    max_sleep_seconds = max(kwargs.get('max_sleep_seconds', 30), sleep_seconds)
+    timeout = kwargs.get('timeout')
+    cancel = kwargs.get('cancel')
+    cancel_on_timeout = kwargs.get('cancel_on_timeout', False)
+    pc = kwargs.get('pc') or collectors.default(_session_stub(task, kwargs))
+    deadline = None if timeout is None else time.time() + timeout
 
     queued_callback = kwargs.get('queued', no_op)
     running_callback = kwargs.get('running', no_op)
@@ -274,12 +476,21 @@ def poll_task(task, *args, **kwargs):
 
     periodic_callback = kwargs.get('periodic', no_op)
 
-    last_state = None
+    last_state, last_progress = None, None
+    interval = sleep_seconds
+    canceled = False
     while True:
         periodic_callback(task, *args)
 
-        if last_state != task.info.state:
-            last_state = task.info.state
+        if cancel is not None and cancel.is_set() and not canceled:
+            canceled = True
+            cancel_task(task)
+
+        info = retrieve_task_state(task, pc)
+        state = info.get('info.state')
+        if state != last_state:
+            last_state = state
+            interval = sleep_seconds
 
             if last_state == vim.TaskInfo.State.success:
                 success_callback(task, *args)
@@ -293,10 +504,28 @@ def poll_task(task, *args, **kwargs):
 
             elif last_state == vim.TaskInfo.State.error:
                 error_callback(task, *args)
-                raise task.info.error
-
-        if sleep_seconds is not None:
-            time.sleep(sleep_seconds)
+                raise info['info.error']
+
+        elif info.get('info.progress') != last_progress:
+            interval = sleep_seconds
+        last_progress = info.get('info.progress')
+
+        now = time.time()
+        if deadline is not None and now >= deadline:
+            if cancel_on_timeout:
+                cancel_task(task)
+            raise TaskTimeout('Task {0} not complete after {1} seconds.'
+                              .format(task._moId, timeout))
+
+        # "equal jitter": half of the interval is fixed, half is random.
+        delay = interval / 2.0 + random.uniform(0, interval / 2.0)
+        if deadline is not None:
+            delay = min(delay, deadline - now)
+        if cancel is not None and not canceled:
+            cancel.wait(delay)
+        else:
+            time.sleep(delay)
+        interval = min(interval * 2, max_sleep_seconds)
 
 
 # NOTE: This kind of injection usually goes at the *bottom* of a file.
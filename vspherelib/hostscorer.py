@@ -0,0 +1,66 @@
+__author__ = 'alessio.rocchi'
+
+from pyVmomi import vim
+import logging
+
+
+class HostScorer(object):
+    """Rank the hosts of a cluster by the headroom they would bring to a HostGroup.
+    Size, current load and runtime state of every host are fetched with one bulk property collection. Hosts
+    disconnected or in maintenance mode are never proposed; the others are ranked by free Mhz, then free memory.
+    """
+    properties = ['name', 'summary.hardware.cpuMhz', 'summary.hardware.numCpuCores', 'summary.hardware.memorySize',
+                  'summary.quickStats.overallCpuUsage', 'summary.quickStats.overallMemoryUsage',
+                  'runtime.inMaintenanceMode', 'runtime.connectionState']
+
+    def __init__(self, vc):
+        """
+        :param vc: VcInterface with an active session.
+        """
+        self.vc = vc
+        self.logger = logging.getLogger('shepherd.hostscorer.HostScorer')
+
+    def collect(self, cluster):
+        """Collect the metrics of every host of the cluster in one call.
+        :return: list of dictionaries of host properties, with the managed object under 'obj'.
+        """
+        view = self.vc.content.viewManager.CreateContainerView(cluster, [vim.HostSystem], True)
+        try:
+            return self.vc.collect_properties(view_ref=view, obj_type=vim.HostSystem, path_set=self.properties,
+                                              include_mors=True)
+        finally:
+            view.DestroyView()
+
+    @staticmethod
+    def eligible(host):
+        return host.get('runtime.connectionState') == 'connected' and not host.get('runtime.inMaintenanceMode')
+
+    @staticmethod
+    def capacity_mhz(host):
+        return host.get('summary.hardware.cpuMhz', 0) * int(host.get('summary.hardware.numCpuCores', 0))
+
+    def headroom(self, host):
+        """Return the free resources of a host as tuple (free Mhz, free memory in MB)."""
+        free_mhz = self.capacity_mhz(host) - (host.get('summary.quickStats.overallCpuUsage') or 0)
+        free_memory = (host.get('summary.hardware.memorySize', 0) / (1024 * 1024) -
+                       (host.get('summary.quickStats.overallMemoryUsage') or 0))
+        return free_mhz, free_memory
+
+    def rank(self, cluster, exclude=()):
+        """Return the eligible hosts of the cluster, the one bringing the most headroom first.
+        :param exclude: managed object ids of the hosts not to propose, e.g. the ones already in the HostGroup.
+        :return: list of tuples (vim.HostSystem, capacity in Mhz)
+        """
+        candidates = []
+        for host in self.collect(cluster):
+            if host['obj']._moId in exclude:
+                continue
+            if not self.eligible(host):
+                self.logger.debug('Host: {} skipped: {}, maintenance mode: {}.'.format(
+                    host.get('name'), host.get('runtime.connectionState'), host.get('runtime.inMaintenanceMode')
+                ))
+                continue
+            candidates.append(host)
+        # best headroom first, then by name to be deterministic.
+        candidates.sort(key=lambda x: (tuple(-value for value in self.headroom(x)), x.get('name')))
+        return [(host['obj'], self.capacity_mhz(host)) for host in candidates]